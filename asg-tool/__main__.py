@@ -25,6 +25,14 @@ def parse_args():
         type=str,
         help="Name of ASG to bind",
     )
+    bind_asg_parser.add_argument(
+        "-b",
+        "--batch-size",
+        dest="batch_size",
+        default=1,
+        type=int,
+        help="Number of spaces to bind per request (default: 1)",
+    )
 
     unbind_asg_parser = subparsers.add_parser(
         "unbind-asg", help="Unbind an ASG from all spaces."
@@ -37,6 +45,22 @@ def parse_args():
         type=str,
         help="Name of ASG to bind",
     )
+    unbind_asg_parser.add_argument(
+        "-w",
+        "--workers",
+        dest="workers",
+        default=1,
+        type=int,
+        help="Number of spaces to unbind concurrently (default: 1)",
+    )
+    unbind_asg_parser.add_argument(
+        "-r",
+        "--rate-limit",
+        dest="rate_limit",
+        default=0,
+        type=float,
+        help="Maximum unbind requests per second, 0 for no limit (default: 0)",
+    )
 
     return parser.parse_args()
 
@@ -50,11 +74,13 @@ def main():
             pprint.pprint(spaces)
             return
         if args.command == "bind-asg":
-            results = bind_asg(args.asg_name)
+            results = bind_asg(args.asg_name, batch_size=args.batch_size)
             print(results)
             return
         if args.command == "unbind-asg":
-            results = unbind_asg(args.asg_name)
+            results = unbind_asg(
+                args.asg_name, workers=args.workers, rate_limit=args.rate_limit
+            )
             print(results)
             return
         else:
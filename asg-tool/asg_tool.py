@@ -1,7 +1,31 @@
-import json
-import subprocess
-from typing import Optional
-from urllib.parse import urlparse
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Iterator, Optional
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+import cf_api
+
+
+class RateLimiter:
+    def __init__(self, requests_per_second: float = 0):
+        self.interval = 1 / requests_per_second if requests_per_second > 0 else 0
+        self.next_slot = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self) -> None:
+        if not self.interval:
+            return
+
+        with self.lock:
+            now = time.monotonic()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + self.interval
+
+        if slot > now:
+            time.sleep(slot - now)
 
 
 def filter_resource_item(item: dict) -> Optional[dict]:
@@ -30,54 +54,14 @@ def filter_resources(resources: list) -> list:
     return filtered
 
 
-def cf_curl_results_handler(output: object) -> dict:
-    results = {}
-
-    # Try to load output as JSON.
-    try:
-        results = json.loads(output.stdout)
-    except:
-        results = {}
-
-    if hasattr(results, "__iter__") and "errors" in results:
-        raise Exception(results)
-
-    return results
-
-
-def cf_curl_get(
-    api_path: str,
-    acc_resources: list = [],
-    iteration: int = 0,
-) -> list:
-    if iteration == 100:
-        return acc_resources
-
-    command = ["cf", "curl", api_path]
-    output = subprocess.run(command, capture_output=True, check=True, encoding="utf-8")
-
-    results = cf_curl_results_handler(output)
-    pagination = results["pagination"]
-    next_page = pagination["next"]
-    resources = results["resources"]
-    joined_resources = acc_resources + resources
-
-    if next_page:
-        parsed_api = urlparse(next_page["href"])
-        next_path = f"{parsed_api.path}?{parsed_api.query}"
-        return cf_curl_get(
-            next_path, acc_resources=joined_resources, iteration=iteration + 1
-        )
-    else:
-        return joined_resources
+def cf_curl_get(api_path: str) -> Iterator[dict]:
+    return cf_api.get_client().paginate_concurrently(api_path)
 
 
 def cf_curl_delete(
     api_path: str,
-) -> list:
-    command = ["cf", "curl", api_path, "-X", "DELETE"]
-    output = subprocess.run(command, capture_output=True, check=True, encoding="utf-8")
-    results = cf_curl_results_handler(output)
+) -> dict:
+    results = cf_api.get_client().delete(api_path)
     return results
 
 
@@ -85,15 +69,12 @@ def cf_curl_post(
     api_path: str,
     data: dict,
 ) -> list:
-    formatted = json.dumps(data)
-    command = ["cf", "curl", api_path, "-X", "POST", "-d", formatted]
-    output = subprocess.run(command, capture_output=True, check=True, encoding="utf-8")
-    results = cf_curl_results_handler(output)
+    results = cf_api.get_client().post(api_path, data)
     return results["data"]
 
 
 def get_spaces() -> list:
-    resources = cf_curl_get("/v3/spaces?per_page=100")
+    resources = cf_curl_get("/v3/spaces?per_page=5000")
     filtered = filter_resources(resources)
 
     return filtered
@@ -111,10 +92,25 @@ def get_asg_guid(asg_name: str) -> Optional[str]:
     return guid
 
 
-def get_running_space_asgs(space_guid: str) -> list:
-    resources = cf_curl_get(f"/v3/security_groups?running_space_guids={space_guid}")
+def get_security_groups() -> list:
+    resources = cf_curl_get("/v3/security_groups?per_page=5000")
+
+    return list(resources)
+
+
+def index_space_asgs(security_groups: list, lifecycle: str) -> dict:
+    space_asgs = {}
+
+    for asg in security_groups:
+        filtered_asg = filter_resource_item(asg)
+
+        if filtered_asg is None:
+            continue
+
+        for space in asg["relationships"][lifecycle]["data"]:
+            space_asgs.setdefault(space["guid"], []).append(filtered_asg)
 
-    return resources
+    return space_asgs
 
 
 def setup_asg_action(asg_name: str) -> tuple:
@@ -132,26 +128,66 @@ def setup_asg_action(asg_name: str) -> tuple:
     return (asg_guid, spaces)
 
 
-def bind_asg(asg_name: str) -> str:
+def chunk_spaces(spaces: list, size: int) -> Iterator[list]:
+    size = max(size, 1)
+    for index in range(0, len(spaces), size):
+        yield spaces[index : index + size]
+
+
+def format_space(space: dict) -> str:
+    return f'NAME: {space["name"]} - GUID: {space["guid"]}'
+
+
+def action_report(action: str, asg_name: str, spaces: list, failures: list) -> str:
+    succeeded = len(spaces) - len(failures)
+    lines = [f"Finished: {action} {asg_name} for {succeeded} of {len(spaces)} spaces"]
+
+    if failures:
+        lines.append(f"Failed for {len(failures)} spaces:")
+        for space, err in failures:
+            lines.append(f"  {format_space(space)}")
+            lines.append(f"    {err}")
+
+    return "\n".join(lines)
+
+
+def bind_spaces(asg_guid: str, spaces: list) -> list:
+    data = {"data": [{"guid": space["guid"]} for space in spaces]}
+
+    return cf_curl_post(
+        f"/v3/security_groups/{asg_guid}/relationships/running_spaces",
+        data=data,
+    )
+
+
+def bind_asg(asg_name: str, batch_size: int = 1) -> str:
     asg_guid, spaces = setup_asg_action(asg_name)
+    failures = []
 
     print(f"Start binding security group {asg_name} to all spaces")
-    for space in spaces:
+    for batch in chunk_spaces(spaces, batch_size):
         try:
-            data = {"data": [space]}
-
-            cf_curl_post(
-                f"/v3/security_groups/{asg_guid}/relationships/running_spaces",
-                data=data,
-            )
-            print(f'Bound {asg_name} to NAME: {space["name"]} - GUID: {space["guid"]}')
+            bind_spaces(asg_guid, batch)
+            bound = batch
         except Exception as err:
-            print(
-                f'Unable to bind {asg_name} to NAME: {space["name"]} - GUID: {space["guid"]}'
-            )
-            print(str(err))
+            if len(batch) == 1:
+                failures.append((batch[0], str(err)))
+                continue
+
+            # A single bad space fails the whole batch, so retry the batch one
+            # space at a time to find out which spaces could not be bound.
+            bound = []
+            for space in batch:
+                try:
+                    bind_spaces(asg_guid, [space])
+                    bound.append(space)
+                except Exception as err:
+                    failures.append((space, str(err)))
+
+        for space in bound:
+            print(f"Bound {asg_name} to {format_space(space)}")
 
-    return "Finished"
+    return action_report("bound", asg_name, spaces, failures)
 
 
 def check_spaces() -> list:
@@ -159,14 +195,19 @@ def check_spaces() -> list:
     results = []
     spaces = get_spaces()
 
+    # List every security group once and invert its space relationships into
+    # space -> ASG lookups, rather than asking the API about each space.
+    security_groups = get_security_groups()
+    running_asgs = index_space_asgs(security_groups, "running_spaces")
+    staging_asgs = index_space_asgs(security_groups, "staging_spaces")
+
     for space in spaces:
         space_guid = space["guid"]
-        asg_resources = get_running_space_asgs(space_guid)
-        filtered = filter_resources(asg_resources)
         updated_space = {
             "name": space["name"],
             "guid": space["guid"],
-            "security_groups": filtered,
+            "security_groups": running_asgs.get(space_guid, []),
+            "staging_security_groups": staging_asgs.get(space_guid, []),
         }
 
         results.append(updated_space)
@@ -174,23 +215,33 @@ def check_spaces() -> list:
     return results
 
 
-def unbind_asg(asg_name: str) -> str:
+def unbind_space(asg_guid: str, space: dict, rate_limiter: RateLimiter) -> dict:
+    rate_limiter.wait()
+    space_guid = space["guid"]
+
+    return cf_curl_delete(
+        f"/v3/security_groups/{asg_guid}/relationships/running_spaces/{space_guid}"
+    )
+
+
+def unbind_asg(asg_name: str, workers: int = 1, rate_limit: float = 0) -> str:
     asg_guid, spaces = setup_asg_action(asg_name)
+    rate_limiter = RateLimiter(rate_limit)
+    failures = []
 
     print(f"Start unbinding security group {asg_name} from all spaces")
-    for space in spaces:
-        try:
-            space_guid = space["guid"]
-            cf_curl_delete(
-                f"/v3/security_groups/{asg_guid}/relationships/running_spaces/{space_guid}"
-            )
-            print(
-                f'Unbound {asg_name} for NAME: {space["name"]} - GUID: {space["guid"]}'
-            )
-        except Exception as err:
-            print(
-                f'Unable to unbind {asg_name} for NAME: {space["name"]} - GUID: {space["guid"]}'
-            )
-            print(str(err))
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        futures = {
+            executor.submit(unbind_space, asg_guid, space, rate_limiter): space
+            for space in spaces
+        }
+
+        for future in as_completed(futures):
+            space = futures[future]
+            try:
+                future.result()
+                print(f"Unbound {asg_name} for {format_space(space)}")
+            except Exception as err:
+                failures.append((space, str(err)))
 
-    return "Finished"
+    return action_report("unbound", asg_name, spaces, failures)
@@ -1,7 +1,9 @@
 import unittest
 from unittest.mock import patch
 import json
+import requests
 import asg_tool
+import cf_api
 
 
 def result_resource(
@@ -48,10 +50,21 @@ def results_from_cf(
     return {"pagination": pagination, "resources": resources}
 
 
-class SubprocessResult:
-    def __init__(self, stdout={}, stderr={}):
-        self.stdout = json.dumps(stdout)
-        self.stderr = json.dumps(stderr)
+def api_response(body=None, status_code=200) -> requests.Response:
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = json.dumps(body).encode("utf-8") if body is not None else b""
+    return response
+
+
+class CFAPITestCase(unittest.TestCase):
+    def setUp(self):
+        client = cf_api.CFClient(
+            api_url="https://api.example.gov", token="bearer test", verify=True
+        )
+        patcher = patch("cf_api.get_client", return_value=client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
 
 
 def create_resource(guid, name):
@@ -68,33 +81,13 @@ def return_cf_request(
     if not resources:
         resources = list(resource for i in range(0, number_or_resources))
 
-    stdout = results_from_cf(pagination=pagination, resources=resources)
-    output = SubprocessResult(stdout=stdout)
-
-    return output
-
+    body = results_from_cf(pagination=pagination, resources=resources)
 
-class TestCFCurlResultsHandler(unittest.TestCase):
-    def test_returns_successfull_output(self):
-        stdout = {"test": "Hello World"}
-        output = SubprocessResult(stdout=stdout)
-        results = asg_tool.cf_curl_results_handler(output)
-        self.assertEqual(results, stdout)
+    return api_response(body)
 
-    def test_raises_exception(self):
-        stdout = {"errors": {"message": "error"}}
-        with self.assertRaises(Exception):
-            output = SubprocessResult(stdout=stdout)
-            asg_tool.cf_curl_results_handler(output)
 
-    def test_returns_empty_object_if_no_stdout(self):
-        output = {"stdout": "not json"}
-        results = asg_tool.cf_curl_results_handler(output)
-        self.assertEqual(results, {})
-
-
-class TestASGGetSpaces(unittest.TestCase):
-    @patch("subprocess.run")
+class TestASGGetSpaces(CFAPITestCase):
+    @patch("requests.Session.request")
     def test_paginate_response_one_page(self, mock_call):
         expected_keys = ["guid", "name"]
         mock_call.return_value = return_cf_request(
@@ -105,21 +98,38 @@ class TestASGGetSpaces(unittest.TestCase):
         self.assertEqual(list(result[0].keys()), expected_keys)
         self.assertEqual(len(result), 10)
 
-    @patch("subprocess.run")
-    def test_paginate_max_100_calls(self, mock_call):
+    @patch("requests.Session.request")
+    def test_paginate_does_not_truncate(self, mock_call):
         pagination = result_pagination(
-            next={"href": "http://example.gov/items?per_page=10"}
+            total_pages=150, next={"href": "http://example.gov/items?page=2"}
         )
         mock_call.return_value = return_cf_request(
             resource=create_resource("a-guid-id", "a-name"), pagination=pagination
         )
         result = asg_tool.get_spaces()
         self.assertIsInstance(result, list)
-        self.assertEqual(len(result), 100)
+        self.assertEqual(len(result), 150)
+        self.assertEqual(mock_call.call_count, 150)
+        requested_pages = sorted(
+            kwargs["params"].get("page", 1) for _, kwargs in mock_call.call_args_list
+        )
+        self.assertEqual(requested_pages, list(range(1, 151)))
+
+    @patch("requests.Session.request")
+    def test_paginate_follows_next_without_total_pages(self, mock_call):
+        pagination_1 = result_pagination(
+            next={"href": "http://example.gov/items?page=2"}
+        )
+        mock_call.side_effect = [
+            return_cf_request(pagination=pagination_1, number_or_resources=3),
+            return_cf_request(number_or_resources=2),
+        ]
+        result = list(asg_tool.cf_curl_get("/v3/items"))
+        self.assertEqual(len(result), 5)
 
     def test_paginate_response_two_pages(self):
         pagination_1 = result_pagination(
-            next={"href": "http://example.gov/items?per_page=10"}
+            total_pages=2, next={"href": "http://example.gov/items?page=2"}
         )
         mock_call_1 = return_cf_request(
             resource=create_resource("a-guid-id", "a-name"),
@@ -131,14 +141,14 @@ class TestASGGetSpaces(unittest.TestCase):
             number_or_resources=5,
         )
 
-        with patch("subprocess.run", side_effect=[mock_call_1, mock_call_2]):
+        with patch("requests.Session.request", side_effect=[mock_call_1, mock_call_2]):
             expected_keys = ["guid", "name"]
             result = asg_tool.get_spaces()
             self.assertIsInstance(result, list)
             self.assertEqual(list(result[0].keys()), expected_keys)
             self.assertEqual(len(result), 15)
 
-    @patch("subprocess.run")
+    @patch("requests.Session.request")
     def test_remove_invalid_resources_from_list(self, mock_call):
         expected_keys = ["guid", "name"]
         valid_resources = list(
@@ -154,47 +164,82 @@ class TestASGGetSpaces(unittest.TestCase):
         self.assertEqual(len(result), 10)
 
 
-class TestCFCurlDelete(unittest.TestCase):
-    @patch("subprocess.run")
+class TestCFCurlDelete(CFAPITestCase):
+    @patch("requests.Session.request")
     def test_successful_delete(self, mock_call):
-        mock_call.return_value = SubprocessResult()
+        mock_call.return_value = api_response(status_code=204)
         result = asg_tool.cf_curl_delete("/v3/test/1")
         self.assertEqual(result, {})
 
+    @patch("requests.Session.request")
+    def test_raises_api_errors(self, mock_call):
+        body = {"errors": [{"title": "CF-ResourceNotFound", "detail": "missing"}]}
+        mock_call.return_value = api_response(body, status_code=404)
+        with self.assertRaises(cf_api.CFAPIError):
+            asg_tool.cf_curl_delete("/v3/test/1")
+
 
-class TestCFCurlPost(unittest.TestCase):
-    @patch("subprocess.run")
+class TestCFCurlPost(CFAPITestCase):
+    @patch("requests.Session.request")
     def test_successful_post(self, mock_call):
         data = {"test": "data"}
         stdout = {"data": {"message": "Success"}}
-        mock_call.return_value = SubprocessResult(stdout=stdout)
+        mock_call.return_value = api_response(stdout)
         result = asg_tool.cf_curl_post("/v3/test/1", data)
         self.assertEqual(result, stdout["data"])
 
 
-class TestCheckSpaceASG(unittest.TestCase):
+def create_asg(guid, name, running_space_guids=None, staging_space_guids=None):
+    running_space_guids = running_space_guids if running_space_guids is not None else []
+    staging_space_guids = staging_space_guids if staging_space_guids is not None else []
+    relationships = {
+        "running_spaces": {"data": list({"guid": g} for g in running_space_guids)},
+        "staging_spaces": {"data": list({"guid": g} for g in staging_space_guids)},
+    }
+    return result_resource(guid=guid, name=name, relationships=relationships)
+
+
+class TestCheckSpaceASG(CFAPITestCase):
     def test_curl_space_asg(self):
         number_of_asgs = 10
         mock_call_spaces = return_cf_request(
-            resource=create_resource("a-space-guid-id", "a-space-name")
+            resources=[
+                create_resource("a-space-guid-id", "a-space-name"),
+                create_resource("other-space-guid-id", "other-space-name"),
+            ]
+        )
+        asgs = list(
+            create_asg(f"a-asg-guid-id-{i}", f"a-asg-name-{i}", ["a-space-guid-id"])
+            for i in range(0, number_of_asgs)
         )
-        mock_call_space_asgs = return_cf_request(
-            resource=create_resource("a-asg-guid-id", "a-asg-name"),
-            number_or_resources=number_of_asgs,
+        asgs.append(
+            create_asg(
+                "staging-asg-guid-id",
+                "staging-asg-name",
+                staging_space_guids=["a-space-guid-id", "other-space-guid-id"],
+            )
         )
+        mock_call_asgs = return_cf_request(resources=asgs)
 
         with patch(
-            "subprocess.run", side_effect=[mock_call_spaces, mock_call_space_asgs]
-        ):
+            "requests.Session.request", side_effect=[mock_call_spaces, mock_call_asgs]
+        ) as mock_call:
             result = asg_tool.check_spaces()
+            self.assertEqual(mock_call.call_count, 2)
             self.assertIsInstance(result, list)
-            self.assertEqual(len(result), 1)
-            first_result = result[0]
+            self.assertEqual(len(result), 2)
+            first_result, second_result = result
             self.assertEqual(len(first_result["security_groups"]), number_of_asgs)
+            self.assertEqual(
+                first_result["staging_security_groups"],
+                [{"guid": "staging-asg-guid-id", "name": "staging-asg-name"}],
+            )
+            self.assertEqual(second_result["security_groups"], [])
+            self.assertEqual(len(second_result["staging_security_groups"]), 1)
 
 
-class TestGetSpaceASG(unittest.TestCase):
-    @patch("subprocess.run")
+class TestGetSpaceASG(CFAPITestCase):
+    @patch("requests.Session.request")
     def test_gets_asg_guid(self, mock_call):
         asg_name = "asg-name"
         asg_guid = "asg-guid-id"
@@ -205,7 +250,7 @@ class TestGetSpaceASG(unittest.TestCase):
         self.assertIsInstance(result, str)
         self.assertEqual(result, asg_guid)
 
-    @patch("subprocess.run")
+    @patch("requests.Session.request")
     def test_gets_none_when_asg_name_not_found(self, mock_call):
         asg_name = "asg-name"
         other_asg_name = "other-asg-name"
@@ -217,5 +262,75 @@ class TestGetSpaceASG(unittest.TestCase):
         self.assertEqual(result, None)
 
 
+def create_spaces(count: int) -> list:
+    return list({"guid": f"space-guid-{i}", "name": f"space-{i}"} for i in range(count))
+
+
+class TestBindASG(CFAPITestCase):
+    @patch("asg_tool.cf_curl_post")
+    @patch("asg_tool.setup_asg_action")
+    def test_binds_spaces_in_batches(self, mock_setup, mock_post):
+        spaces = create_spaces(5)
+        mock_setup.return_value = ("asg-guid-id", spaces)
+        result = asg_tool.bind_asg("asg-name", batch_size=2)
+        self.assertEqual(mock_post.call_count, 3)
+        first_batch = mock_post.call_args_list[0].kwargs["data"]["data"]
+        self.assertEqual(first_batch, [{"guid": "space-guid-0"}, {"guid": "space-guid-1"}])
+        self.assertIn("for 5 of 5 spaces", result)
+
+    @patch("asg_tool.cf_curl_post")
+    @patch("asg_tool.setup_asg_action")
+    def test_isolates_failed_spaces_in_batch(self, mock_setup, mock_post):
+        spaces = create_spaces(3)
+        mock_setup.return_value = ("asg-guid-id", spaces)
+
+        def post(api_path, data):
+            if {"guid": "space-guid-1"} in data["data"]:
+                raise Exception("bind failed")
+            return data["data"]
+
+        mock_post.side_effect = post
+        result = asg_tool.bind_asg("asg-name", batch_size=3)
+        self.assertIn("for 2 of 3 spaces", result)
+        self.assertIn("NAME: space-1 - GUID: space-guid-1", result)
+        self.assertNotIn("GUID: space-guid-0", result)
+
+
+class TestUnbindASG(CFAPITestCase):
+    @patch("asg_tool.cf_curl_delete")
+    @patch("asg_tool.setup_asg_action")
+    def test_collects_failures_into_report(self, mock_setup, mock_delete):
+        spaces = create_spaces(10)
+        mock_setup.return_value = ("asg-guid-id", spaces)
+
+        def delete(api_path):
+            if api_path.endswith("/space-guid-4"):
+                raise Exception("unbind failed")
+            return {}
+
+        mock_delete.side_effect = delete
+        result = asg_tool.unbind_asg("asg-name", workers=4)
+        self.assertEqual(mock_delete.call_count, 10)
+        self.assertIn("for 9 of 10 spaces", result)
+        self.assertIn("NAME: space-4 - GUID: space-guid-4", result)
+        self.assertIn("unbind failed", result)
+
+
+class TestRateLimiter(unittest.TestCase):
+    @patch("time.sleep")
+    def test_spaces_out_calls(self, mock_sleep):
+        rate_limiter = asg_tool.RateLimiter(requests_per_second=10)
+        for i in range(3):
+            rate_limiter.wait()
+        self.assertEqual(mock_sleep.call_count, 2)
+
+    @patch("time.sleep")
+    def test_no_limit(self, mock_sleep):
+        rate_limiter = asg_tool.RateLimiter()
+        for i in range(3):
+            rate_limiter.wait()
+        mock_sleep.assert_not_called()
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -3,9 +3,10 @@
 import os
 import boto3
 import datetime
-import functools
-import json
-import subprocess
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+from cf_names import get_cf_entity_name
 
 rds_client = boto3.client("rds")
 cloudwatch_client = boto3.client("cloudwatch")
@@ -13,22 +14,6 @@ cloudwatch_client = boto3.client("cloudwatch")
 PROD_DATABASE_PREFIX = "cg-aws-broker-prod"
 
 
-@functools.cache
-def get_cf_entity_name(entity, guid):
-    """
-    Retrieves the name of a CF entity from a GUID.
-    """
-    if not guid:
-        return
-    cf_json = subprocess.check_output(
-        "cf curl /v3/" + entity + "/" + guid,
-        universal_newlines=True,
-        shell=True,
-    )
-    cf_data = json.loads(cf_json)
-    return cf_data.get("name", "N/A")
-
-
 def print_all_db_instances_csv_lines():
     rds_response = rds_client.describe_db_instances()
     print_db_instances_csv_lines(rds_response["DBInstances"])
@@ -1,9 +1,24 @@
 #!/usr/bin/env python3
 
 import argparse
-import functools
-import json
-import subprocess
+import csv
+import itertools
+import os
+import sys
+from collections import Counter
+
+import boto3
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+import aws_pricing
+from cf_names import (
+    SERVICE_INSTANCE_PLANS,
+    get_cf_entity_name,
+    get_service_plan_name,
+    prefetch_cf_entity_names,
+)
+from json_stream import iter_json_array
+from pipeline import read_ahead
 
 
 # Prefix for all production Elasticsearch domains.
@@ -556,12 +571,98 @@ RDS_PRICING_INFO = {
     }
 }
 
+# Number of records handled together when reading a JSON file, so their CF
+# names can be resolved in bulk.
+PAGE_SIZE = 500
+
+# Most domains describe_elasticsearch_domains accepts in one call.
+ES_DESCRIBE_BATCH_SIZE = 5
+
+# Top-level key holding the records in the JSON output for each AWS service.
+JSON_KEYS = {
+    "es": "DomainStatusList",
+    "rds": "DBInstances",
+    "redis": "CacheClusters",
+    "aws-resource-tags": "aws_resource_tags",
+}
+
+# CF entity types referenced by the GUID tags on brokered AWS resources.
+TAG_ENTITIES = {
+    "Instance GUID": "service_instances",
+    "Organization GUID": "organizations",
+    "Space GUID": "spaces",
+}
+
 REDIS_PRICING_INFO = {
     "cache.t2.micro": 0.019,
     "cache.t3.micro": 0.02,
     "cache.t3.small": 0.04,
 }
 
+# Flattened RDS pricing, so a page of instances is priced with one dictionary
+# lookup per instance:  (engine, instance class, multi AZ) -> price per hour
+# and (engine, multi AZ) -> storage price per GB/month.
+RDS_INSTANCE_CLASS_PRICES = {
+    (engine, instance_class, multi_az): prices["multi_az" if multi_az else "single"]
+    for engine, engine_pricing in RDS_PRICING_INFO.items()
+    for instance_class, prices in engine_pricing["instance_classes"].items()
+    for multi_az in (True, False)
+}
+
+RDS_STORAGE_PRICES = {
+    (engine, multi_az): engine_pricing["storage"]["multi_az" if multi_az else "single"]
+    for engine, engine_pricing in RDS_PRICING_INFO.items()
+    for multi_az in (True, False)
+}
+
+
+class CostSummary:
+    """
+    Rolls up monthly estimates by arbitrary groupings, e.g. per organization,
+    plan and engine, while the analyzers work through their pages.
+    """
+
+    def __init__(self):
+        self.counts = Counter()
+        self.totals = Counter()
+
+    def add_many(self, estimates, **group_columns):
+        """
+        Adds a column of estimates, grouped by each of the given columns, e.g.
+        add_many(estimates, engine=engines, organization=org_names).
+        """
+
+        for group_by, groups in group_columns.items():
+            for group, estimate in zip(groups, estimates):
+                self.counts[(group_by, group)] += 1
+                self.totals[(group_by, group)] += estimate
+
+        self.counts[("total", "all")] += len(estimates)
+        self.totals[("total", "all")] += sum(estimates)
+
+    def write(self, path):
+        """
+        Writes the rollups to a CSV file, largest totals first within each
+        grouping, followed by the overall total.
+        """
+
+        rows = sorted(
+            (key for key in self.totals if key[0] != "total"),
+            key=lambda key: (key[0], -self.totals[key], str(key[1]))
+        )
+
+        with open(path, "w", newline="") as summary_file:
+            writer = csv.writer(summary_file)
+            writer.writerow(["Group By", "Group", "Count", "Total Monthly Estimate"])
+
+            for key in rows + [("total", "all")]:
+                writer.writerow([
+                    key[0],
+                    key[1],
+                    self.counts[key],
+                    "{:.2f}".format(self.totals[key])
+                ])
+
 
 def parse_args():
     """
@@ -579,35 +680,165 @@ def parse_args():
     )
     parser.add_argument(
         "json_file",
-        help="The JSON output to process"
+        nargs="?",
+        help="The JSON output to process; it is read incrementally and may be gzip-compressed"
+    )
+    parser.add_argument(
+        "--live",
+        action="store_true",
+        default=False,
+        help="Page through the AWS APIs directly instead of reading a JSON file"
     )
     parser.add_argument(
         "--limit",
         default=0,
         help="Limits the amount of records processed to LIMIT"
     )
-    return parser.parse_args()
+    parser.add_argument(
+        "--price-list",
+        action="append",
+        default=[],
+        metavar="OFFER_FILE",
+        help="AWS Price List offer file (JSON or CSV, may be gzip-compressed) to take GovCloud prices from instead of the built-in ones; can be given once per service"
+    )
+    parser.add_argument(
+        "--summary-file",
+        help="Also write monthly estimate rollups (per organization, plan, engine and instance class) to this CSV file"
+    )
+    args = parser.parse_args()
+
+    if args.live == bool(args.json_file):
+        parser.error("provide either a JSON file or --live")
+
+    if args.summary_file and args.aws_service == "aws-resource-tags":
+        parser.error("--summary-file is only available for es, rds and redis")
 
+    return args
 
-@functools.cache
-def get_cf_entity_name(entity, guid):
+
+def apply_price_lists(offer_files):
     """
-    Retrieves the name of a CF entity from a GUID.
+    Replaces the built-in prices with the ones in AWS Price List offer files.
+    Anything the offer files do not price keeps its built-in value.
     """
 
-    cf_json = subprocess.check_output(
-        ["cf", "curl", "/v3/" + entity + "/" + guid],
-        universal_newlines=True
-    )
-    cf_data = json.loads(cf_json)
+    prices = aws_pricing.load_prices(offer_files)
+
+    for key, price in prices.items():
+        service, kind = key[:2]
+
+        if service == "rds" and kind == "instance":
+            RDS_INSTANCE_CLASS_PRICES[key[2:]] = price
+        elif service == "rds" and kind == "storage":
+            RDS_STORAGE_PRICES[key[2:]] = price
+        elif service == "es" and kind == "instance":
+            ES_PRICING_INFO["instance_classes"][key[2]] = price
+        elif service == "es" and kind == "storage":
+            ES_PRICING_INFO["storage"][key[2]] = price
+        elif service == "redis" and kind == "instance":
+            REDIS_PRICING_INFO[key[2]] = price
+
+
+def json_file_pages(json_file, key):
+    """
+    Streams the items under key from a JSON file in pages of PAGE_SIZE.
+    """
+
+    items = iter_json_array(json_file, key)
+
+    while True:
+        page = list(itertools.islice(items, PAGE_SIZE))
+        if not page:
+            return
+        yield page
+
 
-    return cf_data.get("name", "N/A")
+def live_es_pages():
+    """
+    Pages through the Elasticsearch domains of the account, describing them
+    in batches of the most domains the API accepts at once.
+    """
+
+    es_client = boto3.client("es")
+    domain_names = [
+        domain["DomainName"] for domain in es_client.list_domain_names()["DomainNames"]
+    ]
+
+    for start in range(0, len(domain_names), ES_DESCRIBE_BATCH_SIZE):
+        response = es_client.describe_elasticsearch_domains(
+            DomainNames=domain_names[start:start + ES_DESCRIBE_BATCH_SIZE]
+        )
+        yield response["DomainStatusList"]
 
 
-def parse_aws_resource_tags(json_file, limit):
+def live_rds_pages():
     """
-    Processes tags for a AWS resources and retrieves their associated Cloud
-    Foundry values.
+    Pages through the RDS instances of the account.
+    """
+
+    paginator = boto3.client("rds").get_paginator("describe_db_instances")
+
+    for page in paginator.paginate():
+        yield page["DBInstances"]
+
+
+def live_redis_pages():
+    """
+    Pages through the ElastiCache clusters of the account.
+    """
+
+    paginator = boto3.client("elasticache").get_paginator("describe_cache_clusters")
+
+    for page in paginator.paginate():
+        yield page["CacheClusters"]
+
+
+def live_aws_resource_tags_pages():
+    """
+    Pages through every AWS resource tagged with a CF service instance GUID,
+    in the same shape as the aws_resource_tags JSON input.
+    """
+
+    paginator = boto3.client("resourcegroupstaggingapi").get_paginator("get_resources")
+
+    for page in paginator.paginate(TagFilters=[{ "Key": "Instance GUID" }]):
+        yield [
+            { "arn": resource["ResourceARN"], "TagList": resource["Tags"] }
+            for resource in page["ResourceTagMappingList"]
+        ]
+
+
+def get_tags(resource):
+    """
+    Returns the tags of an AWS resource as a dictionary.
+    """
+
+    return { tag.get("Key"): tag.get("Value") for tag in resource["TagList"] }
+
+
+def prefetch_tag_entity_names(tag_dicts, tag_entities):
+    """
+    Collects every distinct CF GUID found under the given (tag key, CF entity
+    type) pairs and resolves their names up front with a few bulk CF API calls,
+    rather than one call per GUID while printing each row.
+    """
+
+    tag_entities = list(tag_entities)
+    guids = {tag_entity: set() for tag_entity in tag_entities}
+
+    for tags in tag_dicts:
+        for tag_key, entity in tag_entities:
+            if tags.get(tag_key):
+                guids[(tag_key, entity)].add(tags[tag_key])
+
+    for (tag_key, entity), entity_guids in guids.items():
+        prefetch_cf_entity_names(entity, entity_guids)
+
+
+def parse_aws_resource_tags(pages, limit):
+    """
+    Processes pages of tags for AWS resources and retrieves their associated
+    Cloud Foundry values.
     """
 
     def parse_aws_resource_name(aws_resource_arn):
@@ -622,222 +853,291 @@ def parse_aws_resource_tags(json_file, limit):
         return name_part
 
     count = 0
-    tag_data = json.load(open(json_file))
 
     print("AWS Resource Name,Instance GUID,Space GUID,Organization GUID,Instance Name,Space Name,Organization Name")
 
-    for resource in tag_data["aws_resource_tags"]:
-        # Retrieve all of the tags associated with the resource.
-        tags = { tag.get("Key"): tag.get("Value") for tag in resource["TagList"] }
-
-        # If we set a processing limit and we haven't skipped, check to see if
-        # we should stop.
-        if limit > 0 and count >= limit:
-            break
-
-        # Check if the instance has the appropriate CF metadata associated with
-        # it and if not, default to N/A values.
-        if "Instance GUID" in tags:
-            instance_guid = tags["Instance GUID"]
-            instance_name = get_cf_entity_name(
-                "service_instances",
-                tags["Instance GUID"]
-            )
-        else:
-            instance_guid = "N/A"
-            instance_name = "N/A"
-
-        if "Organization GUID" in tags:
-            org_guid = tags["Organization GUID"]
-            org_name = get_cf_entity_name(
-                "organizations",
-                tags["Organization GUID"]
+    for resources in pages:
+        # Resolve the CF names for the whole page with a few bulk calls.
+        prefetch_tag_entity_names(map(get_tags, resources), TAG_ENTITIES.items())
+
+        for resource in resources:
+            # Retrieve all of the tags associated with the resource.
+            tags = get_tags(resource)
+
+            # If we set a processing limit and we haven't skipped, check to see if
+            # we should stop.
+            if limit > 0 and count >= limit:
+                return
+
+            # Check if the instance has the appropriate CF metadata associated with
+            # it and if not, default to N/A values.
+            if "Instance GUID" in tags:
+                instance_guid = tags["Instance GUID"]
+                instance_name = get_cf_entity_name(
+                    "service_instances",
+                    tags["Instance GUID"]
+                )
+            else:
+                instance_guid = "N/A"
+                instance_name = "N/A"
+
+            if "Organization GUID" in tags:
+                org_guid = tags["Organization GUID"]
+                org_name = get_cf_entity_name(
+                    "organizations",
+                    tags["Organization GUID"]
+                )
+            else:
+                org_guid = "N/A"
+                org_name = "N/A"
+
+            if "Space GUID" in tags:
+                space_guid = tags["Space GUID"]
+                space_name = get_cf_entity_name(
+                    "spaces",
+                    tags["Space GUID"]
+                )
+            else:
+                space_guid = "N/A"
+                space_name = "N/A"
+
+            output = "{aws_resource_name},{instance_guid},{space_guid},{org_guid},{instance_name},{space_name},{org_name}".format(
+                aws_resource_name=parse_aws_resource_name(resource["arn"]),
+                instance_guid=instance_guid,
+                space_guid=space_guid,
+                org_guid=org_guid,
+                instance_name=instance_name,
+                space_name=space_name,
+                org_name=org_name
             )
-        else:
-            org_guid = "N/A"
-            org_name = "N/A"
-
-        if "Space GUID" in tags:
-            space_guid = tags["Space GUID"]
-            space_name = get_cf_entity_name(
-                "spaces",
-                tags["Space GUID"]
-            )
-        else:
-            space_guid = "N/A"
-            space_name = "N/A"
-
-        output = "{aws_resource_name},{instance_guid},{space_guid},{org_guid},{instance_name},{space_name},{org_name}".format(
-            aws_resource_name=parse_aws_resource_name(resource["arn"]),
-            instance_guid=instance_guid,
-            space_guid=space_guid,
-            org_guid=org_guid,
-            instance_name=instance_name,
-            space_name=space_name,
-            org_name=org_name
-        )
 
-        print(output)
-        count += 1
+            print(output)
+            count += 1
 
 
-def analyze_es(json_file, limit):
+def analyze_es(pages, limit, summary=None):
     """
-    Analyzes a JSON file containing AWS Elasticsearch domain information.
+    Analyzes pages of AWS Elasticsearch domain information.  Each page is
+    loaded into columns and priced in one batch.
     """
 
-    def calculate_monthly_cost(num_data_instances, data_instance_class_price, num_master_instances, master_instance_class_price, storage_size, storage_price):
+    def calculate_monthly_costs(num_data_instances, data_instance_class_prices, num_master_instances, master_instance_class_prices, storage_sizes, storage_price):
         """
-        Calculates the monthly cost of an Elasticsearch domain.  Note that this
-        is a rough estimate based on AWS' pricing formula for Elasticsearch:
+        Calculates the monthly costs of a batch of Elasticsearch domains, given
+        one column per input.  Note that this is a rough estimate based on AWS'
+        pricing formula for Elasticsearch:
 
         (num_data_instances * data_instance_class_price * HOURS_PER_MONTH) +
         (num_master_instances * master_instance_class_price * HOURS_PER_MONTH) +
         (storage_size * storage_price * num_data_instances)
 
-        Returns the value formatted as a string, rounded to 2 decimal places.
+        Returns a column with the estimate for each domain.
         """
 
-        estimate = (int(num_data_instances) * data_instance_class_price * HOURS_PER_MONTH) + (int(num_master_instances) * master_instance_class_price * HOURS_PER_MONTH) + (int(storage_size) * storage_price * int(num_data_instances))
-        return "{estimate:.2f}".format(estimate=estimate)
+        return [
+            (num_data * data_price * HOURS_PER_MONTH) + (num_master * master_price * HOURS_PER_MONTH) + (storage_size * storage_price * num_data)
+            for num_data, data_price, num_master, master_price, storage_size in zip(
+                num_data_instances,
+                data_instance_class_prices,
+                num_master_instances,
+                master_instance_class_prices,
+                storage_sizes
+            )
+        ]
 
     count = 0
-    es_domain_data = json.load(open(json_file))
+    storage_price = ES_PRICING_INFO["storage"]["gp2"]
 
     print("Domain Name,Data Instance Class,Num Data Instances,Data Instance Class Price Per Hour,Master Instance Class,Num Master Instances,Master Instance Class Price per Hour,Data Storage Size,Storage Type,Storage Price per GB/Month,Total Monthly Estimate")
 
-    for es_domain in es_domain_data["DomainStatusList"]:
-        # If we set a processing limit and we haven't skipped, check to see if
-        # we should stop.
-        if limit > 0 and count >= limit:
-            break
-
-        # Check for the presence of master instances.
-        if es_domain["ElasticsearchClusterConfig"]["DedicatedMasterEnabled"]:
-            master_instance_class=es_domain["ElasticsearchClusterConfig"]["DedicatedMasterType"]
-            num_master_instances=es_domain["ElasticsearchClusterConfig"]["DedicatedMasterCount"]
-            master_instance_class_price = ES_PRICING_INFO["instance_classes"][master_instance_class]
-        else:
-            master_instance_class = "N/A"
-            num_master_instances = 0
-            master_instance_class_price = 0
-
-        output = "{domain_name},{data_instance_class},{num_data_instances},{data_instance_class_price},{master_instance_class},{num_master_instances},{master_instance_class_price},{data_storage_size},{storage_type},{storage_price},{total_monthly_estimate}".format(
-            domain_name=es_domain["DomainName"],
-            data_instance_class=es_domain["ElasticsearchClusterConfig"]["InstanceType"],
-            num_data_instances=es_domain["ElasticsearchClusterConfig"]["InstanceCount"],
-            data_instance_class_price=ES_PRICING_INFO["instance_classes"][es_domain["ElasticsearchClusterConfig"]["InstanceType"]],
-            master_instance_class=master_instance_class,
-            num_master_instances=num_master_instances,
-            master_instance_class_price=master_instance_class_price,
-            data_storage_size=es_domain["EBSOptions"]["VolumeSize"],
-            storage_type=es_domain["EBSOptions"]["VolumeType"],
-            storage_price=ES_PRICING_INFO["storage"]["gp2"],
-            total_monthly_estimate=calculate_monthly_cost(
-                es_domain["ElasticsearchClusterConfig"]["InstanceCount"],
-                ES_PRICING_INFO["instance_classes"][es_domain["ElasticsearchClusterConfig"]["InstanceType"]],
-                num_master_instances,
-                master_instance_class_price,
-                es_domain["EBSOptions"]["VolumeSize"],
-                ES_PRICING_INFO["storage"]["gp2"],
-            )
+    for es_domains in pages:
+        # If we set a processing limit, only take what is left of it.
+        if limit > 0:
+            es_domains = es_domains[:limit - count]
+
+        cluster_configs = [es_domain["ElasticsearchClusterConfig"] for es_domain in es_domains]
+        data_instance_classes = [config["InstanceType"] for config in cluster_configs]
+        num_data_instances = [int(config["InstanceCount"]) for config in cluster_configs]
+
+        # Domains without dedicated master instances have no master cost.
+        has_masters = [config["DedicatedMasterEnabled"] for config in cluster_configs]
+        master_instance_classes = [
+            config["DedicatedMasterType"] if has_master else "N/A"
+            for config, has_master in zip(cluster_configs, has_masters)
+        ]
+        num_master_instances = [
+            int(config["DedicatedMasterCount"]) if has_master else 0
+            for config, has_master in zip(cluster_configs, has_masters)
+        ]
+
+        data_instance_class_prices = [
+            ES_PRICING_INFO["instance_classes"][instance_class]
+            for instance_class in data_instance_classes
+        ]
+        master_instance_class_prices = [
+            ES_PRICING_INFO["instance_classes"][instance_class] if has_master else 0
+            for instance_class, has_master in zip(master_instance_classes, has_masters)
+        ]
+        storage_sizes = [int(es_domain["EBSOptions"]["VolumeSize"]) for es_domain in es_domains]
+
+        estimates = calculate_monthly_costs(
+            num_data_instances,
+            data_instance_class_prices,
+            num_master_instances,
+            master_instance_class_prices,
+            storage_sizes,
+            storage_price
         )
 
-        print(output)
-        count += 1
+        for index, es_domain in enumerate(es_domains):
+            output = "{domain_name},{data_instance_class},{num_data_instances},{data_instance_class_price},{master_instance_class},{num_master_instances},{master_instance_class_price},{data_storage_size},{storage_type},{storage_price},{total_monthly_estimate:.2f}".format(
+                domain_name=es_domain["DomainName"],
+                data_instance_class=data_instance_classes[index],
+                num_data_instances=num_data_instances[index],
+                data_instance_class_price=data_instance_class_prices[index],
+                master_instance_class=master_instance_classes[index],
+                num_master_instances=num_master_instances[index],
+                master_instance_class_price=master_instance_class_prices[index],
+                data_storage_size=storage_sizes[index],
+                storage_type=es_domain["EBSOptions"]["VolumeType"],
+                storage_price=storage_price,
+                total_monthly_estimate=estimates[index]
+            )
+
+            print(output)
+
+        if summary is not None:
+            summary.add_many(
+                estimates,
+                engine=[es_domain.get("ElasticsearchVersion", "N/A") for es_domain in es_domains],
+                instance_class=data_instance_classes
+            )
+
+        count += len(es_domains)
+        if limit > 0 and count >= limit:
+            return
 
 
-def analyze_rds(json_file, limit):
+def analyze_rds(pages, limit, summary=None):
     """
-    Analyzes a JSON file containing AWS RDS instance information.
+    Analyzes pages of AWS RDS instance information.  Each page is loaded into
+    columns and priced in one batch.
     """
 
-    def calculate_monthly_cost(instance_class_price, storage_price, storage_size):
+    def calculate_monthly_costs(instance_class_prices, storage_prices, storage_sizes):
         """
-        Calculates the monthly cost of an RDS instance.  Note that this is a
-        rough estimate based on AWS' pricing formula for RDS, and the instance
-        class price factors in whether or not an instance is set with MultiAZ:
+        Calculates the monthly costs of a batch of RDS instances, given one
+        column per input.  Note that this is a rough estimate based on AWS'
+        pricing formula for RDS, and the instance class price factors in
+        whether or not an instance is set with MultiAZ:
 
         (instance_class_price * HOURS_PER_MONTH) + (storage_size * storage_price)
 
-        Returns the value formatted as a string, rounded to 2 decimal places.
+        Returns a column with the estimate for each instance.
         """
 
-        estimate = (instance_class_price * HOURS_PER_MONTH) + (storage_size * storage_price)
-        return "{estimate:.2f}".format(estimate=estimate)
+        return [
+            (instance_class_price * HOURS_PER_MONTH) + (storage_size * storage_price)
+            for instance_class_price, storage_price, storage_size in zip(
+                instance_class_prices,
+                storage_prices,
+                storage_sizes
+            )
+        ]
 
     count = 0
-    rds_instance_data = json.load(open(json_file))
 
     print("Instance Class,Engine,MultiAZ,Storage Type,Storage Size,Instance GUID,Space GUID,Organization GUID,Space Name,Organization Name,Instance Class Price per Hour,Storage Price per GB/Month,Total Monthly Estimate")
 
-    for db_instance in rds_instance_data["DBInstances"]:
-        # Retrieve all of the tags associated with the instance.
-        tags = { tag.get("Key"): tag.get("Value") for tag in db_instance["TagList"] }
-
-        # Check if the instance has the appropriate CF metadata associated with
-        # it and if not, skip it.  The remaining instances may not always
-        # represent a customer instance, but it's a close enough estimate for
-        # our purposes.
-        # If we set a processing limit and we haven't skipped, check to see if
-        # we should stop.
-        if "Instance GUID" not in tags:
+    for db_instances in pages:
+        # Check if the instances have the appropriate CF metadata associated
+        # with them and if not, skip them.  The remaining instances may not
+        # always represent a customer instance, but it's a close enough
+        # estimate for our purposes.
+        tagged_instances = [
+            (db_instance, tags)
+            for db_instance, tags in zip(db_instances, map(get_tags, db_instances))
+            if "Instance GUID" in tags
+        ]
+
+        # If we set a processing limit, only take what is left of it.
+        if limit > 0:
+            tagged_instances = tagged_instances[:limit - count]
+
+        if not tagged_instances:
             continue
-        elif limit > 0 and count >= limit:
-            break
 
-        org_name = get_cf_entity_name(
-            "organizations",
-            tags["Organization GUID"]
-        )
+        db_instances = [db_instance for db_instance, _ in tagged_instances]
+        tag_dicts = [tags for _, tags in tagged_instances]
+
+        # Resolve the CF names for the whole page with a few bulk calls.
+        tag_entities = [("Organization GUID", "organizations"), ("Space GUID", "spaces")]
+        if summary is not None:
+            tag_entities.append(("Instance GUID", SERVICE_INSTANCE_PLANS))
+        prefetch_tag_entity_names(tag_dicts, tag_entities)
+
+        org_names = [get_cf_entity_name("organizations", tags["Organization GUID"]) for tags in tag_dicts]
+        space_names = [get_cf_entity_name("spaces", tags["Space GUID"]) for tags in tag_dicts]
+
+        instance_classes = [db_instance["DBInstanceClass"] for db_instance in db_instances]
+        engines = [db_instance["Engine"] for db_instance in db_instances]
+        multi_azs = [bool(db_instance["MultiAZ"]) for db_instance in db_instances]
+        storage_sizes = [db_instance["AllocatedStorage"] for db_instance in db_instances]
+
+        instance_class_prices = [
+            RDS_INSTANCE_CLASS_PRICES[key]
+            for key in zip(engines, instance_classes, multi_azs)
+        ]
+        storage_prices = [RDS_STORAGE_PRICES[key] for key in zip(engines, multi_azs)]
+
+        estimates = calculate_monthly_costs(instance_class_prices, storage_prices, storage_sizes)
+
+        for index, db_instance in enumerate(db_instances):
+            tags = tag_dicts[index]
+
+            output = "{instance_class},{engine},{multi_az},{storage_type},{storage_size},{instance_guid},{space_guid},{org_guid},{space_name},{org_name},{instance_class_price},{storage_price},{total_monthly_estimate:.2f}".format(
+                instance_class=instance_classes[index],
+                engine=engines[index],
+                multi_az="Yes" if multi_azs[index] else "No",
+                storage_type=db_instance["StorageType"],
+                storage_size=storage_sizes[index],
+                instance_guid=tags["Instance GUID"],
+                space_guid=tags["Space GUID"],
+                org_guid=tags["Organization GUID"],
+                space_name=space_names[index],
+                org_name=org_names[index],
+                instance_class_price=instance_class_prices[index],
+                storage_price=storage_prices[index],
+                total_monthly_estimate=estimates[index]
+            )
 
-        space_name = get_cf_entity_name(
-            "spaces",
-            tags["Space GUID"]
-        )
+            print(output)
 
-        if db_instance["MultiAZ"]:
-            instance_class_price = RDS_PRICING_INFO[db_instance["Engine"]]["instance_classes"][db_instance["DBInstanceClass"]]["multi_az"]
-            storage_price = RDS_PRICING_INFO[db_instance["Engine"]]["storage"]["multi_az"]
-            is_multi_az = "Yes"
-        else:
-            instance_class_price = RDS_PRICING_INFO[db_instance["Engine"]]["instance_classes"][db_instance["DBInstanceClass"]]["single"]
-            storage_price = RDS_PRICING_INFO[db_instance["Engine"]]["storage"]["single"]
-            is_multi_az = "No"
-
-        output = "{instance_class},{engine},{multi_az},{storage_type},{storage_size},{instance_guid},{space_guid},{org_guid},{space_name},{org_name},{instance_class_price},{storage_price},{total_monthly_estimate}".format(
-            instance_class=db_instance["DBInstanceClass"],
-            engine=db_instance["Engine"],
-            multi_az=is_multi_az,
-            storage_type=db_instance["StorageType"],
-            storage_size=db_instance["AllocatedStorage"],
-            instance_guid=tags["Instance GUID"],
-            space_guid=tags["Space GUID"],
-            org_guid=tags["Organization GUID"],
-            space_name=space_name,
-            org_name=org_name,
-            instance_class_price=instance_class_price,
-            storage_price=storage_price,
-            total_monthly_estimate=calculate_monthly_cost(
-                instance_class_price,
-                storage_price,
-                db_instance["AllocatedStorage"]
+        if summary is not None:
+            summary.add_many(
+                estimates,
+                organization=org_names,
+                plan=[get_service_plan_name(tags["Instance GUID"]) for tags in tag_dicts],
+                engine=engines,
+                instance_class=instance_classes
             )
-        )
 
-        print(output)
-        count += 1
+        count += len(db_instances)
+        if limit > 0 and count >= limit:
+            return
 
 
-def analyze_redis(json_file, limit):
+def analyze_redis(pages, limit, summary=None):
     """
-    Analyzes a JSON file containing AWS ElastiCache Redis cluster information.
+    Analyzes pages of AWS ElastiCache Redis cluster information.  Each page is
+    loaded into columns and priced in one batch.
     """
 
-    def calculate_monthly_cost(num_instances, instance_class_price):
+    def calculate_monthly_costs(num_instances, instance_class_prices):
         """
-        Calculates the monthly cost of a Redis cluster.  Note that this
-        is a rough estimate based on AWS' pricing formula for ElastiCache:
+        Calculates the monthly costs of a batch of Redis clusters, given one
+        column per input.  Note that this is a rough estimate based on AWS'
+        pricing formula for ElastiCache:
 
         Actual price for (3 instances) Memcached Memory optimized cache r4.16xlarge OnDemand (Hourly): 3 instance(s) x 8.73600000 USD hourly = 26.208 USD
 
@@ -845,37 +1145,57 @@ def analyze_redis(json_file, limit):
 
         num_instances * instance_class_price * HOURS_PER_MONTH
 
-        Returns the value formatted as a string, rounded to 2 decimal places.
+        Returns a column with the estimate for each cluster.
         """
 
-        estimate = int(num_instances) * instance_class_price * HOURS_PER_MONTH
-        return "{estimate:.2f}".format(estimate=estimate)
+        return [
+            num * instance_class_price * HOURS_PER_MONTH
+            for num, instance_class_price in zip(num_instances, instance_class_prices)
+        ]
 
     count = 0
-    redis_cluster_data = json.load(open(json_file))
 
     print("Cache Cluster ID,Cache Cluster Type,Instance Class,Number of Nodes,Instance Class Price,Total Monthly Estimate")
 
-    for redis_cluster in redis_cluster_data["CacheClusters"]:
-        # If we set a processing limit and we haven't skipped, check to see if
-        # we should stop.
-        if limit > 0 and count >= limit:
-            break
-
-        output = "{cache_cluster_id},{cache_cluster_type},{instance_class},{num_nodes},{instance_class_price},{total_monthly_estimate}".format(
-            cache_cluster_id=redis_cluster["CacheClusterId"],
-            cache_cluster_type=redis_cluster["Engine"],
-            instance_class=redis_cluster["CacheNodeType"],
-            num_nodes=redis_cluster["NumCacheNodes"],
-            instance_class_price=REDIS_PRICING_INFO[redis_cluster["CacheNodeType"]],
-            total_monthly_estimate=calculate_monthly_cost(
-                redis_cluster["NumCacheNodes"],
-                REDIS_PRICING_INFO[redis_cluster["CacheNodeType"]]
+    for redis_clusters in pages:
+        # If we set a processing limit, only take what is left of it.
+        if limit > 0:
+            redis_clusters = redis_clusters[:limit - count]
+
+        engines = [redis_cluster["Engine"] for redis_cluster in redis_clusters]
+        instance_classes = [redis_cluster["CacheNodeType"] for redis_cluster in redis_clusters]
+        num_nodes = [int(redis_cluster["NumCacheNodes"]) for redis_cluster in redis_clusters]
+        instance_class_prices = [REDIS_PRICING_INFO[instance_class] for instance_class in instance_classes]
+
+        estimates = calculate_monthly_costs(num_nodes, instance_class_prices)
+
+        for index, redis_cluster in enumerate(redis_clusters):
+            output = "{cache_cluster_id},{cache_cluster_type},{instance_class},{num_nodes},{instance_class_price},{total_monthly_estimate:.2f}".format(
+                cache_cluster_id=redis_cluster["CacheClusterId"],
+                cache_cluster_type=engines[index],
+                instance_class=instance_classes[index],
+                num_nodes=num_nodes[index],
+                instance_class_price=instance_class_prices[index],
+                total_monthly_estimate=estimates[index]
             )
-        )
 
-        print(output)
-        count += 1
+            print(output)
+
+        if summary is not None:
+            summary.add_many(estimates, engine=engines, instance_class=instance_classes)
+
+        count += len(redis_clusters)
+        if limit > 0 and count >= limit:
+            return
+
+
+# Functions that page through the AWS APIs directly for each AWS service.
+LIVE_SOURCES = {
+    "es": live_es_pages,
+    "rds": live_rds_pages,
+    "redis": live_redis_pages,
+    "aws-resource-tags": live_aws_resource_tags_pages,
+}
 
 
 def main():
@@ -883,16 +1203,36 @@ def main():
 
     limit = int(args.limit)
 
-    if args.aws_service == "es":
-        analyze_es(args.json_file, limit)
-    elif args.aws_service == "rds":
-        analyze_rds(args.json_file, limit)
-    elif args.aws_service == "redis":
-        analyze_redis(args.json_file, limit)
-    elif args.aws_service == "aws-resource-tags":
-        parse_aws_resource_tags(args.json_file, limit)
-    else:
+    analyzers = {
+        "es": analyze_es,
+        "rds": analyze_rds,
+        "redis": analyze_redis,
+        "aws-resource-tags": parse_aws_resource_tags,
+    }
+
+    if args.aws_service not in analyzers:
         print("Unknown command, exiting.")
+        return
+
+    if args.price_list:
+        apply_price_lists(args.price_list)
+
+    if args.live:
+        # Fetch the next page from AWS while the current one is analyzed.
+        pages = read_ahead(LIVE_SOURCES[args.aws_service]())
+    else:
+        pages = json_file_pages(args.json_file, JSON_KEYS[args.aws_service])
+
+    if args.aws_service == "aws-resource-tags":
+        analyzers[args.aws_service](pages, limit)
+        return
+
+    summary = CostSummary() if args.summary_file else None
+
+    analyzers[args.aws_service](pages, limit, summary)
+
+    if summary is not None:
+        summary.write(args.summary_file)
 
 
 if __name__ == "__main__":
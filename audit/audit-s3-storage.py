@@ -4,9 +4,10 @@ import os
 import boto3
 from botocore.exceptions import ClientError
 import datetime
-import functools
-import json
-import subprocess
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+from cf_names import get_cf_entity_name
 
 s3_client = boto3.client("s3")
 cloudwatch_client = boto3.client("cloudwatch")
@@ -14,22 +15,6 @@ cloudwatch_client = boto3.client("cloudwatch")
 PROD_S3_PREFIX = "cg-"
 
 
-@functools.cache
-def get_cf_entity_name(entity, guid):
-    """
-    Retrieves the name of a CF entity from a GUID.
-    """
-    if not guid:
-        return
-    cf_json = subprocess.check_output(
-        "cf curl /v3/" + entity + "/" + guid,
-        universal_newlines=True,
-        shell=True,
-    )
-    cf_data = json.loads(cf_json)
-    return cf_data.get("name", "N/A")
-
-
 def print_all_s3_instances_csv_lines():
     buckets = s3_client.list_buckets()
     bucket_list=[bucket['Name'] for bucket in buckets['Buckets']]
@@ -6,13 +6,16 @@ with the org and space names they belong to and a bit of other metadata.  The
 output is sorted in chronological order by created_at date.
 
 NOTE:  This script assumes you are logged into CF on the command line as it
-makes use of calls with the cf CLI.
+reads the API endpoint and token from the cf CLI config.
 """
 
 import argparse
-import json
 import logging
-import subprocess
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+import cf_api
 
 # CF API URI endpoint configuration.
 CF_SERVICE_INSTANCES_API_URI = "/v3/service_instances?service_plan_names=cdn-route,custom-domain,domain,domain-with-cdn&order_by=created_at"
@@ -104,6 +107,7 @@ def get_service_instances(
     in the platform.
     """
 
+    client = cf_api.get_client()
     service_instances = []
     resources_parsed = 0
     resources_skipped = 0
@@ -116,9 +120,10 @@ def get_service_instances(
     # service instances from the API call itself.
     # http://v3-apidocs.cloudfoundry.org/version/3.99.0/#filters
     if federalist_only:
-        federalist_org_guid = subprocess.check_output(
-            ["cf", "org", FEDERALIST_ORG_NAME, "--guid"]
-        ).decode("utf-8").replace("\n", "")
+        federalist_org_guid = client.get(
+            CF_ORGANIZATIONS_API_URI,
+            params={"names": FEDERALIST_ORG_NAME}
+        )["resources"][0]["guid"]
 
         page = page + "&organization_guids=" + federalist_org_guid
 
@@ -132,9 +137,9 @@ def get_service_instances(
 
     while page is not None:
         try:
-            output = json.loads(subprocess.check_output(["cf", "curl", page]).decode("utf-8"))
-        except subprocess.CalledProcessError as exc:
-            logger.error("Unable to execute cf curl: {0}".format(exc))
+            output = client.get(page)
+        except cf_api.CFAPIError as exc:
+            logger.error("Unable to query the CF API: {0}".format(exc))
             break
 
         # Go through each resource returned and parse all of the relevant
@@ -145,7 +150,7 @@ def get_service_instances(
             if limit > 0 and resources_parsed >= limit:
                 break
 
-            service_instance = parse_resource(resource)
+            service_instance = parse_resource(client, resource)
 
             # Check to see if we should skip this record because of the
             # exclusion flags set.  If we skip, don't increase the counter so
@@ -181,11 +186,9 @@ def get_service_instances(
         else:
             page = None
 
-        # If we still have a page value, we need to retrieve the piece to get to
-        # the next page.
+        # If we still have a page value, follow its link to the next page.
         if page is not None:
-            uri_parts = page["href"].split("/")
-            page = "{0}/{1}".format(uri_parts[-2], uri_parts[-1])
+            page = page["href"]
             logger.info("...Processing next page...")
         else:
             logger.info("...Finished processing {0} records ({1} skipped).".format(
@@ -196,7 +199,7 @@ def get_service_instances(
     return service_instances
 
 
-def parse_resource(resource):
+def parse_resource(client, resource):
     """
     Takes in a CF API service instance resource and parses the following
     information out of it:
@@ -221,22 +224,22 @@ def parse_resource(resource):
 
     # Retrieve the service plan information.
     service_plan_guid = resource["relationships"]["service_plan"]["data"]["guid"]
-    service_plan_output = json.loads(subprocess.check_output(["cf", "curl", CF_SERVICE_PLANS_API_URI + service_plan_guid]).decode("utf-8"))
+    service_plan_output = client.get(CF_SERVICE_PLANS_API_URI + service_plan_guid)
     resource_info["service_plan"] = service_plan_output["name"]
 
     # Retrieve the broker information.
     service_offering_guid = service_plan_output["relationships"]["service_offering"]["data"]["guid"]
-    service_offering_output = json.loads(subprocess.check_output(["cf", "curl", CF_SERVICE_OFFERINGS_API_URI + service_offering_guid]).decode("utf-8"))
+    service_offering_output = client.get(CF_SERVICE_OFFERINGS_API_URI + service_offering_guid)
     resource_info["broker"] = service_offering_output["name"]
 
     # Retrieve the space information.
     space_guid = resource["relationships"]["space"]["data"]["guid"]
-    space_output = json.loads(subprocess.check_output(["cf", "curl", CF_SPACES_API_URI + space_guid]).decode("utf-8"))
+    space_output = client.get(CF_SPACES_API_URI + space_guid)
     resource_info["space_name"] = space_output["name"]
 
     # Retrieve the organization information.
     org_guid = space_output["relationships"]["organization"]["data"]["guid"]
-    org_output = json.loads(subprocess.check_output(["cf", "curl", CF_ORGANIZATIONS_API_URI + org_guid]).decode("utf-8"))
+    org_output = client.get(CF_ORGANIZATIONS_API_URI + org_guid)
     resource_info["org_name"] = org_output["name"]
 
     return resource_info
@@ -3,262 +3,296 @@
 # Prerequisites:
 #  - Use aws-vault if running locally
 #  - `cf login` into production CF
-# Usage: python3 aws-list-rds-databases-needing-upgrades.py
+# Usage: python3 aws-list-rds-databases-needing-upgrades.py [--rules RULES_FILE] [--explain]
+#  - --rules: YAML rule table of the upgrade policy, default is rds-upgrade-rules.yaml next to this script
+#  - --explain: Print why each db instance got its action
 # Environment variables:
 #  - CSV_FILE_NAME: The results are written to a csv file, the default is "idle_db.csv"
-#  - SYSTEM_DOMAIN: CF system domain, default is pointed to production with the value "fr.cloud.gov"
+#  - CF_WORKERS: Number of pages of db instances whose org/space names are looked up at the same time, default is 4
+#  - SYSTEM_DOMAIN: CF system domain, e.g. "fr.cloud.gov", default is the CF API targeted by `cf login`
 
+import argparse
 import boto3
+import functools
+import yaml
+from botocore.exceptions import BotoCoreError, ClientError
 from packaging import version
 import csv, sys, os
-import requests, warnings
-import subprocess
-from requests.structures import CaseInsensitiveDict
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
-POSTGRESQL_MINVERSION="14" # https://docs.aws.amazon.com/AmazonRDS/latest/PostgreSQLReleaseNotes/postgresql-release-calendar.html
-MYSQL_MINVERSION="8.4" # https://docs.aws.amazon.com/AmazonRDS/latest/UserGuide/MySQL.Concepts.VersionMgmt.html#MySQL.Concepts.VersionMgmt.ReleaseCalendar
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+import cf_owners
+import pipeline
 
 
-# Function to retrieve org and space name for an app
-def get_org_space_service_instance(space_id, instance_id):
+RULES_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "rds-upgrade-rules.yaml"
+)
 
-    if not sys.warnoptions:
-        warnings.simplefilter("ignore")
+# The action of a rule to use, keyed by (needs instance upgrade, needs engine upgrade)
+UPGRADE_KINDS = {
+    (True, True): "both",
+    (True, False): "instance",
+    (False, True): "engine",
+}
 
-    # Login
-    system_domain = os.getenv("SYSTEM_DOMAIN", "fr.cloud.gov")
 
-    # This is done each time because the overall script takes longer to run than the token is good for
-    result = subprocess.run(["cf", "oauth-token"], stdout=subprocess.PIPE)
-    token = result.stdout
-    token = token[:-1]  # Need to trim the newline character at the end
+@functools.lru_cache(maxsize=None)
+def parse_version(db_engine_version):
+    return version.parse(db_engine_version)
 
-    headers = CaseInsensitiveDict()
-    headers["Accept"] = "application/json"
-    headers["Authorization"] = token
 
-    space_url = "https://api." + system_domain + "/v3/spaces/" + space_id
+# Business logic on what to do with the instance, loaded from a YAML rule table (see rds-upgrade-rules.yaml) and
+# compiled once into lookups: minimum versions by engine, a set of outdated families and rules indexed by name prefix
+class UpgradeRules:
+    def __init__(self, rules_file=RULES_FILE):
+        with open(rules_file) as f:
+            config = yaml.safe_load(f)
 
-    # Try/except because the org id might not exist for the CF environment targeted (typically dev/staging).
-    try:
-        space_vars = requests.get(space_url, headers=headers, verify=False).json()
-        space_name = space_vars["name"]
-        org_url = space_vars["links"]["organization"]["href"]
-        org_vars = requests.get(org_url, headers=headers, verify=False).json()
-        org_name = org_vars["name"]
-    except:
-        org_name = "NOTFOUND"
-        space_name = "NOTFOUND"
+        self.minimum_engine_versions = {
+            engine: (minimum, version.parse(str(minimum)))
+            for engine, minimum in config.get("minimum_engine_versions", {}).items()
+        }
+        self.outdated_instance_families = set(
+            config.get("outdated_instance_families", [])
+        )
 
+        self.rules = config.get("rules", [])
+        self.prefixes = {}
+        self.default_rule = None
+        for index, rule in enumerate(self.rules):
+            if not rule.get("name"):
+                raise ValueError(f"Rule {index} in {rules_file} has no name")
+            missing = set(UPGRADE_KINDS.values()) - set(rule.get("actions", {}))
+            if missing:
+                raise ValueError(
+                    f"Rule {rule['name']} in {rules_file} has no action for: {', '.join(sorted(missing))}"
+                )
+            prefix = rule.get("name_prefix")
+            if prefix:
+                self.prefixes.setdefault(prefix, index)
+            elif self.default_rule is None:
+                self.default_rule = index
+        if self.default_rule is None:
+            raise ValueError(f"{rules_file} has no default rule without a name_prefix")
+
+        # Only the prefix lengths in use have to be tried against a name
+        self.prefix_lengths = sorted(set(len(prefix) for prefix in self.prefixes))
+
+    def match_rule(self, db_instance_name):
+        """
+        Returns the first rule, in file order, whose prefix the name starts with
+        """
+        matches = [
+            self.prefixes[db_instance_name[:length]]
+            for length in self.prefix_lengths
+            if db_instance_name[:length] in self.prefixes
+        ]
+        return self.rules[min(matches, default=self.default_rule)]
+
+    def classify(self, db_engine, db_engine_version, family_name, db_instance_name):
+        """
+        Returns the action for an instance, "ok" if it needs no upgrade, and the
+        reasons behind it
+        """
+        reasons = []
+
+        family_ok = family_name not in self.outdated_instance_families
+        if not family_ok:
+            reasons.append(f"instance family {family_name} is outdated")
+
+        engine_ok = True
+        if db_engine in self.minimum_engine_versions:
+            minimum, minimum_version = self.minimum_engine_versions[db_engine]
+            if parse_version(db_engine_version) < minimum_version:
+                engine_ok = False
+                reasons.append(f"{db_engine} {db_engine_version} is older than {minimum}")
+                print(f"current db engine version is: {db_engine_version}, and the current db engine is: {db_engine}")
+
+        if family_ok and engine_ok:
+            return "ok", reasons
+
+        rule = self.match_rule(db_instance_name)
+        kind = UPGRADE_KINDS[(not family_ok, not engine_ok)]
+        reasons.append(f"rule {rule['name']} ({kind})")
+        return rule["actions"][kind], reasons
+
+
+HEADER_ROW = (
+    "DBInstanceIdentifier",
+    "DBInstanceClass",
+    "DBName",
+    "AllocatedStorage",
+    "Engine",
+    "EngineVersion",
+    "PreferredMaintenanceWindow",
+    "Action",
+    "Created At",
+    "Age in Days",
+    "Org ID",
+    "Org Name",
+    "Space ID",
+    "Space Name",
+    "Instance ID",
+    "Instance Name",
+    "TagList",
+)
+
+
+# Number of db instances in the account, from the RDS quota usage, so progress can show an ETA
+def count_db_instances(rds):
     try:
-        service_instance_url = (
-            "https://api." + system_domain + "/v3/service_instances/" + instance_id
+        quotas = rds.describe_account_attributes()["AccountQuotas"]
+    except (BotoCoreError, ClientError):
+        return None
+    for quota in quotas:
+        if quota["AccountQuotaName"] == "DBInstances":
+            return quota["Used"]
+    return None
+
+
+# Classify a page of db instances, returning the ones needing an upgrade as (row up to the org id, space id, instance guid, tags)
+def classify_page(dbinstances, rules, explain, end_time):
+
+    pending = []
+    for dbinstance in dbinstances:
+        db_instance_name = dbinstance["DBInstanceIdentifier"]
+
+        db_type = dbinstance["DBInstanceClass"]
+        db_name = dbinstance["DBName"]
+        db_storage = dbinstance["AllocatedStorage"]
+        db_engine = dbinstance["Engine"]
+        db_engine_version = dbinstance["EngineVersion"]
+        db_instance_created_at = dbinstance["InstanceCreateTime"]
+        db_age = end_time - db_instance_created_at
+        db_tag_list = dbinstance["TagList"]
+        db_preferred_maintenance_windows = dbinstance["PreferredMaintenanceWindow"]
+
+        family_name = "db." + db_type.split(".")[1]
+
+        # Pull the org and space id's from the tags
+        org_id = space_id = instance_guid = ""
+
+        for tagArray in db_tag_list:
+            if tagArray["Key"] == "Organization GUID":
+                org_id = tagArray["Value"]
+            if tagArray["Key"] == "Space GUID":
+                space_id = tagArray["Value"]
+            if tagArray["Key"] == "Instance GUID":
+                instance_guid = tagArray["Value"]
+
+        action, reasons = rules.classify(
+            db_engine, db_engine_version, family_name, db_instance_name
         )
-        service_instance_vars = requests.get(
-            service_instance_url, headers=headers, verify=False
-        ).json()
-        instance_name = service_instance_vars["name"]
-    except:
-        instance_name = "NOTFOUND"
-
-    return org_name, space_name, instance_name
-
-
-# Business logic on what to do with the instance
-def determine_action(db_engine, db_engine_version, family_name, db_instance_name):
-
-    action = ""
-    family_ok = True
-    engine_ok = True
-
-    if family_name == "db.t2" or family_name == "db.m4":
-        family_ok = False
-    
-    if (
-        db_engine == "postgres"
-        and version.parse(db_engine_version) < version.parse(POSTGRESQL_MINVERSION)
-    ) or (
-        db_engine == "mysql" and version.parse(db_engine_version) < version.parse(MYSQL_MINVERSION)
-    ):
-        engine_ok = False
-        print(f"current db engine version is: {db_engine_version}, and the current db engine is: {db_engine}")
-
-    if family_ok == False and engine_ok == False:
-        # Needs instance and engine upgrade
-        if db_instance_name.startswith("cg-aws-broker-dev"):
-            action = "Give to platform, needs both engine upgrade and instance upgrade, is AWS broker dev broker"
-        elif db_instance_name.startswith("cg-aws-broker-stage"):
-            action = "Give to platform, needs both engine upgrade and instance upgrade, is AWS broker staging broker"
-        elif db_instance_name.startswith("development-"):
-            action = "Give to platform, needs both engine upgrade and instance upgrade, likely terraform created in cg-provision main stack for development"
-        elif db_instance_name.startswith("staging-"):
-            action = "Give to platform, needs both engine upgrade and instance upgrade, likely terraform created in cg-provision main stack for staging"
-        elif db_instance_name.startswith("production-"):
-            action = "Give to platform, needs both engine upgrade and instance upgrade, likely terraform created in cg-provision main stack for production"
-        elif db_instance_name.startswith("tooling-"):
-            action = "Give to platform, needs both engine upgrade and instance upgrade, likely terraform created in cg-provision main stack for tooling"
-        elif db_instance_name.startswith("terraform-"):
-            action = "Give to platform, needs both engine upgrade and instance upgrade, likely terraform but need to track down"
-        elif db_instance_name.startswith("bosh-"):
-            action = "Give to platform, needs both engine upgrade and instance upgrade, likely terraform but need to track down"
-        else:
-            action = (
-                "Customer database which needs both engine upgrade and instance upgrade"
+        if explain:
+            print(f"{db_instance_name}: {action} [{'; '.join(reasons) or 'no upgrade needed'}]")
+
+        if action != "ok":
+            row = (
+                db_instance_name,
+                db_type,
+                db_name,
+                db_storage,
+                db_engine,
+                db_engine_version,
+                db_preferred_maintenance_windows,
+                action,
+                db_instance_created_at,
+                db_age.days,
+                org_id,
             )
+            pending.append((row, space_id, instance_guid, db_tag_list))
 
-    elif family_ok == False and engine_ok:
-        # Needs just instance upgraded
-        if db_instance_name.startswith("cg-aws-broker-dev"):
-            action = (
-                "Give to platform, needs instance upgrade, is AWS broker dev broker"
-            )
-        elif db_instance_name.startswith("cg-aws-broker-stage"):
-            action = (
-                "Give to platform, needs intance upgrade, is AWS broker staging broker"
-            )
-        elif db_instance_name.startswith("development-"):
-            action = "Give to platform, needs instance upgrade, likely terraform created in cg-provision main stack for development"
-        elif db_instance_name.startswith("staging-"):
-            action = "Give to platform, needs instance upgrade, likely terraform created in cg-provision main stack for staging"
-        elif db_instance_name.startswith("production-"):
-            action = "Give to platform, needs instance upgrade, likely terraform created in cg-provision main stack for production"
-        elif db_instance_name.startswith("tooling-"):
-            action = "Give to platform, needs instance upgrade, likely terraform created in cg-provision main stack for tooling"
-        elif db_instance_name.startswith("terraform-"):
-            action = "Give to platform, needs instance upgrade, likely terraform but need to track down"
-        elif db_instance_name.startswith("bosh-"):
-            action = "Give to platform, needs instance upgrade, likely terraform but need to track down"
-        else:
-            action = "Customer database which needs instance upgrade"
-
-    elif family_ok and engine_ok == False:
-        # Needs engine upgraded
-        if db_instance_name.startswith("cg-aws-broker-dev"):
-            action = "Give to platform, needs engine upgrade, is AWS broker dev broker"
-        elif db_instance_name.startswith("cg-aws-broker-stage"):
-            action = (
-                "Give to platform, needs engine upgrade, is AWS broker staging broker"
-            )
-        elif db_instance_name.startswith("development-"):
-            action = "Give to platform, needs engine upgrade, likely terraform created in cg-provision main stack for development"
-        elif db_instance_name.startswith("staging-"):
-            action = "Give to platform, needs engine upgrade, likely terraform created in cg-provision main stack for staging"
-        elif db_instance_name.startswith("production-"):
-            action = "Give to platform, needs engine upgrade, likely terraform created in cg-provision main stack for production"
-        elif db_instance_name.startswith("tooling-"):
-            action = "Give to platform, needs engine upgrade, likely terraform created in cg-provision main stack for tooling"
-        elif db_instance_name.startswith("terraform-"):
-            action = "Give to platform, needs engine upgrade, likely terraform but need to track down"
-        elif db_instance_name.startswith("bosh-"):
-            action = "Give to platform, needs engine upgrade, likely terraform but need to track down"
-        else:
-            action = "Customer database which needs engine upgrade"
+    return pending
 
-    else:
-        action = "ok"
 
-    return action
+# Look up the org/space names of a page's classified db instances with a few bulk calls and return its csv rows
+def resolve_page(pending):
 
+    cf_owners.prefetch_owners(
+        [space_id for _, space_id, _, _ in pending if space_id != ""],
+        [instance_guid for _, space_id, instance_guid, _ in pending if space_id != ""],
+    )
+
+    rows = []
+    for row, space_id, instance_guid, db_tag_list in pending:
+        org_name = space_name = instance_name = ""
+        if space_id != "":
+            org_name, space_name, instance_name = (
+                cf_owners.get_org_space_service_instance(space_id, instance_guid)
+            )
+        rows.append(
+            row
+            + (org_name, space_id, space_name, instance_guid, instance_name, db_tag_list)
+        )
+    return rows
 
-def export_dbs():
+
+# Runs as a three stage pipeline: pages of db instances are fetched ahead in the background, each page is classified
+# and handed to a bounded pool that looks up its org/space names, and the csv is written page by page in the order
+# AWS listed them
+def export_dbs(rules, explain=False):
 
     # Set defaults
     csv_file_name = os.getenv("CSV_FILE_NAME", "rds_db.csv")
+    cf_workers = int(os.getenv("CF_WORKERS", 4))
 
     # Set history
     end_time = datetime.now(tz=timezone.utc)
 
-    csv_file = open(csv_file_name, "w")
-    obj = csv.writer(csv_file, delimiter=",")
-
     rds = boto3.client("rds")
     paginator = rds.get_paginator("describe_db_instances").paginate()
+    progress = pipeline.Progress(count_db_instances(rds))
 
-    # Create and write out header row for csv file
-    header_row = (
-        "DBInstanceIdentifier",
-        "DBInstanceClass",
-        "DBName",
-        "AllocatedStorage",
-        "Engine",
-        "EngineVersion",
-        "PreferredMaintenanceWindow",
-        "Action",
-        "Created At",
-        "Age in Days",
-        "Org ID",
-        "Org Name",
-        "Space ID",
-        "Space Name",
-        "Instance ID",
-        "Instance Name",
-        "TagList",
-    )
-    obj.writerow(header_row)
-
-    for page in paginator:
-        for dbinstance in page["DBInstances"]:
-            db_instance_name = dbinstance["DBInstanceIdentifier"]
-            print(f"Collecting information for: {db_instance_name}")
-
-            db_type = dbinstance["DBInstanceClass"]
-            db_name = dbinstance["DBName"]
-            db_storage = dbinstance["AllocatedStorage"]
-            db_engine = dbinstance["Engine"]
-            db_engine_version = dbinstance["EngineVersion"]
-            db_instance_created_at = dbinstance["InstanceCreateTime"]
-            db_age = end_time - db_instance_created_at
-            db_tag_list = dbinstance["TagList"]
-            db_preferred_maintenance_windows = dbinstance["PreferredMaintenanceWindow"]
-
-            family_name = "db." + db_type.split(".")[1]
-
-            # Pull the org and space id's from the tags
-            org_id = space_id = instance_guid = ""
-
-            for tagArray in db_tag_list:
-                if tagArray["Key"] == "Organization GUID":
-                    org_id = tagArray["Value"]
-                if tagArray["Key"] == "Space GUID":
-                    space_id = tagArray["Value"]
-                if tagArray["Key"] == "Instance GUID":
-                    instance_guid = tagArray["Value"]
-
-            action = determine_action(
-                db_engine, db_engine_version, family_name, db_instance_name
+    with open(csv_file_name, "w") as csv_file, ThreadPoolExecutor(
+        max_workers=cf_workers
+    ) as executor:
+        obj = csv.writer(csv_file, delimiter=",")
+
+        # Create and write out header row for csv file
+        obj.writerow(HEADER_ROW)
+
+        in_flight = deque()
+
+        def write_oldest_page():
+            page_size, rows = in_flight.popleft()
+            obj.writerows(rows.result())
+            print(f"Checked db instances: {progress.add(page_size)}")
+
+        for page in pipeline.read_ahead(paginator, depth=2):
+            pending = classify_page(page["DBInstances"], rules, explain, end_time)
+            in_flight.append(
+                (len(page["DBInstances"]), executor.submit(resolve_page, pending))
             )
 
-            if action != "ok":
-                org_name = space_name = instance_name = ""
-                if space_id != "":
-                    org_name, space_name, instance_name = (
-                        get_org_space_service_instance(space_id, instance_guid)
-                    )  # Only lookup org/space name if needed because of performance hit
-
-                output = (
-                    db_instance_name,
-                    db_type,
-                    db_name,
-                    db_storage,
-                    db_engine,
-                    db_engine_version,
-                    db_preferred_maintenance_windows,
-                    action,
-                    db_instance_created_at,
-                    db_age.days,
-                    org_id,
-                    org_name,
-                    space_id,
-                    space_name,
-                    instance_guid,
-                    instance_name,
-                    db_tag_list,
-                )
-                obj.writerow(output)
-            print(f"output written to: {csv_file_name}")
+            # Keep a bounded number of pages waiting on CF
+            while len(in_flight) > 2 * cf_workers:
+                write_oldest_page()
+
+        while in_flight:
+            write_oldest_page()
+
+    print(f"output written to: {csv_file_name}")
+
 
 def main():
-    export_dbs()
+    parser = argparse.ArgumentParser(
+        description="List the RDS instances needing engine or instance family upgrades"
+    )
+    parser.add_argument(
+        "--rules",
+        default=RULES_FILE,
+        help="YAML rule table of the upgrade policy, default is rds-upgrade-rules.yaml",
+    )
+    parser.add_argument(
+        "--explain",
+        action="store_true",
+        help="Print which rule matched each db instance and why",
+    )
+    args = parser.parse_args()
+
+    export_dbs(UpgradeRules(args.rules), args.explain)
 
 
 if __name__ == "__main__":
@@ -8,62 +8,160 @@
 # Environment variables:
 #  - AWS_ACCOUNT: The 12 digit AWS account number, probably want gov prod plat admin
 #  - SHOW_ALL: Emit results for ALL databases, not just those with no db connections, default is false
-#  - SYSTEM_DOMAIN: CF system domain, default is pointed to production with the value "fr.cloud.gov"
+#  - WORKERS: Number of AWS and CF API calls made at the same time, default is 8
+#  - SYSTEM_DOMAIN: CF system domain, e.g. "fr.cloud.gov", default is the CF API targeted by `cf login`
 
 
 import boto3
 import sys, os 
-import requests, warnings
-import subprocess
-from requests.structures import CaseInsensitiveDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+import cf_owners
 
-# Function to retrieve org and space name for an app
-def get_org_space_service_instance(space_id, instance_id):
+# describe_domains accepts at most 5 domain names per request
+DESCRIBE_DOMAINS_BATCH_SIZE = 5
 
-    if not sys.warnoptions:
-        warnings.simplefilter("ignore")
+# GetMetricData accepts at most 500 metric queries per request
+METRIC_DATA_BATCH_SIZE = 500
 
-    # Login
-    system_domain = os.getenv('SYSTEM_DOMAIN', "fr.cloud.gov" )
+HEADER_ROW = ("domain_name", "org_id", "space_id", "instance_guid", "max_searchable_documents", "max_search_rate", "max_indexing_rate", "org_name", "space_name", "instance_name")
 
-    # This is done each time because the overall script takes longer to run than the token is good for
-    result = subprocess.run(['cf', 'oauth-token'], stdout=subprocess.PIPE)
-    token = result.stdout
-    token = token[:-1] # Need to trim the newline character at the end 
-   
+# Metrics pulled for each domain, with the statistic taken over each period
+DOMAIN_METRICS = (
+    ('SearchableDocuments', 'Maximum'),
+    ('SearchRate', 'Maximum'),
+    ('IndexingRate', 'Maximum'),
+)
 
-    headers = CaseInsensitiveDict()
-    headers["Accept"] = "application/json"
-    headers["Authorization"] = token
 
-    space_url = "https://api." + system_domain + "/v3/spaces/" + space_id
+def batches(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
 
-    # Try/except because the org id might not exist for the CF environment targeted (typically dev/staging).  
-    try:
-        space_vars = requests.get(space_url, headers=headers, verify=False).json()
-        space_name = space_vars["name"]
-        org_url = space_vars["links"]["organization"]["href"]
-        org_vars = requests.get(org_url, headers=headers, verify=False).json()
-        org_name = org_vars["name"]
-    except:
-        org_name="NOTFOUND"
-        space_name="NOTFOUND"
 
-    try:
-        service_instance_url = "https://api." + system_domain + "/v3/service_instances/" + instance_id
-        service_instance_vars = requests.get(service_instance_url, headers=headers, verify=False).json()
-        instance_name = service_instance_vars["name"]
-    except:
-        instance_name="NOTFOUND"
+# Describe a batch of up to DESCRIBE_DOMAINS_BATCH_SIZE domains and pull the tags of each one
+def describe_domains(es_client, domain_names):
 
+    domains = []
+    for domain in es_client.describe_domains(DomainNames=domain_names)['DomainStatusList']:
+        tags = es_client.list_tags(ARN=domain['ARN'])
+        domains.append((domain['DomainName'], tags['TagList']))
+    return domains
 
-    return org_name, space_name, instance_name
 
+# Find the highest value of each DOMAIN_METRICS metric for a batch of domains with one GetMetricData request
+def get_domain_metrics(cloudwatch_client, aws_account, metrics, start_time, end_time):
 
+    queries = [
+        {
+            'Id': 'm' + str(index),
+            'MetricStat': {
+                'Metric': {
+                    'Namespace': 'AWS/ES',
+                    'MetricName': metric_name,
+                    'Dimensions': [
+                        {
+                            'Name': 'DomainName',
+                            'Value': domain_name
+                        },
+                        {
+                            "Name": "ClientId",
+                            "Value": aws_account
+                        }
+                    ]
+                },
+                'Period': 14400,
+                'Stat': stat
+            }
+        }
+        for index, (domain_name, metric_name, stat) in enumerate(metrics)
+    ]
+
+    max_values = {}
+    paginator = cloudwatch_client.get_paginator('get_metric_data').paginate(
+        MetricDataQueries=queries,
+        StartTime=start_time,
+        EndTime=end_time
+    )
+    # Results for one query can be split across pages
+    for page in paginator:
+        for result in page['MetricDataResults']:
+            domain_name, metric_name, _ = metrics[int(result['Id'][1:])]
+            values = max_values.setdefault(domain_name, {})
+            values[metric_name] = max([values.get(metric_name, 0)] + result['Values'])
+    return max_values
+
+
+# Scan the domains of one account and region, returning a HEADER_ROW shaped row for each unused one (or every one with show_all)
+def scan_domains(es_client, cloudwatch_client, aws_account, show_all, workers):
+
+    # Set history
+    num_days_history = 1
+    start_time = datetime.now() - timedelta(days=int(num_days_history))
+    end_time = datetime.now()
+    
+    domain_names = [domain['DomainName'] for domain in es_client.list_domain_names()['DomainNames']]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+
+        # Describe the domains in batches, all batches at the same time
+        domains = []
+        for batch in executor.map(lambda batch: describe_domains(es_client, batch), batches(domain_names, DESCRIBE_DOMAINS_BATCH_SIZE)):
+            domains.extend(batch)
 
+        # Pull the org and space id's from the tags
+        domain_guids = {}
+        for domain_name, tag_list in domains:
+            org_id = space_id = instance_guid = ""
+
+            for tag in tag_list:
+                if tag['Key'] == "Organization GUID":
+                    org_id = tag['Value']
+                if tag['Key'] == "Space GUID":
+                    space_id = tag['Value']
+                if tag['Key'] == "Instance GUID":
+                    instance_guid = tag['Value']
+
+            domain_guids[domain_name] = (org_id, space_id, instance_guid)
+
+        # Look up the org/space names while the metrics are pulled
+        owners = executor.submit(
+            cf_owners.prefetch_owners,
+            [space_id for _, space_id, _ in domain_guids.values()],
+            [instance_guid for _, _, instance_guid in domain_guids.values()]
+        )
 
+        # Keep all metrics of a domain in the same request
+        metric_batches = [
+            [
+                (domain_name, metric_name, stat)
+                for domain_name, _ in batch
+                for metric_name, stat in DOMAIN_METRICS
+            ]
+            for batch in batches(domains, METRIC_DATA_BATCH_SIZE // len(DOMAIN_METRICS))
+        ]
+        max_values = {}
+        for batch_values in executor.map(lambda batch: get_domain_metrics(cloudwatch_client, aws_account, batch, start_time, end_time), metric_batches):
+            max_values.update(batch_values)
+
+        owners.result()
+
+    rows = []
+    for domain_name, _ in domains:
+        org_id, space_id, instance_guid = domain_guids[domain_name]
+        domain_values = max_values.get(domain_name, {})
+        max_searchable_documents = domain_values.get('SearchableDocuments', 0)
+        max_search_rate = domain_values.get('SearchRate', 0)
+        max_indexing_rate = domain_values.get('IndexingRate', 0)
+
+        if max_searchable_documents == 0.0  or show_all:
+            org_name = space_name = instance_name = ""
+            if space_id != "":
+                org_name, space_name, instance_name = cf_owners.get_org_space_service_instance(space_id, instance_guid)
+            rows.append((domain_name, org_id, space_id, instance_guid, max_searchable_documents, max_search_rate, max_indexing_rate, org_name, space_name, instance_name))
+
+    return rows
 
 
 def export_domains():
@@ -71,6 +169,7 @@ def export_domains():
     # Set defaults 
     show_all = os.getenv('SHOW_ALL', False )
     aws_account = os.getenv('AWS_ACCOUNT','NOTFOUND')
+    workers = int(os.getenv('WORKERS', 8))
     comma = ","
 
 
@@ -79,70 +178,15 @@ def export_domains():
         print("Please set the 12 digit AWS_ACCOUNT variable and try again.")
         sys.exit(1)
 
-    # Set history
-    num_days_history = 1
-    start_time = datetime.now() - timedelta(days=int(num_days_history))
-    end_time = datetime.now()
-    
     cloudwatch_client = boto3.client('cloudwatch', region_name='us-gov-west-1')
     es_client = boto3.client('opensearch')
 
-    domains = es_client.list_domain_names()
+    rows = scan_domains(es_client, cloudwatch_client, aws_account, show_all, workers)
 
     # Print header
-    print("domain_name, org_id, space_id, instance_guid, max_searchable_documents, org_name, space_name, instance_name")
-
-    for esinstance in domains['DomainNames']:
-        domain_name = esinstance['DomainName']
-
-        domain = es_client.describe_domain(DomainName=domain_name)
-        arn = domain['DomainStatus']['ARN']
-        tags = es_client.list_tags(ARN=arn)
-
-        # Pull the org and space id's from the tags
-        org_id = space_id = instance_guid = ""
-
-        for tag in tags['TagList']:
-            if tag['Key'] == "Organization GUID":
-                org_id = tag['Value']
-            if tag['Key'] == "Space GUID":
-                space_id = tag['Value']
-            if tag['Key'] == "Instance GUID":
-                instance_guid = tag['Value']
-
-
-        es_metrics = cloudwatch_client.get_metric_statistics(
-            Namespace='AWS/ES',
-            MetricName='SearchableDocuments',
-            Dimensions=[
-                {
-                    'Name': 'DomainName',
-                    'Value': domain_name
-                },
-                {
-                    "Name": "ClientId",
-                    "Value": aws_account
-                }
-            ],
-            StartTime= start_time,
-            EndTime= end_time,
-            Period= 14400,  
-            Statistics=[
-                'Maximum',
-            ]
-        )
-
-        max_searchable_documents = 0
-        for es_metric in es_metrics['Datapoints']:
-            searchable_documents = es_metric['Maximum']
-            if searchable_documents > max_searchable_documents:
-                max_searchable_documents = searchable_documents
-
-        if max_searchable_documents == 0.0  or show_all:
-            org_name = space_name = instance_name = ""
-            if space_id != "":
-                org_name, space_name, instance_name = get_org_space_service_instance(space_id, instance_guid)  #Only lookup org/space name if needed because of performance hit
-            print(domain_name,comma, org_id,comma, space_id,comma, instance_guid,comma, max_searchable_documents,comma, org_name,comma, space_name,comma, instance_name)
+    print(", ".join(HEADER_ROW))
+    for row in rows:
+        print(*row, sep=" " + comma + " ")
 
 
 def main():
@@ -150,4 +194,3 @@ def main():
 
 if __name__ == "__main__":
   main()
-
@@ -7,56 +7,18 @@
 #  - NUM_DAYS: The number of days of no db connections to be included on the list, default is 30
 #  - CSV_FILE_NAME: The results are written to a csv file, the default is "idle_db.csv"
 #  - SHOW_ALL: Emit results for ALL databases, not just those with no db connections, default is false
-#  - SYSTEM_DOMAIN: CF system domain, default is pointed to production with the value "fr.cloud.gov"
+#  - METRIC_STORE: Where CloudWatch metric history is kept between runs, default is ~/.cache/cg-scripts/metrics.sqlite3
+#  - SYSTEM_DOMAIN: CF system domain, e.g. "fr.cloud.gov", default is the CF API targeted by `cf login`
 
 import boto3
 import csv, sys, os 
-import requests, warnings
-import subprocess
-from requests.structures import CaseInsensitiveDict
 from datetime import datetime, timedelta, timezone
 
-# Function to retrieve org and space name for an app
-def get_org_space_service_instance(space_id, instance_id):
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+import cf_owners
+import metric_store
 
-    if not sys.warnoptions:
-        warnings.simplefilter("ignore")
-
-    # Login
-    system_domain = os.getenv('SYSTEM_DOMAIN', "fr.cloud.gov" )
-
-    # This is done each time because the overall script takes longer to run than the token is good for
-    result = subprocess.run(['cf', 'oauth-token'], stdout=subprocess.PIPE)
-    token = result.stdout
-    token = token[:-1] # Need to trim the newline character at the end 
-   
-
-    headers = CaseInsensitiveDict()
-    headers["Accept"] = "application/json"
-    headers["Authorization"] = token
-
-    space_url = "https://api." + system_domain + "/v3/spaces/" + space_id
-
-    # Try/except because the org id might not exist for the CF environment targeted (typically dev/staging).  
-    try:
-        space_vars = requests.get(space_url, headers=headers, verify=False).json()
-        space_name = space_vars["name"]
-        org_url = space_vars["links"]["organization"]["href"]
-        org_vars = requests.get(org_url, headers=headers, verify=False).json()
-        org_name = org_vars["name"]
-    except:
-        org_name="NOTFOUND"
-        space_name="NOTFOUND"
-
-    try:
-        service_instance_url = "https://api." + system_domain + "/v3/service_instances/" + instance_id
-        service_instance_vars = requests.get(service_instance_url, headers=headers, verify=False).json()
-        instance_name = service_instance_vars["name"]
-    except:
-        instance_name="NOTFOUND"
-
-
-    return org_name, space_name, instance_name
+HEADER_ROW = ("DBInstanceIdentifier","DBInstanceClass","Action","DBName","AllocatedStorage","Engine","EngineVersion","DB Connections","Created At","Age in Days","Org ID", "Org Name", "Space ID", "Space Name", "Instance ID", "Instance Name", "Stop Command","TagList")
 
 # Business logic on what to do with the instance
 def determine_action(connection_count, db_instance_name, space_name):
@@ -88,93 +50,137 @@ def determine_action(connection_count, db_instance_name, space_name):
         action = "Give to platform, unclassified"
     return action
 
+# The scope the metric store keeps this account and region's metrics under, the same "account/region" the sweep uses
+def default_metric_scope(cloudwatch_client):
+    region = cloudwatch_client.meta.region_name
+    account_id = boto3.client('sts', region_name=region).get_caller_identity()['Account']
+    return f"{account_id}/{region}"
+
+# Sum the daily DatabaseConnections of many db instances.  Metrics come from the local metric store, which only pulls
+# what it has not seen yet from CloudWatch, up to 500 db instances per GetMetricData request
+def get_connection_counts(cloudwatch_client, db_instance_names, start_time, end_time, metric_scope=None):
+
+    store = metric_store.get_metric_store()
+    scope = metric_scope or default_metric_scope(cloudwatch_client)
+    series = {
+        db_instance_name: metric_store.Series(
+            scope,
+            'AWS/RDS',
+            'DatabaseConnections',
+            (('DBInstanceIdentifier', db_instance_name),),
+            'Sum',
+            86400,    # Pull 1 day's worth of stats
+            'Count'
+        )
+        for db_instance_name in db_instance_names
+    }
+
+    print(f'Pulling cloudwatch db connections metrics for {len(series)} db instances')
+
+    # The db instances of requests that failed are left out of the counts
+    failed = store.update(cloudwatch_client, series.values(), start_time, end_time)
+
+    return {
+        db_instance_name: sum(store.values(db_series, start_time, end_time), 0.0)
+        for db_instance_name, db_series in series.items()
+        if db_series not in failed
+    }
+
+# Scan the db instances of one account and region, returning a HEADER_ROW shaped row for each idle one (or every one with show_all).
+# metric_scope tells apart the accounts and regions sharing the local metric store, the default is the account and region of the cloudwatch client
+def scan_idle_dbs(rds, cloudwatch_client, num_days_history, show_all, metric_scope=None):
+
+    # Set history
+    start_time = datetime.now(tz=timezone.utc) - timedelta(days=num_days_history)
+    end_time = datetime.now(tz=timezone.utc)
+
+    paginator = rds.get_paginator('describe_db_instances').paginate()
+
+    # Collect every db instance first so their metrics can be pulled in batches
+    dbinstances = []
+    for page in paginator:
+        dbinstances.extend(page['DBInstances'])
+
+    connection_counts = get_connection_counts(
+        cloudwatch_client,
+        [dbinstance['DBInstanceIdentifier'] for dbinstance in dbinstances],
+        start_time,
+        end_time,
+        metric_scope
+    )
+
+    # Look up the org/space names of every db instance that will be listed with a few bulk calls
+    space_guids = []
+    instance_guids = []
+    for dbinstance in dbinstances:
+        if connection_counts.get(dbinstance['DBInstanceIdentifier']) == 0.0 or show_all:
+            tags = {tag['Key']: tag['Value'] for tag in dbinstance['TagList']}
+            space_guids.append(tags.get("Space GUID"))
+            instance_guids.append(tags.get("Instance GUID"))
+    cf_owners.prefetch_owners(space_guids, instance_guids)
+
+    rows = []
+    for dbinstance in dbinstances:
+        db_instance_name = dbinstance['DBInstanceIdentifier']
+        print(f'Collecting information for: {db_instance_name}')
+        
+        db_type = dbinstance['DBInstanceClass']
+        db_name = dbinstance['DBName']
+        db_storage = dbinstance['AllocatedStorage']
+        db_engine = dbinstance['Engine']
+        db_engine_version = dbinstance['EngineVersion']
+        db_instance_created_at = dbinstance['InstanceCreateTime']
+        db_age = end_time - db_instance_created_at
+        db_tag_list = dbinstance['TagList']
+        stop_command = "aws rds stop-db-instance --db-instance-identifier " + db_instance_name + " ;"
+
+        # Pull the org and space id's from the tags
+        org_id = space_id = instance_guid = ""
+
+        for tagArray in db_tag_list:
+            if tagArray['Key'] == "Organization GUID":
+                org_id = tagArray['Value']
+            if tagArray['Key'] == "Space GUID":
+                space_id = tagArray['Value']
+            if tagArray['Key'] == "Instance GUID":
+                instance_guid = tagArray['Value']
+
+        # Metrics are missing if the rds is brand new or its batch errored out pulling cloudwatch stats
+        if db_instance_name in connection_counts:
+            connection_count = connection_counts[db_instance_name]
+        else:
+            print(f'Probably a new born db, could not pull cloudwatch metrics, setting value to -1: {db_instance_name}')
+            connection_count = -1
+
+        if (connection_count == 0.0 and db_age.days >= num_days_history) or show_all:
+            org_name = space_name = instance_name = ""
+            if space_id != "":
+                org_name, space_name, instance_name = cf_owners.get_org_space_service_instance(space_id, instance_guid)
+
+            action = determine_action(connection_count, db_instance_name, space_name)
+            output = (db_instance_name,db_type, action, db_name,db_storage,db_engine,db_engine_version, connection_count, db_instance_created_at, db_age.days, org_id, org_name, space_id, space_name, instance_guid, instance_name, stop_command, db_tag_list)
+            rows.append(output)
+
+    return rows
+
 def export_idle_dbs():
 
     # Set defaults 
-    num_days_history = os.getenv('NUM_DAYS', 30)
+    num_days_history = int(os.getenv('NUM_DAYS', 30))
     csv_file_name = os.getenv('CSV_FILE_NAME', "idle_db.csv" )
     show_all = os.getenv('SHOW_ALL', False )
 
-    # Set history
-    start_time = datetime.now(tz=timezone.utc) - timedelta(days=int(num_days_history))
-    end_time = datetime.now(tz=timezone.utc)
-
     cloudwatch_client = boto3.client('cloudwatch', region_name='us-gov-west-1')
-
-    csv_file = open(csv_file_name, 'w')
-    obj = csv.writer(csv_file, delimiter=',')
-
     rds = boto3.client('rds')
-    paginator = rds.get_paginator('describe_db_instances').paginate()
 
-    # Create and write out header row for csv file
-    header_row = ("DBInstanceIdentifier","DBInstanceClass","Action","DBName","AllocatedStorage","Engine","EngineVersion","DB Connections","Created At","Age in Days","Org ID", "Org Name", "Space ID", "Space Name", "Instance ID", "Instance Name", "Stop Command","TagList")
-    obj.writerow(header_row)
+    rows = scan_idle_dbs(rds, cloudwatch_client, num_days_history, show_all)
 
-    for page in paginator:
-        for dbinstance in page['DBInstances']:
-            db_instance_name = dbinstance['DBInstanceIdentifier']
-            print(f'Collecting information for: {db_instance_name}')
-            
-            db_type = dbinstance['DBInstanceClass']
-            db_name = dbinstance['DBName']
-            db_storage = dbinstance['AllocatedStorage']
-            db_engine = dbinstance['Engine']
-            db_engine_version = dbinstance['EngineVersion']
-            db_instance_created_at = dbinstance['InstanceCreateTime']
-            db_age = end_time - db_instance_created_at
-            db_tag_list = dbinstance['TagList']
-            stop_command = "aws rds stop-db-instance --db-instance-identifier " + db_instance_name + " ;"
-
-            # Pull the org and space id's from the tags
-            org_id = space_id = instance_guid = ""
-
-            for tagArray in db_tag_list:
-                if tagArray['Key'] == "Organization GUID":
-                    org_id = tagArray['Value']
-                if tagArray['Key'] == "Space GUID":
-                    space_id = tagArray['Value']
-                if tagArray['Key'] == "Instance GUID":
-                    instance_guid = tagArray['Value']
-
-            # Pull the cloudwatch db connections metrics for the db instance
-            rds_conn_metric = cloudwatch_client.get_metric_statistics(
-                Namespace='AWS/RDS',
-                MetricName='DatabaseConnections',
-                Dimensions=[
-                    {
-                        'Name': 'DBInstanceIdentifier',
-                        'Value': db_instance_name
-                    },
-                ],
-                StartTime= start_time,
-                EndTime= end_time,
-                Period= 86400,    # Pull 1 day's worth of stats
-                Statistics=[
-                    'Sum',
-                ],
-                Unit='Count'
-            )
-
-            # Try loop is here because if the rds is brand new, it will error out trying to pull cloudwatch stats
-            try:
-                connection_count = 0.0
-                for datapoint in rds_conn_metric['Datapoints']:
-                    connection_count = connection_count + datapoint['Sum']
-
-            except:
-                print(f'Probably a new born db, could not pull cloudwatch metrics, setting value to -1: {db_instance_name}')
-                connection_count = -1
-
-            if (connection_count == 0.0 and db_age.days >= num_days_history) or show_all:
-                org_name = space_name = instance_name = ""
-                if space_id != "":
-                    org_name, space_name, instance_name = get_org_space_service_instance(space_id, instance_guid)  #Only lookup org/space name if needed because of performance hit
-
-                action = determine_action(connection_count, db_instance_name, space_name)
-                output = (db_instance_name,db_type, action, db_name,db_storage,db_engine,db_engine_version, connection_count, db_instance_created_at, db_age.days, org_id, org_name, space_id, space_name, instance_guid, instance_name, stop_command, db_tag_list)
-                obj.writerow(output)
+    with open(csv_file_name, 'w') as csv_file:
+        obj = csv.writer(csv_file, delimiter=',')
 
+        # Create and write out header row for csv file
+        obj.writerow(HEADER_ROW)
+        obj.writerows(rows)
 
 
 def main():
@@ -6,125 +6,113 @@
 # Environment variables:
 #  - NUM_DAYS: The number of days of no db connections to be included on the list, default is 30
 #  - SHOW_ALL: Emit results for ALL databases, not just those with no db connections, default is false
-#  - SYSTEM_DOMAIN: CF system domain, default is pointed to production with the value "fr.cloud.gov"
+#  - METRIC_STORE: Where CloudWatch metric history is kept between runs, default is ~/.cache/cg-scripts/metrics.sqlite3
+#  - SYSTEM_DOMAIN: CF system domain, e.g. "fr.cloud.gov", default is the CF API targeted by `cf login`
 
 
 
 import boto3, sys, os
-import requests, warnings
-import subprocess
-from requests.structures import CaseInsensitiveDict
-from datetime import datetime, timedelta
-
-# Function to retrieve org and space name for an app
-def get_org_space_service_instance(instance_id):
-
-    if not sys.warnoptions:
-        warnings.simplefilter("ignore")
-
-    # Login
-    system_domain = os.getenv('SYSTEM_DOMAIN', "fr.cloud.gov" )
-
-    # This is done each time because the overall script takes longer to run than the token is good for
-    result = subprocess.run(['cf', 'oauth-token'], stdout=subprocess.PIPE)
-    token = result.stdout
-    token = token[:-1] # Need to trim the newline character at the end 
-   
-
-    headers = CaseInsensitiveDict()
-    headers["Accept"] = "application/json"
-    headers["Authorization"] = token
-
-    service_instance_url = "https://api." + system_domain + "/v3/service_instances/" + instance_id
-    service_instance_vars = requests.get(service_instance_url, headers=headers, verify=False).json()
-    
-    # Try/except because the org id might not exist for the CF environment targeted (typically dev/staging).  
-    try:
-        instance_name = service_instance_vars["name"]
-
-        space_url = service_instance_vars["links"]["space"]["href"]
-        space_vars = requests.get(space_url, headers=headers, verify=False).json()
-        space_name = space_vars["name"]
-
-        org_url = space_vars["links"]["organization"]["href"]
-        org_vars = requests.get(org_url, headers=headers, verify=False).json()
-        org_name = org_vars["name"]
-
-    except:
-        org_name="NOTFOUND"
-        space_name="NOTFOUND"
-        instance_name="NOTFOUND"
-    return org_name, space_name, instance_name
+from datetime import datetime, timedelta, timezone
 
-def export_idle_redis():
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+import cf_owners
+import metric_store
 
-    # Set defaults 
-    num_days_history = os.getenv('NUM_DAYS', 30)
-    show_all = os.getenv('SHOW_ALL', False )
-    comma = ","
+HEADER_ROW = ("cluster_id", "node_type", "engine", "engine_version", "status", "instance_guid", "cluster_max_curr_items", "org_name", "space_name", "instance_name")
 
-    # Set history
-    start_time = datetime.now() - timedelta(days=int(num_days_history))
-    end_time = datetime.now()
-    cluster_max_curr_items = 0
 
-    cloudwatch_client = boto3.client('cloudwatch', region_name='us-gov-west-1')
-    ec_client = boto3.client('elasticache')
+# The scope the metric store keeps this account and region's metrics under, the same "account/region" the sweep uses
+def default_metric_scope(cloudwatch_client):
+    region = cloudwatch_client.meta.region_name
+    account_id = boto3.client('sts', region_name=region).get_caller_identity()['Account']
+    return f"{account_id}/{region}"
 
-    # Print header
-    print( "cluster_id, node_type, engine, engine_version, status, instance_guid, cluster_max_curr_items, org_name, space_name, instance_name")
+# Scan the Redis clusters of one account and region, returning a HEADER_ROW shaped row for each idle one (or every one with show_all).
+# metric_scope tells apart the accounts and regions sharing the local metric store, the default is the account and region of the cloudwatch client
+def scan_idle_redis(ec_client, cloudwatch_client, num_days_history, show_all, metric_scope=None):
 
+    # Set history
+    start_time = datetime.now(tz=timezone.utc) - timedelta(days=num_days_history)
+    end_time = datetime.now(tz=timezone.utc)
+    rows = []
 
     # Note this loops through each Redis node, not the cluster.  For cluster only, switch to `describe_replication_groups`
     paginator = ec_client.get_paginator('describe_cache_clusters').paginate()
-    last_cluster_id = ""
 
+    # Collect every node first so their metrics can be pulled in batches.  The metric store only pulls what it has not
+    # seen yet from CloudWatch, up to 500 nodes per GetMetricData request
+    cluster_nodes = []
     for page in paginator:
-        for cluster_node in page['CacheClusters']:
-            cluster_node_id = cluster_node['CacheClusterId']
-            cluster_id = cluster_node_id[:-4]
-            node_type = cluster_node['CacheNodeType']
-            engine = cluster_node['Engine']
-            engine_version = cluster_node['EngineVersion']
-            status = cluster_node['CacheClusterStatus']
-            instance_guid = cluster_node_id[4:-4]
-
-            ec_metrics = cloudwatch_client.get_metric_statistics(
-                Namespace='AWS/ElastiCache',
-                MetricName='CurrItems',
-                Dimensions=[
-                    {
-                        'Name': 'CacheClusterId',
-                        'Value': cluster_node_id
-                    }
-                ],
-                StartTime= start_time,
-                EndTime= end_time,
-                Period= 86400,  
-                Statistics=[
-                    'Maximum',
-                ]
-            )
-
-            # Find the highwater mark of "Current Items", per day, for each cluster node and aggregate for the whole cluster
+        cluster_nodes.extend(page['CacheClusters'])
+
+    store = metric_store.get_metric_store()
+    scope = metric_scope or default_metric_scope(cloudwatch_client)
+    node_series = {
+        cluster_node['CacheClusterId']: metric_store.Series(
+            scope,
+            'AWS/ElastiCache',
+            'CurrItems',
+            (('CacheClusterId', cluster_node['CacheClusterId']),),
+            'Maximum',
+            86400
+        )
+        for cluster_node in cluster_nodes
+    }
+    failed = store.update(cloudwatch_client, node_series.values(), start_time, end_time)
+
+    # Group the nodes by cluster, keeping the order they were listed in
+    clusters = {}
+    for cluster_node in cluster_nodes:
+        clusters.setdefault(cluster_node['CacheClusterId'][:-4], []).append(cluster_node)
+
+    for cluster_id, nodes in clusters.items():
+        cluster_node = nodes[0]
+        node_type = cluster_node['CacheNodeType']
+        engine = cluster_node['Engine']
+        engine_version = cluster_node['EngineVersion']
+        status = cluster_node['CacheClusterStatus']
+        instance_guid = cluster_node['CacheClusterId'][4:-4]
+
+        # Find the highwater mark of "Current Items", per day, for each cluster node and aggregate for the whole cluster.
+        # A cluster with any node whose metrics could not be pulled is reported as -1
+        cluster_max_curr_items = 0
+        cluster_failed = False
+        for node in nodes:
+            cluster_node_id = node['CacheClusterId']
+            if node_series[cluster_node_id] in failed:
+                print(f'Could not pull cloudwatch metrics, setting value to -1: {cluster_node_id}', file=sys.stderr)
+                cluster_failed = True
+                continue
             node_max_curr_items = 0
-            for es_metric in ec_metrics['Datapoints']:
-                curr_items = es_metric['Maximum']
+            for curr_items in store.values(node_series[cluster_node_id], start_time, end_time):
                 if curr_items > node_max_curr_items:
                     node_max_curr_items = curr_items
             cluster_max_curr_items = cluster_max_curr_items + node_max_curr_items
+        if cluster_failed:
+            cluster_max_curr_items = -1
 
+        if show_all or cluster_max_curr_items == 0.0:
+            org_name, space_name, instance_name = cf_owners.get_service_instance_owner(instance_guid)  #Only lookup org/space name if needed because of performance hit
+            rows.append((cluster_id, node_type, engine, engine_version, status, instance_guid, cluster_max_curr_items, org_name, space_name, instance_name))
 
-            if last_cluster_id != cluster_id:
+    return rows
 
-                # Got to the last node in the cluster
-                org_name = space_name = instance_name = ""
+def export_idle_redis():
 
-                if show_all or cluster_max_curr_items == 0.0:
-                    org_name, space_name, instance_name = get_org_space_service_instance(instance_guid)  #Only lookup org/space name if needed because of performance hit
-                    print(cluster_id, comma, node_type, comma, engine, comma, engine_version, comma, status, comma, instance_guid, comma, cluster_max_curr_items, comma, org_name, comma, space_name, comma, instance_name)
-                cluster_max_curr_items = 0
-                last_cluster_id = cluster_id
+    # Set defaults 
+    num_days_history = int(os.getenv('NUM_DAYS', 30))
+    show_all = os.getenv('SHOW_ALL', False )
+    comma = ","
+
+    cloudwatch_client = boto3.client('cloudwatch', region_name='us-gov-west-1')
+    ec_client = boto3.client('elasticache')
+
+    rows = scan_idle_redis(ec_client, cloudwatch_client, num_days_history, show_all)
+
+    # Print header
+    print(", ".join(HEADER_ROW))
+    for row in rows:
+        print(*row, sep=" " + comma + " ")
 
 
 def main():
@@ -0,0 +1,213 @@
+# Purpose: Run the unused RDS, Elasticsearch/OpenSearch and Redis scans across several AWS profiles and regions at
+#          once and merge their results into one CSV or JSONL file
+# Prerequisites:
+#  - AWS profiles (e.g. from aws-vault or ~/.aws/config) for every account to sweep
+#  - `cf login` into production CF
+# Usage: python3 aws-sweep-idle-resources.py --profiles gov-prod gov-stage --regions us-gov-west-1 us-gov-east-1 -o idle.jsonl
+# Environment variables:
+#  - METRIC_STORE: Where CloudWatch metric history is kept between runs, default is ~/.cache/cg-scripts/metrics.sqlite3
+#  - SYSTEM_DOMAIN: CF system domain, e.g. "fr.cloud.gov", default is the CF API targeted by `cf login`
+#
+# Every (profile, region, service) scan runs on one shared pool of workers.  The calls each scan makes to an AWS
+# service are held to a budget of requests per second, per account and region since that is how AWS throttles them,
+# and throttled calls are retried with botocore's adaptive retry mode.
+
+import argparse
+import csv
+import importlib.util
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
+
+SERVICES = ("rds", "es", "redis")
+
+# AWS API calls per second allowed per account and region, by the service name boto3 uses
+DEFAULT_BUDGETS = {
+    "rds": 10,
+    "opensearch": 5,
+    "elasticache": 10,
+    "cloudwatch": 10,
+}
+
+BOTO_CONFIG = Config(retries={"mode": "adaptive", "max_attempts": 10}, max_pool_connections=16)
+
+COMMON_FIELDS = ("Profile", "Region", "Service")
+
+# Threads each Elasticsearch scan uses for its own describe and metrics calls.  Kept small since every scan already
+# runs on the sweep's pool of workers, and the AWS calls are held to the rate budgets anyway.
+SCAN_WORKERS = 2
+
+
+def load_script(file_name):
+    spec = importlib.util.spec_from_file_location(
+        file_name.replace("-", "_")[:-3],
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), file_name),
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+rds_script = load_script("aws-list-unused-rds-databases.py")
+es_script = load_script("aws-list-unused-es-domains.py")
+redis_script = load_script("aws-list-unused-redis-clusters.py")
+
+
+class RateBudget:
+    """
+    Token bucket shared by every client of one service in one account and region
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, **kwargs):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class Target:
+    """
+    The clients of one profile and region.  Clients are created up front on the main thread, since boto3 sessions are
+    not thread-safe, and then shared by the scans of the target.
+    """
+
+    def __init__(self, profile, region, budgets):
+        self.profile = profile
+        self.region = region
+        self.session = boto3.Session(profile_name=profile, region_name=region)
+        self.clients = {}
+        for service_name in DEFAULT_BUDGETS:
+            client = self.session.client(service_name, config=BOTO_CONFIG)
+            client.meta.events.register("before-call", RateBudget(budgets[service_name]).acquire)
+            self.clients[service_name] = client
+
+        self.account_id = self.session.client("sts", config=BOTO_CONFIG).get_caller_identity()["Account"]
+
+    @property
+    def metric_scope(self):
+        return f"{self.account_id}/{self.region}"
+
+    @property
+    def name(self):
+        return f"{self.profile or 'default'}/{self.region}"
+
+    def scan(self, service, num_days_history, show_all):
+        """
+        Returns (header row, rows) of one service's scan
+        """
+        cloudwatch_client = self.clients["cloudwatch"]
+        if service == "rds":
+            rows = rds_script.scan_idle_dbs(self.clients["rds"], cloudwatch_client, num_days_history, show_all, self.metric_scope)
+            return rds_script.HEADER_ROW, rows
+        if service == "es":
+            rows = es_script.scan_domains(self.clients["opensearch"], cloudwatch_client, self.account_id, show_all, SCAN_WORKERS)
+            return es_script.HEADER_ROW, rows
+        rows = redis_script.scan_idle_redis(self.clients["elasticache"], cloudwatch_client, num_days_history, show_all, self.metric_scope)
+        return redis_script.HEADER_ROW, rows
+
+
+def parse_budgets(values):
+    budgets = dict(DEFAULT_BUDGETS)
+    for value in values:
+        service_name, _, rate = value.partition("=")
+        if service_name not in budgets or not rate:
+            raise argparse.ArgumentTypeError(f"expected one of {', '.join(budgets)}=RATE, got {value}")
+        budgets[service_name] = float(rate)
+    return budgets
+
+
+def write_results(output_file, results):
+    """
+    Writes the rows of every scan, tagged with where they came from, as JSON lines or as one CSV whose columns are
+    the union of the scans' columns
+    """
+    records = []
+    fields = list(COMMON_FIELDS)
+    for (target, service), (header_row, rows) in results:
+        fields.extend(field for field in header_row if field not in fields)
+        for row in rows:
+            records.append({"Profile": target.profile or "default", "Region": target.region, "Service": service, **dict(zip(header_row, row))})
+
+    with open(output_file, "w", newline="") as f:
+        if output_file.endswith(".jsonl"):
+            for record in records:
+                f.write(json.dumps(record, default=str) + "\n")
+        else:
+            writer = csv.DictWriter(f, fieldnames=fields, restval="")
+            writer.writeheader()
+            writer.writerows(records)
+
+    return len(records)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sweep several AWS accounts and regions for unused brokered resources")
+    parser.add_argument("--profiles", nargs="+", default=[None], help="AWS profiles to sweep, default is the default credential chain")
+    parser.add_argument("--regions", nargs="+", default=["us-gov-west-1"], help="Regions to sweep, default is us-gov-west-1")
+    parser.add_argument("--services", nargs="+", choices=SERVICES, default=list(SERVICES), help="Scans to run, default is all of them")
+    parser.add_argument("-o", "--output", default="idle_resources.csv", help="Output file, written as JSON lines if it ends in .jsonl, CSV otherwise")
+    parser.add_argument("--num-days", type=int, default=30, help="Number of days of no activity for RDS and Redis, default is 30")
+    parser.add_argument("--show-all", action="store_true", help="Emit results for ALL resources, not just unused ones")
+    parser.add_argument("-w", "--workers", type=int, default=8, help="Number of scans run at the same time, default is 8")
+    parser.add_argument("--budget", action="append", default=[], metavar="SERVICE=RATE", help=f"AWS API calls per second per account and region, defaults are {DEFAULT_BUDGETS}")
+    args = parser.parse_args()
+
+    try:
+        budgets = parse_budgets(args.budget)
+    except argparse.ArgumentTypeError as e:
+        parser.error(str(e))
+
+    failed = False
+    targets = []
+    for profile in args.profiles:
+        for region in args.regions:
+            try:
+                targets.append(Target(profile, region, budgets))
+            except (BotoCoreError, ClientError) as e:
+                print(f"Could not set up {profile or 'default'}/{region}, skipping it: {e}", file=sys.stderr)
+                failed = True
+
+    results = []
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = {
+            (target, service): executor.submit(target.scan, service, args.num_days, args.show_all)
+            for target in targets
+            for service in args.services
+        }
+        for (target, service), future in futures.items():
+            try:
+                results.append(((target, service), future.result()))
+                print(f"Scanned {service} in {target.name}", file=sys.stderr)
+            # Any one scan failing, e.g. on a CF lookup, must not lose the results of the others
+            except Exception as e:
+                print(f"Could not scan {service} in {target.name}: {e}", file=sys.stderr)
+                failed = True
+
+    count = write_results(args.output, results)
+    print(f"{count} resources written to: {args.output}", file=sys.stderr)
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+import unittest
+from unittest.mock import MagicMock, patch
+import importlib.util
+import io
+import os
+import tempfile
+
+
+def load_script(file_name):
+    spec = importlib.util.spec_from_file_location(
+        file_name.replace("-", "_")[:-3],
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), file_name),
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+rds_upgrades = load_script("aws-list-rds-databases-needing-upgrades.py")
+rds_script = load_script("aws-list-unused-rds-databases.py")
+redis_script = load_script("aws-list-unused-redis-clusters.py")
+
+
+RULE_ACTIONS = """
+    actions:
+      both: {0} both
+      instance: {0} instance
+      engine: {0} engine
+"""
+
+
+class TestUpgradeRules(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def write_rules(self, text) -> str:
+        path = os.path.join(self.tmpdir.name, "rules.yaml")
+        with open(path, "w") as rules_file:
+            rules_file.write(text)
+        return path
+
+    @patch("sys.stdout", new_callable=io.StringIO)
+    def test_bundled_rules(self, _):
+        rules = rds_upgrades.UpgradeRules()
+        cases = [
+            (("postgres", "15.4", "db.m5", "customer-db"), "ok"),
+            (("mysql", "8.4.3", "db.t3", "customer-db"), "ok"),
+            (("redis", "6.0", "db.t3", "customer-db"), "ok"),
+            (
+                ("postgres", "12.4", "db.t2", "bosh-x"),
+                "Give to platform, needs both engine upgrade and instance upgrade, likely terraform but need to track down",
+            ),
+            (
+                ("mysql", "8.0.35", "db.m5", "cg-aws-broker-devabc"),
+                "Give to platform, needs engine upgrade, is AWS broker dev broker",
+            ),
+            (
+                ("postgres", "16.1", "db.m4", "cg-aws-broker-stage-x"),
+                "Give to platform, needs intance upgrade, is AWS broker staging broker",
+            ),
+            (
+                ("postgres", "16.1", "db.t2", "production-cf"),
+                "Give to platform, needs instance upgrade, likely terraform created in cg-provision main stack for production",
+            ),
+            (
+                ("postgres", "13.7", "db.m5", "tooling-concourse"),
+                "Give to platform, needs engine upgrade, likely terraform created in cg-provision main stack for tooling",
+            ),
+            (
+                ("postgres", "9.6", "db.m5", "cg-aws-broker-prod-x"),
+                "Customer database which needs engine upgrade",
+            ),
+            (
+                ("mysql", "5.7", "db.t2", "terraform-x"),
+                "Give to platform, needs both engine upgrade and instance upgrade, likely terraform but need to track down",
+            ),
+        ]
+        for args, action in cases:
+            with self.subTest(args=args):
+                self.assertEqual(rules.classify(*args)[0], action)
+
+    def test_first_matching_rule_wins(self):
+        path = self.write_rules(
+            "outdated_instance_families: [db.t2]\nrules:\n"
+            + "  - name: long\n    name_prefix: staging-db-"
+            + RULE_ACTIONS.format("long")
+            + "  - name: short\n    name_prefix: staging-"
+            + RULE_ACTIONS.format("short")
+            + "  - name: shorter\n    name_prefix: stag"
+            + RULE_ACTIONS.format("shorter")
+            + "  - name: default"
+            + RULE_ACTIONS.format("default")
+        )
+        rules = rds_upgrades.UpgradeRules(path)
+        self.assertEqual(rules.match_rule("staging-db-1")["name"], "long")
+        self.assertEqual(rules.match_rule("staging-app")["name"], "short")
+        self.assertEqual(rules.match_rule("stage")["name"], "shorter")
+        self.assertEqual(rules.match_rule("production-db")["name"], "default")
+
+        action, reasons = rules.classify("postgres", "16", "db.t2", "staging-app")
+        self.assertEqual(action, "short instance")
+        self.assertEqual(reasons, ["instance family db.t2 is outdated", "rule short (instance)"])
+
+    def test_earlier_shorter_prefix_wins(self):
+        path = self.write_rules(
+            "rules:\n"
+            + "  - name: short\n    name_prefix: staging-"
+            + RULE_ACTIONS.format("short")
+            + "  - name: long\n    name_prefix: staging-db-"
+            + RULE_ACTIONS.format("long")
+            + "  - name: default"
+            + RULE_ACTIONS.format("default")
+        )
+        rules = rds_upgrades.UpgradeRules(path)
+        self.assertEqual(rules.match_rule("staging-db-1")["name"], "short")
+
+    def test_requires_every_action(self):
+        path = self.write_rules(
+            "rules:\n  - name: partial\n    actions:\n      both: x\n      engine: y\n"
+        )
+        with self.assertRaisesRegex(ValueError, "partial .* no action for: instance"):
+            rds_upgrades.UpgradeRules(path)
+
+    def test_requires_default_rule(self):
+        path = self.write_rules(
+            "rules:\n  - name: bosh\n    name_prefix: bosh-" + RULE_ACTIONS.format("bosh")
+        )
+        with self.assertRaisesRegex(ValueError, "no default rule"):
+            rds_upgrades.UpgradeRules(path)
+
+    def test_requires_rule_name(self):
+        path = self.write_rules("rules:\n  - name_prefix: bosh-" + RULE_ACTIONS.format("bosh"))
+        with self.assertRaisesRegex(ValueError, "Rule 0 .* has no name"):
+            rds_upgrades.UpgradeRules(path)
+
+
+class TestDefaultMetricScope(unittest.TestCase):
+    @patch("boto3.client")
+    def test_scopes_metrics_by_account_and_region(self, mock_client):
+        mock_client.return_value.get_caller_identity.return_value = {
+            "Account": "123456789012"
+        }
+        cloudwatch_client = MagicMock()
+        cloudwatch_client.meta.region_name = "us-gov-east-1"
+
+        for script in (rds_script, redis_script):
+            with self.subTest(script=script.__name__):
+                self.assertEqual(
+                    script.default_metric_scope(cloudwatch_client),
+                    "123456789012/us-gov-east-1",
+                )
+        mock_client.assert_called_with("sts", region_name="us-gov-east-1")
+
+
+def cache_node(cluster_node_id) -> dict:
+    return {
+        "CacheClusterId": cluster_node_id,
+        "CacheNodeType": "cache.t3.micro",
+        "Engine": "redis",
+        "EngineVersion": "7.0",
+        "CacheClusterStatus": "available",
+    }
+
+
+class TestScanIdleRedis(unittest.TestCase):
+    def scan(self, curr_items, failed_node_ids):
+        ec_client = MagicMock()
+        ec_client.get_paginator.return_value.paginate.return_value = [
+            {"CacheClusters": [cache_node(node_id) for node_id in curr_items]}
+        ]
+        store = MagicMock()
+        store.update.side_effect = lambda client, series_list, start, end: {
+            series for series in series_list if series.dimensions[0][1] in failed_node_ids
+        }
+        store.values.side_effect = lambda series, start, end: curr_items[series.dimensions[0][1]]
+
+        with patch.object(redis_script.metric_store, "get_metric_store", return_value=store), patch.object(
+            redis_script.cf_owners, "get_service_instance_owner", return_value=("org", "space", "instance")
+        ), patch("sys.stderr"):
+            rows = redis_script.scan_idle_redis(ec_client, MagicMock(), 30, True, "123456789012/us-gov-west-1")
+        return {row[0]: row[6] for row in rows}
+
+    def test_sums_nodes_per_cluster(self):
+        totals = self.scan(
+            {"cg-a-001": [0, 3], "cg-a-002": [1], "cg-b-001": [0], "cg-b-002": [0]}, set()
+        )
+        self.assertEqual(totals, {"cg-a": 4, "cg-b": 0})
+
+    def test_reports_clusters_with_failed_nodes_as_failed(self):
+        totals = self.scan(
+            {"cg-a-001": [1], "cg-a-002": [5], "cg-b-001": [], "cg-b-002": [], "cg-c-001": [2]},
+            {"cg-a-002", "cg-b-001", "cg-b-002"},
+        )
+        self.assertEqual(totals, {"cg-a": -1, "cg-b": -1, "cg-c": 2})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -3,17 +3,283 @@
 import subprocess
 import sys
 import os.path
-import json
 import boto3
 import datetime
-import functools
-import urllib.parse
-from collections import Counter
-from openpyxl import load_workbook
+import gzip
+import io
+import json
+import tempfile
+from botocore.config import Config
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from openpyxl import Workbook, load_workbook
 import argparse
 import math
 import re
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+import cf_api
+from cf_names import NOT_FOUND, get_cf_entity_name, get_service_plan_names
+from json_stream import open_json
+
+# Number of organizations collected at the same time
+ORG_WORKERS = 8
+
+# Number of CF and AWS lookups in flight at the same time, shared by all orgs
+LOOKUP_WORKERS = 16
+
+# Most DB instances the db-instance-id filter of describe_db_instances takes
+RDS_DESCRIBE_FILTER_SIZE = 100
+
+# Most domains describe_elasticsearch_domains accepts in one call
+ES_DESCRIBE_BATCH_SIZE = 5
+
+# Most metrics GetMetricData accepts in one request
+METRIC_DATA_BATCH_SIZE = 500
+
+# Bumped whenever the layout of --snapshot files changes
+SNAPSHOT_VERSION = 1
+
+# Collected org data saved in snapshots, besides the org's resources
+ORG_SNAPSHOT_FIELDS = [
+    "name",
+    "space_names",
+    "guid",
+    "quota_guid",
+    "space_guid_map",
+    "space_guids",
+    "memory_quota",
+    "memory_usage",
+    "memory_usage_by_space",
+]
+
+# Plan name counted for resources whose service instance cannot be found
+PLAN_NOT_FOUND = "Not_Found"
+
+# Resource types of the brokered services in the tagging API
+RESOURCE_TYPES = {
+    "rds": "rds:db",
+    "redis": "elasticache:replicationgroup",
+    "es": "es:domain",
+    "s3": "s3:bucket",
+}
+
+# Spellings of the org and space tags used by the different brokers, in order
+# of preference.  Only S3 buckets carry the alternate spellings; the other
+# resources are always tagged with the first one, along with "Instance GUID"
+ORG_TAG_KEYS = ["Organization GUID", "Organization ID", "organizationGuid"]
+SPACE_TAG_KEYS = ["Space GUID", "Space ID", "spaceGuid"]
+
+
+def chunks(items, size):
+    return [items[i : i + size] for i in range(0, len(items), size)]
+
+
+def describe_db_instances(client, arns):
+    """
+    Describes a batch of DB instances, returning them by ARN
+    """
+    paginator = client.get_paginator("describe_db_instances")
+    pages = paginator.paginate(Filters=[{"Name": "db-instance-id", "Values": arns}])
+    return {
+        db_instance["DBInstanceArn"]: db_instance
+        for page in pages
+        for db_instance in page["DBInstances"]
+    }
+
+
+def describe_es_domains(client, domain_names):
+    """
+    Describes a batch of Elasticsearch domains, returning them by domain name
+    """
+    response = client.describe_elasticsearch_domains(DomainNames=domain_names)
+    return {
+        domain_status["DomainName"]: domain_status
+        for domain_status in response["DomainStatusList"]
+    }
+
+
+def list_bucket_size_metrics(client, bucket_names):
+    """
+    Returns the (bucket name, storage type) pairs that have a BucketSizeBytes
+    metric, i.e. every storage class each of the buckets uses
+    """
+    paginator = client.get_paginator("list_metrics")
+    pages = paginator.paginate(Namespace="AWS/S3", MetricName="BucketSizeBytes")
+    metrics = []
+    for page in pages:
+        for metric in page["Metrics"]:
+            dimensions = {
+                dimension["Name"]: dimension["Value"]
+                for dimension in metric["Dimensions"]
+            }
+            if dimensions.get("BucketName") in bucket_names:
+                metrics.append((dimensions["BucketName"], dimensions["StorageType"]))
+    return metrics
+
+
+def get_bucket_sizes(client, metrics):
+    """
+    Fetches the latest BucketSizeBytes of a batch of (bucket name, storage
+    type) pairs with one GetMetricData request, returning
+    {bucket name: {storage type: bytes}}
+    """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    queries = [
+        {
+            "Id": f"m{index}",
+            "MetricStat": {
+                "Metric": {
+                    "Namespace": "AWS/S3",
+                    "MetricName": "BucketSizeBytes",
+                    "Dimensions": [
+                        {"Name": "BucketName", "Value": bucket_name},
+                        {"Name": "StorageType", "Value": storage_type},
+                    ],
+                },
+                "Period": 86400,
+                "Stat": "Average",
+                "Unit": "Bytes",
+            },
+        }
+        for index, (bucket_name, storage_type) in enumerate(metrics)
+    ]
+
+    sizes = {}
+    paginator = client.get_paginator("get_metric_data")
+    pages = paginator.paginate(
+        MetricDataQueries=queries,
+        # The metric is published once a day, so look back far enough to
+        # always find the latest datapoint
+        StartTime=now - datetime.timedelta(days=2),
+        EndTime=now,
+        ScanBy="TimestampDescending",
+    )
+    for page in pages:
+        for result in page["MetricDataResults"]:
+            if len(result["Values"]) == 0:
+                continue
+            bucket_name, storage_type = metrics[int(result["Id"][1:])]
+            sizes.setdefault(bucket_name, {}).setdefault(
+                storage_type, result["Values"][0]
+            )
+    return sizes
+
+
+class S3SizeCache:
+    """
+    BucketSizeBytes is only updated once a day, so bucket sizes are kept on
+    disk for the (UTC) day they were fetched, and re-running an estimate on
+    the same day costs no CloudWatch calls
+    """
+
+    def __init__(self, path=None, day=None):
+        cache_home = os.getenv("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
+        self.path = path or os.path.join(
+            cache_home, "cg-scripts", "s3-bucket-sizes.json"
+        )
+        today = datetime.datetime.now(datetime.timezone.utc).date()
+        self.day = day or today.isoformat()
+        self.sizes = self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as cache_file:
+                data = json.load(cache_file)
+        except (OSError, ValueError):
+            return {}
+        if data.get("day") != self.day:
+            return {}
+        return data.get("buckets", {})
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            "w", dir=os.path.dirname(self.path), suffix=".tmp", delete=False
+        ) as cache_file:
+            json.dump({"day": self.day, "buckets": self.sizes}, cache_file)
+        os.replace(cache_file.name, self.path)
+
+
+def first_tag_value(tags, keys):
+    for key in keys:
+        if key in tags:
+            return tags[key]
+    return None
+
+
+class TagIndex:
+    """
+    Every tagged brokered resource in the account, from a single scan of the
+    tagging API, indexed by (org GUID, space GUID, resource type) so looking
+    up the resources of an org or space never calls AWS again
+    """
+
+    def __init__(self, client):
+        self.resources = defaultdict(list)
+        self.space_guids = defaultdict(set)
+
+        type_names = {value: key for key, value in RESOURCE_TYPES.items()}
+        paginator = client.get_paginator("get_resources")
+        pages = paginator.paginate(
+            ResourceTypeFilters=list(RESOURCE_TYPES.values()), ResourcesPerPage=100
+        )
+
+        position = 0
+        for page in pages:
+            for resource in page["ResourceTagMappingList"]:
+                resource_type = self.resource_type(resource["ResourceARN"], type_names)
+                if resource_type is None:
+                    continue
+                tags = {tag["Key"]: tag["Value"] for tag in resource["Tags"]}
+                if resource_type == "s3":
+                    org_tag_keys, space_tag_keys = ORG_TAG_KEYS, SPACE_TAG_KEYS
+                else:
+                    org_tag_keys, space_tag_keys = ORG_TAG_KEYS[:1], SPACE_TAG_KEYS[:1]
+                org_guid = first_tag_value(tags, org_tag_keys)
+                if org_guid is None:
+                    continue
+                space_guid = first_tag_value(tags, space_tag_keys)
+
+                self.resources[(org_guid, space_guid, resource_type)].append(
+                    (position, resource)
+                )
+                self.space_guids[(org_guid, resource_type)].add(space_guid)
+                position += 1
+
+    @staticmethod
+    def resource_type(arn, type_names):
+        # e.g. arn:aws-us-gov:rds:us-gov-west-1:123:db:name is "rds:db" and
+        # arn:aws-us-gov:s3:::bucket is "s3:bucket"
+        parts = arn.split(":")
+        service = parts[2]
+        if service == "s3":
+            return type_names.get("s3:bucket")
+        resource = parts[5].split("/")[0] if len(parts) > 5 else ""
+        return type_names.get(service + ":" + resource)
+
+    def get_resources(self, org_guid, space_guids, resource_type):
+        """
+        Returns the resources of a type in an org, limited to some spaces if
+        any are given, in the order the tagging API listed them
+        """
+        if len(space_guids) == 0:
+            space_guids = self.space_guids[(org_guid, resource_type)]
+        resources = []
+        for space_guid in space_guids:
+            resources.extend(
+                self.resources.get((org_guid, space_guid, resource_type), [])
+            )
+        return [resource for _, resource in sorted(resources, key=lambda r: r[0])]
+
+
+def warn_not_found(resource_type, arn):
+    print(
+        f"Warning: {resource_type} {arn} was not found, counting it as empty",
+        file=sys.stderr,
+    )
+
+
 class AWSResource:
     def __init__(self, arn, tags):
         self.arn = arn
@@ -22,25 +288,20 @@ class AWSResource:
             self.instance_id = arn.split(":")[-1]
         else:
             self.instance_id = "Unknown"
+        # Resolved for all resources at once, see Account.resolve_plan_names
+        self.service_plan_name = PLAN_NOT_FOUND
 
-    def get_instance_plan_name(self, instance_guid):
-        cf_json = subprocess.check_output(
-            "cf curl /v3/service_instances/"
-            + instance_guid
-            + "/?fields[service_plan]=name",
-            universal_newlines=True,
-            shell=True,
-        )
-        cf_data = json.loads(cf_json)
-        return cf_data.get("included", "N/A")["service_plans"][0]["name"]
+    def to_snapshot(self):
+        return dict(vars(self))
 
-    def get_service_plan_name(self, instance_guid):
-        service_plan_name = "Not_Found"
-        try:
-            service_plan_name = self.get_instance_plan_name(instance_guid)
-        except:
-            service_plan_name = "Not_Found"
-        return service_plan_name
+    @classmethod
+    def from_snapshot(cls, data):
+        """
+        Rebuilds a resource from a snapshot without calling CF or AWS
+        """
+        resource = cls.__new__(cls)
+        vars(resource).update(data)
+        return resource
 
 
 class AWSNotS3(AWSResource):
@@ -57,33 +318,18 @@ class AWSNotS3(AWSResource):
                 tag["Value"] for tag in tags if tag["Key"] == "Space name"
             ][0]
         except:
-            self.space_name = self.get_cf_entity_name("spaces", self.space_guid)
-
-        self.service_plan_name = super().get_service_plan_name(self.instance_guid)
-
-    @functools.cache
-    def get_cf_entity_name(self, entity, guid):
-        """
-        Retrieves the name of a CF entity from a GUID.
-        """
-        if not guid:
-            return
-        cf_json = subprocess.check_output(
-            "cf curl /v3/" + entity + "/" + guid,
-            universal_newlines=True,
-            shell=True,
-        )
-        cf_data = json.loads(cf_json)
-        return cf_data.get("name", "N/A")
+            self.space_name = get_cf_entity_name("spaces", self.space_guid)
 
 
 class Rds(AWSNotS3):
     def __init__(self, arn, tags):
         super().__init__(arn, tags)
 
-    def get_db_instance(self, client):
-        response = client.describe_db_instances(DBInstanceIdentifier=self.arn)
-        instance_info = response["DBInstances"][0]
+    def set_db_instance(self, instance_info):
+        if instance_info is None:
+            warn_not_found("RDS instance", self.arn)
+            self.allocated_storage = 0
+            return
         self.allocated_storage = instance_info["AllocatedStorage"]
 
 
@@ -96,10 +342,15 @@ class Es(AWSNotS3):
     def __init__(self, arn, tags):
         super().__init__(arn, tags)
 
-    def get_es_instance(self, client):
-        es_domain_name = self.arn.split("/")[1]
-        response = client.describe_elasticsearch_domain(DomainName=es_domain_name)
-        domain_status = response["DomainStatus"]
+    @property
+    def domain_name(self):
+        return self.arn.split("/")[1]
+
+    def set_es_domain(self, domain_status):
+        if domain_status is None:
+            warn_not_found("ES domain", self.arn)
+            self.volume_size = 0
+            return
         ebs_options = domain_status.get("EBSOptions", {})
         self.volume_size = ebs_options.get("VolumeSize", 0)
 
@@ -109,44 +360,46 @@ class S3(AWSResource):
         super().__init__(arn, tags)
         self.bucket_name = self.instance_id
         self.instance_guid = re.sub(r"^cg-", "", self.bucket_name)
-        self.service_plan_name = super().get_service_plan_name(self.instance_guid)
-
-    def get_s3_usage(self, client):
-        now = datetime.datetime.now()
-        response = client.get_metric_statistics(
-            Namespace="AWS/S3",
-            MetricName="BucketSizeBytes",
-            Dimensions=[
-                {"Name": "BucketName", "Value": self.bucket_name},
-                {
-                    "Name": "StorageType",
-                    "Value": "StandardStorage",
-                },
-            ],
-            Statistics=["Average"],
-            Period=86400,
-            StartTime=now - datetime.timedelta(days=1),
-            EndTime=now,
-            Unit="Bytes",
-        )
-        self.s3_usage = 0
-        datapoints = response["Datapoints"]
-        if len(datapoints) > 0:
-            self.s3_usage = datapoints[0]["Average"]
+
+    def set_s3_usage(self, sizes_by_storage_type):
+        self.s3_usage_by_storage_type = sizes_by_storage_type
+        self.s3_usage = sum(sizes_by_storage_type.values())
+
+
+class AWSClients:
+    """
+    boto3 clients shared by every collection thread.  Clients are thread-safe
+    but creating them is not, so they are all created up front.
+    """
+
+    def __init__(self, max_pool_connections=LOOKUP_WORKERS):
+        config = Config(max_pool_connections=max_pool_connections)
+        self.resource_tags = boto3.client("resourcegroupstaggingapi", config=config)
+        self.rds = boto3.client("rds", config=config)
+        self.es = boto3.client("es", config=config)
+        self.cloudwatch = boto3.client("cloudwatch", config=config)
 
 
 class Organization:
-    def __init__(self, name, space_names):
+    """
+    CF and AWS usage for an organization.  Independent lookups are fanned out
+    on the executor, which must only be given tasks that never wait on other
+    tasks of the same executor.
+    """
+
+    def __init__(self, name, space_names, executor):
         self.name = name
         self.space_names = space_names
+        self.executor = executor
         self.data = self.get_data()
         self.guid = self.data["guid"]
+        self.quota_guid = self.data["relationships"]["quota"]["data"]["guid"]
+        memory_quota = self.executor.submit(self.get_memory_quota)
         self.space_guid_map = self.get_space_guid_map()
         self.space_guids = list(self.space_guid_map.values())
-        self.quota_guid = self.data["relationships"]["quota"]["data"]["guid"]
-        self.memory_quota = self.get_memory_quota()
         self.memory_usage_by_space = []
         self.memory_usage = self.get_memory_usage()
+        self.memory_quota = memory_quota.result()
         self.rds_instances = []
         self.redis_instances = []
         self.es_instances = []
@@ -154,60 +407,117 @@ class Organization:
         self.rds_allocation = 0
         self.s3_storage = 0
 
+    def resource_lists(self):
+        return {
+            "rds_instances": (Rds, self.rds_instances),
+            "redis_instances": (Redis, self.redis_instances),
+            "es_instances": (Es, self.es_instances),
+            "s3_buckets": (S3, self.s3_buckets),
+        }
+
+    def to_snapshot(self):
+        data = {field: getattr(self, field) for field in ORG_SNAPSHOT_FIELDS}
+        for key, (_, resources) in self.resource_lists().items():
+            data[key] = [resource.to_snapshot() for resource in resources]
+        return data
+
+    @classmethod
+    def from_snapshot(cls, data):
+        """
+        Rebuilds a collected org from a snapshot without calling CF or AWS
+        """
+        org = cls.__new__(cls)
+        org.executor = None
+        for field in ORG_SNAPSHOT_FIELDS:
+            setattr(org, field, data[field])
+        org.rds_instances = []
+        org.redis_instances = []
+        org.es_instances = []
+        org.s3_buckets = []
+        org.rds_allocation = 0
+        org.s3_storage = 0
+        for key, (resource_class, resources) in org.resource_lists().items():
+            resources.extend(
+                resource_class.from_snapshot(resource) for resource in data[key]
+            )
+        return org
+
     def get_space_guid_map(self):
         if len(self.space_names) == 0:
             return {}
-        cf_json = subprocess.check_output(
-            f"cf curl \"/v3/spaces?organization_guids={self.guid}&names={','.join(self.space_names)}\"",
-            universal_newlines=True,
-            shell=True,
+        resources = cf_api.get_client().paginate(
+            "/v3/spaces",
+            params={
+                "organization_guids": self.guid,
+                "names": ",".join(self.space_names),
+            },
         )
-        response = json.loads(cf_json)
         space_guid_map = {}
-        for resource in response["resources"]:
+        for resource in resources:
             space_guid_map[resource["name"]] = resource["guid"]
         return space_guid_map
 
     def get_data(self):
-        cf_json = subprocess.check_output(
-            "cf curl /v3/organizations/?names=" + self.name,
-            universal_newlines=True,
-            shell=True,
+        response = cf_api.get_client().get(
+            "/v3/organizations", params={"names": self.name}
         )
-        return json.loads(cf_json)["resources"][0]
+        return response["resources"][0]
 
     def get_memory_quota(self):
-        cf_json = subprocess.check_output(
-            "cf curl /v3/organization_quotas/" + self.quota_guid,
-            universal_newlines=True,
-            shell=True,
-        )
-        return json.loads(cf_json)["apps"]["total_memory_in_mb"]
+        response = cf_api.get_client().get("/v3/organization_quotas/" + self.quota_guid)
+        return response["apps"]["total_memory_in_mb"]
 
     def get_memory_usage(self):
         if len(self.space_names) == 0:
-            cf_json = subprocess.check_output(
-                "cf curl /v3/organizations/" + self.guid + "/usage_summary",
-                universal_newlines=True,
-                shell=True,
+            response = cf_api.get_client().get(
+                "/v3/organizations/" + self.guid + "/usage_summary"
             )
-            return json.loads(cf_json)["usage_summary"]["memory_in_mb"]
+            return response["usage_summary"]["memory_in_mb"]
         else:
             total_memory = 0
-            for space_name in self.space_names:
-                total_space_memory = 0
-                space_guid = self.space_guid_map[space_name]
+            space_guids = [
+                self.space_guid_map[space_name] for space_name in self.space_names
+            ]
+
+            # One listing each for the apps, processes and running tasks of
+            # all the spaces, fetched at the same time
+            apps = self.executor.submit(
+                self.list_space_resources, "/v3/apps", space_guids
+            )
+            processes = self.executor.submit(
+                self.list_space_resources, "/v3/processes", space_guids
+            )
+            tasks = self.executor.submit(
+                self.list_space_resources,
+                "/v3/tasks",
+                space_guids,
+                {"states": "RUNNING"},
+            )
 
-                started_app_memory_usage = self.get_started_app_memory_usage(space_guid)
-                running_task_memory_usage = self.get_running_task_memory_usage(
-                    space_guid
-                )
+            app_space_guids = {}
+            started_app_guids = set()
+            for app in apps.result():
+                app_guid = app["guid"]
+                space_guid = app["relationships"]["space"]["data"]["guid"]
+                app_space_guids[app_guid] = space_guid
+                if app["state"] == "STARTED":
+                    started_app_guids.add(app_guid)
+
+            started_app_memory_usage = self.get_started_app_memory_usage(
+                processes.result(), app_space_guids, started_app_guids
+            )
+            running_task_memory_usage = self.get_running_task_memory_usage(
+                tasks.result(), app_space_guids
+            )
+
+            for space_name, space_guid in zip(self.space_names, space_guids):
+                total_space_memory = 0
 
                 # memory usage for an org and/or space is:
                 #   memory for started applications + memory for running tasks
                 # see https://github.com/cloudfoundry/cloud_controller_ng/blob/a5c0d35b4b59566617ebae8a79a14687e6d9b3b6/app/models/runtime/organization.rb#L231
-                total_space_memory += started_app_memory_usage
-                total_space_memory += running_task_memory_usage
+                total_space_memory += started_app_memory_usage[space_guid]
+                total_space_memory += running_task_memory_usage[space_guid]
 
                 self.memory_usage_by_space.append(
                     {"space_name": space_name, "memory_usage_in_mb": total_space_memory}
@@ -216,78 +526,77 @@ class Organization:
                 total_memory += total_space_memory
             return total_memory
 
-    def get_started_app_memory_usage(self, space_guid):
-        total_started_app_memory_usage = 0
-
-        cf_json = subprocess.check_output(
-            f'cf curl "/v3/apps?organization_guids={self.guid}&space_guids={space_guid}"',
-            universal_newlines=True,
-            shell=True,
-        )
-        response = json.loads(cf_json)
-        started_app_instance_guids = [
-            resource["guid"]
-            for resource in response["resources"]
-            if resource["state"] == "STARTED"
-        ]
-
-        if len(started_app_instance_guids) == 0:
-            return 0
+    def list_space_resources(self, path, space_guids, params=None):
+        """
+        Lists a resource type for all of the given spaces at once
+        """
+        resources = []
+        for space_guids_chunk in cf_api.chunk_guids(space_guids):
+            resources.extend(
+                cf_api.get_client().paginate(
+                    path,
+                    params={
+                        "organization_guids": self.guid,
+                        "space_guids": ",".join(space_guids_chunk),
+                        "per_page": 5000,
+                        **(params or {}),
+                    },
+                )
+            )
+        return resources
 
-        app_guids_filter = ",".join(started_app_instance_guids)
-        cf_json = subprocess.check_output(
-            f'cf curl "/v3/processes?organization_guids={self.guid}&space_guids={space_guid}&app_guids={app_guids_filter}"',
-            universal_newlines=True,
-            shell=True,
-        )
-        response = json.loads(cf_json)
+    def get_started_app_memory_usage(
+        self, processes, app_space_guids, started_app_guids
+    ):
+        """
+        Returns {space guid: MB} used by the processes of started apps
+        """
+        started_app_memory_usage = Counter()
 
-        for resource in response["resources"]:
+        for resource in processes:
+            app_guid = resource["relationships"]["app"]["data"]["guid"]
+            if app_guid not in started_app_guids:
+                continue
             num_instances = resource["instances"]
             memory_per_instance = resource["memory_in_mb"]
             process_memory = num_instances * memory_per_instance
-            total_started_app_memory_usage += process_memory
+            started_app_memory_usage[app_space_guids[app_guid]] += process_memory
 
-        return total_started_app_memory_usage
+        return started_app_memory_usage
 
-    def get_running_task_memory_usage(self, space_guid):
-        total_task_memory = 0
-        cf_json = subprocess.check_output(
-            f'cf curl "/v3/tasks?organization_guids={self.guid}&space_guids={space_guid}&states=RUNNING"',
-            universal_newlines=True,
-            shell=True,
-        )
-        response = json.loads(cf_json)
-        for resource in response["resources"]:
-            total_task_memory += resource["memory_in_mb"]
-        return total_task_memory
-
-    def get_aws_instances(self, client, resource_type):
-        resource_type_map = {
-            "rds": "rds:db",
-            "redis": "elasticache:replicationgroup",
-            "es": "es:domain",
-        }
-        resource_type_filter = [resource_type_map[resource_type]]
-        tag_filters = [{"Key": "Organization GUID", "Values": [self.guid]}]
-        if len(self.space_guids) > 0:
-            tag_filters.append(
-                {
-                    "Key": "Space GUID",
-                    "Values": self.space_guids,
-                }
+    def get_running_task_memory_usage(self, tasks, app_space_guids):
+        """
+        Returns {space guid: MB} used by running tasks
+        """
+        running_task_memory_usage = Counter()
+
+        for resource in tasks:
+            app_guid = resource["relationships"]["app"]["data"]["guid"]
+            if app_guid not in app_space_guids:
+                continue
+            running_task_memory_usage[app_space_guids[app_guid]] += resource[
+                "memory_in_mb"
+            ]
+
+        return running_task_memory_usage
+
+    def build_resources(self, resource_class, resources):
+        """
+        Builds the resource objects for a tagging API response, resolving
+        their CF names concurrently.
+        """
+        return list(
+            self.executor.map(
+                lambda resource: resource_class(
+                    resource["ResourceARN"], resource["Tags"]
+                ),
+                resources,
             )
-        response = client.get_resources(
-            TagFilters=tag_filters,
-            ResourceTypeFilters=resource_type_filter,
         )
-        return response
 
-    def get_rds_instances(self, client):
-        response = self.get_aws_instances(client, "rds")
+    def get_rds_instances(self, resources):
         rds_instance_guids = []
-        for resource in response["ResourceTagMappingList"]:
-            rds = Rds(resource["ResourceARN"], resource["Tags"])
+        for rds in self.build_resources(Rds, resources):
             # replica databases will appear twice in the list of
             # tagged resources, but they should only be tracked once
             # for cost purposes
@@ -295,43 +604,29 @@ class Organization:
                 self.rds_instances.append(rds)
                 rds_instance_guids.append(rds.instance_guid)
 
-    def get_redis_instances(self, client):
-        response = self.get_aws_instances(client, "redis")
-        for resource in response["ResourceTagMappingList"]:
-            redis = Redis(resource["ResourceARN"], resource["Tags"])
-            self.redis_instances.append(redis)
-
-    def get_es_instances(self, client):
-        response = self.get_aws_instances(client, "es")
-        for resource in response["ResourceTagMappingList"]:
-            es = Es(resource["ResourceARN"], resource["Tags"])
-            self.es_instances.append(es)
-
-    def get_s3_buckets(self, client):
-        def _get_s3_buckets(client, tag_filters):
-            response = client.get_resources(
-                TagFilters=tag_filters,
-                ResourceTypeFilters=["s3:bucket"],
-            )
-            return response["ResourceTagMappingList"]
+    def get_redis_instances(self, resources):
+        self.redis_instances.extend(self.build_resources(Redis, resources))
 
-        resources = []
+    def get_es_instances(self, resources):
+        self.es_instances.extend(self.build_resources(Es, resources))
 
-        for key_value in ["Organization GUID", "Organization ID", "organizationGuid"]:
-            tag_filters = [{"Key": key_value, "Values": [self.guid]}]
-            if len(self.space_guids) == 0:
-                s3_bucket_resources = _get_s3_buckets(client, tag_filters)
-                resources = resources + s3_bucket_resources
-            else:
-                for key in ["Space GUID", "Space ID", "spaceGuid"]:
-                    space_tag_filters = tag_filters.copy()
-                    space_tag_filters.append({"Key": key, "Values": self.space_guids})
-                    s3_bucket_resources = _get_s3_buckets(client, space_tag_filters)
-                    resources = resources + s3_bucket_resources
+    def get_s3_buckets(self, resources):
+        self.s3_buckets.extend(self.build_resources(S3, resources))
 
-        for resource in resources:
-            s3 = S3(resource["ResourceARN"], resource["Tags"])
-            self.s3_buckets.append(s3)
+    def collect(self, tag_index):
+        """
+        Gathers the AWS resources of the organization from the tag index.
+        Their sizes are looked up later for all orgs at once, see
+        Account.describe_resources.
+        """
+
+        def resources(resource_type):
+            return tag_index.get_resources(self.guid, self.space_guids, resource_type)
+
+        self.get_rds_instances(resources("rds"))
+        self.get_redis_instances(resources("redis"))
+        self.get_es_instances(resources("es"))
+        self.get_s3_buckets(resources("s3"))
 
     def report_memory(self, reporter):
         reporter.log(f"Organization name: {self.name}")
@@ -349,13 +644,10 @@ class Organization:
                     f"Memory usage for space {space_name} (GB): {memory_usage/1024:.2f}"
                 )
 
-    def report_rds(self, tags_client, reporter):
+    def report_rds(self, reporter):
         self.rds_instance_plans = Counter()
-        rds_client = boto3.client("rds")
 
-        self.get_rds_instances(tags_client)
         for rds in self.rds_instances:
-            rds.get_db_instance(rds_client)
             self.rds_instance_plans[rds.service_plan_name] += 1
             self.rds_allocation += rds.allocated_storage
 
@@ -367,15 +659,12 @@ class Organization:
             for key, value in sorted(self.rds_instance_plans.items()):
                 reporter.log(f"  {key}: {value}")
 
-    def report_s3(self, tags_client, reporter):
+    def report_s3(self, reporter):
         self.s3_instance_plans = Counter()
 
         self.s3_total_storage = 0
-        cloudwatch_client = boto3.client("cloudwatch")
 
-        self.get_s3_buckets(tags_client)
         for s3 in self.s3_buckets:
-            s3.get_s3_usage(cloudwatch_client)
             self.s3_instance_plans[s3.service_plan_name] += 1
             self.s3_total_storage += s3.s3_usage
 
@@ -389,9 +678,8 @@ class Organization:
             for key, value in sorted(self.s3_instance_plans.items()):
                 reporter.log(f"  {key}: {value}")
 
-    def report_redis(self, tags_client, reporter):
+    def report_redis(self, reporter):
         self.redis_instance_plans = Counter()
-        self.get_redis_instances(tags_client)
 
         if len(self.redis_instances) == 0:
             return
@@ -406,19 +694,16 @@ class Organization:
             for key, value in sorted(self.redis_instance_plans.items()):
                 reporter.log(f"  {key}: {value}")
 
-    def report_es(self, tags_client, reporter):
+    def report_es(self, reporter):
         self.es_instance_plans = Counter()
-        self.get_es_instances(tags_client)
         self.es_volume_storage = 0
 
         if len(self.es_instances) == 0:
             return
 
         reporter.log("ES")
-        es_client = boto3.client("es")
 
         for es in self.es_instances:
-            es.get_es_instance(es_client)
             self.es_instance_plans[es.service_plan_name] += 1
             self.es_volume_storage += es.volume_size
         reporter.log(f" ES volume storage (GB): {self.es_volume_storage}")
@@ -455,13 +740,12 @@ def test_authenticated(service):
         sys.exit(1)  # Exit with non-zero status cod
 
 
-class Account:
-    def __init__(self, orgs, space_names, input_workbook_file, output_workbook_file):
-        self.org_names = orgs
-        self.space_names = space_names if space_names else []
-
-        self.resource_tags_client = boto3.client("resourcegroupstaggingapi")
+class Usage:
+    """
+    Usage totals that go into a cost estimate, for one org or a whole account
+    """
 
+    def __init__(self, orgs=()):
         self.memory_quota = 0
         self.memory_usage = 0
         self.rds_total_allocation = 0
@@ -471,60 +755,413 @@ class Account:
         self.rds_total_instance_plans = Counter()
         self.redis_total_instance_plans = Counter()
         self.es_total_instance_plans = Counter()
+
+        for org in orgs:
+            self.add_org(org)
+
+    def add_org(self, org):
+        """
+        Adds the usage of an org that has been reported on
+        """
+        self.memory_quota += org.memory_quota
+        self.memory_usage += org.memory_usage
+        self.rds_total_instance_plans.update(org.rds_instance_plans)
+        self.rds_total_allocation += org.rds_allocation
+        self.s3_total_storage += org.s3_total_storage
+        self.redis_total_instance_plans.update(org.redis_instance_plans)
+        self.es_total_instance_plans.update(org.es_instance_plans)
+        self.es_total_volume_storage += org.es_volume_storage
+
+
+class Account:
+    def __init__(
+        self,
+        orgs,
+        space_names,
+        input_workbook_file,
+        output_workbook_file,
+        org_workers=ORG_WORKERS,
+        lookup_workers=LOOKUP_WORKERS,
+        snapshot=None,
+    ):
+        self.org_names = orgs
+        self.space_names = space_names if space_names else []
+        self.org_workers = org_workers
+        self.lookup_workers = lookup_workers
+        # Data loaded with load_snapshot, replayed instead of calling CF/AWS
+        self.snapshot = snapshot
+
+        self.aws_clients = None
+
+        self.orgs = []
+        self.usage = Usage()
+        self.template = None
         self.input_workbook_file = input_workbook_file
         self.output_workbook_file = output_workbook_file
         self.reporter = Reporter()
 
-    def report_orgs(self):
-        for org_name in self.org_names:
-            # urlencode name to ensure that names with possible URL escape
-            # characters (e.g. +) will be handled properly when querying the CF API
-            org_name = urllib.parse.quote_plus(org_name)
-            # We have a check in main() to ensure that the script cannot be executed
-            # with space names when specifying multiple org names, since space names
-            # are not unique across orgs
-            org = Organization(name=org_name, space_names=self.space_names)
-            self.reporter.log("-----------------------------")
-            org.report_memory(self.reporter)
-            self.memory_quota += org.memory_quota
-            self.memory_usage += org.memory_usage
+    def collect_org(self, org_name, tag_index_future, executor):
+        # Org names are passed to the CF API as query parameters, which
+        # the client urlencodes, so names with characters such as + are
+        # handled properly.
+        # We have a check in main() to ensure that the script cannot be executed
+        # with space names when specifying multiple org names, since space names
+        # are not unique across orgs
+        org = Organization(
+            name=org_name, space_names=self.space_names, executor=executor
+        )
+        org.collect(tag_index_future.result())
+        return org
+
+    def get_s3_bucket_sizes(self, bucket_names, executor):
+        """
+        Returns {bucket name: {storage type: bytes}}, only asking CloudWatch
+        about buckets that were not already sized today.  Sizes for up to 500
+        bucket/storage type pairs are fetched per GetMetricData request
+        """
+        cache = S3SizeCache()
+        missing = set(bucket_names) - cache.sizes.keys()
+
+        if len(missing) > 0:
+            cloudwatch_client = self.aws_clients.cloudwatch
+            metrics = list_bucket_size_metrics(cloudwatch_client, missing)
+            batches = executor.map(
+                lambda batch: get_bucket_sizes(cloudwatch_client, batch),
+                chunks(metrics, METRIC_DATA_BATCH_SIZE),
+            )
+            for batch in batches:
+                for bucket_name, sizes in batch.items():
+                    cache.sizes.setdefault(bucket_name, {}).update(sizes)
+            # Buckets without any metric are empty
+            for bucket_name in missing:
+                cache.sizes.setdefault(bucket_name, {})
+            cache.save()
+
+        return cache.sizes
+
+    def describe_resources(self, orgs, executor):
+        """
+        Looks up the sizes of the resources of every org with as few AWS calls
+        as possible: DB instances are described 100 at a time, ES domains 5 at
+        a time and S3 bucket sizes 500 at a time, then joined back to their
+        resources by ARN/domain name/bucket name.
+        """
+        rds_instances = [rds for org in orgs for rds in org.rds_instances]
+        es_instances = [es for org in orgs for es in org.es_instances]
+        s3_buckets = [s3 for org in orgs for s3 in org.s3_buckets]
 
-            org.report_rds(self.resource_tags_client, self.reporter)
-            for key, value in org.rds_instance_plans.items():
-                self.rds_total_instance_plans[key] += value
-            self.rds_total_allocation += org.rds_allocation
+        arns = sorted({rds.arn for rds in rds_instances})
+        domain_names = sorted({es.domain_name for es in es_instances})
 
-            org.report_s3(self.resource_tags_client, self.reporter)
-            self.s3_total_storage += org.s3_total_storage
+        db_instance_batches = executor.map(
+            lambda batch: describe_db_instances(self.aws_clients.rds, batch),
+            chunks(arns, RDS_DESCRIBE_FILTER_SIZE),
+        )
+        es_domain_batches = executor.map(
+            lambda batch: describe_es_domains(self.aws_clients.es, batch),
+            chunks(domain_names, ES_DESCRIBE_BATCH_SIZE),
+        )
+        # The describes above are already running on the pool while this
+        # waits on CloudWatch
+        s3_bucket_sizes = self.get_s3_bucket_sizes(
+            [s3.bucket_name for s3 in s3_buckets], executor
+        )
+
+        db_instances = {}
+        for batch in db_instance_batches:
+            db_instances.update(batch)
+        for rds in rds_instances:
+            rds.set_db_instance(db_instances.get(rds.arn))
 
-            org.report_redis(self.resource_tags_client, self.reporter)
-            for key, value in org.redis_instance_plans.items():
-                self.redis_total_instance_plans[key] += value
+        es_domains = {}
+        for batch in es_domain_batches:
+            es_domains.update(batch)
+        for es in es_instances:
+            es.set_es_domain(es_domains.get(es.domain_name))
 
-            org.report_es(self.resource_tags_client, self.reporter)
-            for key, value in org.es_instance_plans.items():
-                self.es_total_instance_plans[key] += value
-            self.es_total_volume_storage += org.es_volume_storage
+        for s3 in s3_buckets:
+            s3.set_s3_usage(s3_bucket_sizes.get(s3.bucket_name, {}))
+
+    def resolve_plan_names(self, orgs):
+        """
+        Resolves the service plan names of the RDS, Redis, ES and S3
+        resources of every org with a few bulk CF API calls.  Instances the
+        CF API fails to look up are reported and counted as not found
+        """
+        resources = [
+            resource
+            for org in orgs
+            for resources in (
+                org.rds_instances,
+                org.redis_instances,
+                org.es_instances,
+                org.s3_buckets,
+            )
+            for resource in resources
+        ]
+
+        plan_names, errors = get_service_plan_names(
+            resource.instance_guid for resource in resources
+        )
+        for instance_guid, error in sorted(errors.items()):
+            print(
+                "Error: could not get the service plan of instance "
+                f"{instance_guid}: {error}",
+                file=sys.stderr,
+            )
+
+        for resource in resources:
+            plan_name = plan_names.get(resource.instance_guid, NOT_FOUND)
+            resource.service_plan_name = (
+                PLAN_NOT_FOUND if plan_name == NOT_FOUND else plan_name
+            )
+
+    def collect_orgs(self):
+        """
+        Collects every organization, several at a time, from one scan of the
+        tagging API, then sizes all of their resources and resolves their
+        plan names together.  Each org's own lookups go to a separate,
+        shared pool so that an org waiting on its lookups never holds up the
+        threads those lookups need.  Orgs are returned in the order they were
+        given.
+        """
+        if self.snapshot is not None:
+            return self.orgs_from_snapshot()
+
+        self.aws_clients = AWSClients(max_pool_connections=self.lookup_workers)
+
+        with ThreadPoolExecutor(
+            max_workers=self.lookup_workers
+        ) as lookup_executor, ThreadPoolExecutor(
+            max_workers=self.org_workers
+        ) as org_executor:
+            # The tag scan runs while the orgs' CF data is being collected
+            tag_index_future = lookup_executor.submit(
+                TagIndex, self.aws_clients.resource_tags
+            )
+            orgs = list(
+                org_executor.map(
+                    lambda org_name: self.collect_org(
+                        org_name, tag_index_future, lookup_executor
+                    ),
+                    self.org_names,
+                )
+            )
+            plan_names = lookup_executor.submit(self.resolve_plan_names, orgs)
+            self.describe_resources(orgs, lookup_executor)
+            plan_names.result()
+        return orgs
+
+    def orgs_from_snapshot(self):
+        orgs = {
+            org_data["name"]: Organization.from_snapshot(org_data)
+            for org_data in self.snapshot["orgs"]
+        }
+        return [orgs[org_name] for org_name in self.org_names]
+
+    def save_snapshot(self, path):
+        """
+        Saves everything collected about the orgs, so workbooks can be
+        generated again later with --from-snapshot without calling CF or AWS.
+        Paths ending in .gz are compressed
+        """
+        snapshot = {
+            "version": SNAPSHOT_VERSION,
+            "created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "org_names": self.org_names,
+            "space_names": self.space_names,
+            "orgs": [org.to_snapshot() for org in self.orgs],
+        }
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "wt", encoding="utf-8") as snapshot_file:
+            json.dump(snapshot, snapshot_file)
+        print(f"Saved snapshot to: {path}", file=sys.stderr)
+
+    @staticmethod
+    def load_snapshot(path):
+        with open_json(path) as snapshot_file:
+            snapshot = json.load(snapshot_file)
+        if snapshot.get("version") != SNAPSHOT_VERSION:
+            raise ValueError(
+                f"{path} is a version {snapshot.get('version')} snapshot, "
+                f"expected version {SNAPSHOT_VERSION}"
+            )
+        return snapshot
+
+    def report_orgs(self):
+        for org in self.collect_orgs():
+            first_output = len(self.reporter.outputs)
+            self.reporter.log("-----------------------------")
+            org.report_memory(self.reporter)
+            org.report_rds(self.reporter)
+            org.report_s3(self.reporter)
+            org.report_redis(self.reporter)
+            org.report_es(self.reporter)
+            # Kept for the org's own workbook in batch mode
+            org.report_outputs = self.reporter.outputs[first_output:]
+
+            self.usage.add_org(org)
+            self.orgs.append(org)
 
     def report_summary(self, reporter):
+        usage = self.usage
         reporter.log("-===========================-")
-        reporter.log(f"Account Total Mem Quota (GB): {self.memory_quota/1024:.0f}")
-        reporter.log(f"Account Total Mem Usage (GB): {self.memory_usage/1024:.0f}")
-        reporter.log(f"Account RDS Total Alloc (GB): {self.rds_total_allocation:.0f}")
+        reporter.log(f"Account Total Mem Quota (GB): {usage.memory_quota/1024:.0f}")
+        reporter.log(f"Account Total Mem Usage (GB): {usage.memory_usage/1024:.0f}")
+        reporter.log(
+            f"Account RDS Total Alloc (GB): {usage.rds_total_allocation:.0f}"
+        )
         reporter.log(f"Account RDS Plans")
-        for key, value in sorted(self.rds_total_instance_plans.items()):
+        for key, value in sorted(usage.rds_total_instance_plans.items()):
             reporter.log(f"  {key}: {value}")
         reporter.log(
-            f"Account S3 Total Usage (GB): {self.s3_total_storage/(1024*1024*1024):.0f}"
+            f"Account S3 Total Usage (GB): {usage.s3_total_storage/(1024*1024*1024):.0f}"
         )
         reporter.log(f"Account Redis Plans")
-        for key, value in sorted(self.redis_total_instance_plans.items()):
+        for key, value in sorted(usage.redis_total_instance_plans.items()):
             reporter.log(f"  {key}: {value}")
         reporter.log(f"Account ES Plans")
-        for key, value in sorted(self.es_total_instance_plans.items()):
+        for key, value in sorted(usage.es_total_instance_plans.items()):
             reporter.log(f"  {key}: {value}")
 
+    def load_template(self):
+        """
+        Opens a fresh copy of the input workbook.  The file is only read once
+        however many workbooks are generated from it
+        """
+        if self.template is None:
+            with open(self.input_workbook_file, "rb") as template_file:
+                self.template = template_file.read()
+        return load_workbook(filename=io.BytesIO(self.template))
+
     def generate_cost_estimate(self, reporter):
+        self.write_cost_estimate(
+            self.output_workbook_file, self.org_names, self.usage, reporter.outputs
+        )
+
+    def generate_org_cost_estimates(self):
+        """
+        Batch mode: writes one workbook per org, named after the org, from
+        the data already collected for all of them
+        """
+        for org in self.orgs:
+            self.write_cost_estimate(
+                workbook_file_name(org.name),
+                [org.name],
+                Usage([org]),
+                org.report_outputs,
+            )
+
+    def write_details(self, output_file):
+        """
+        Lists every space and resource found, one sheet per kind.  Rows are
+        streamed to write-only worksheets so the workbook is never held in
+        memory, however many orgs are included
+        """
+        workbook = Workbook(write_only=True)
+
+        memory_sheet = workbook.create_sheet("Memory")
+        memory_sheet.append(
+            ["Organization", "Space", "Memory Usage (MB)", "Memory Quota (MB)"]
+        )
+        rds_sheet = workbook.create_sheet("RDS")
+        rds_sheet.append(
+            [
+                "Organization",
+                "Space GUID",
+                "Instance GUID",
+                "Service Plan",
+                "Allocated Storage (GB)",
+                "ARN",
+            ]
+        )
+        redis_sheet = workbook.create_sheet("Redis")
+        redis_sheet.append(
+            ["Organization", "Space GUID", "Instance GUID", "Service Plan", "ARN"]
+        )
+        es_sheet = workbook.create_sheet("ES")
+        es_sheet.append(
+            [
+                "Organization",
+                "Space GUID",
+                "Instance GUID",
+                "Service Plan",
+                "Volume Size (GB)",
+                "ARN",
+            ]
+        )
+        s3_sheet = workbook.create_sheet("S3")
+        s3_sheet.append(
+            [
+                "Organization",
+                "Bucket",
+                "Instance GUID",
+                "Service Plan",
+                "Usage (GB)",
+                "ARN",
+            ]
+        )
+
+        for org in self.orgs:
+            if len(org.memory_usage_by_space) == 0:
+                memory_sheet.append([org.name, "", org.memory_usage, org.memory_quota])
+            for space_info in org.memory_usage_by_space:
+                memory_sheet.append(
+                    [
+                        org.name,
+                        space_info["space_name"],
+                        space_info["memory_usage_in_mb"],
+                        org.memory_quota,
+                    ]
+                )
+            for rds in org.rds_instances:
+                rds_sheet.append(
+                    [
+                        org.name,
+                        rds.space_guid,
+                        rds.instance_guid,
+                        rds.service_plan_name,
+                        rds.allocated_storage,
+                        rds.arn,
+                    ]
+                )
+            for redis in org.redis_instances:
+                redis_sheet.append(
+                    [
+                        org.name,
+                        redis.space_guid,
+                        redis.instance_guid,
+                        redis.service_plan_name,
+                        redis.arn,
+                    ]
+                )
+            for es in org.es_instances:
+                es_sheet.append(
+                    [
+                        org.name,
+                        es.space_guid,
+                        es.instance_guid,
+                        es.service_plan_name,
+                        es.volume_size,
+                        es.arn,
+                    ]
+                )
+            for s3 in org.s3_buckets:
+                s3_sheet.append(
+                    [
+                        org.name,
+                        s3.bucket_name,
+                        s3.instance_guid,
+                        s3.service_plan_name,
+                        s3.s3_usage / (1024 * 1024 * 1024),
+                        s3.arn,
+                    ]
+                )
+
+        workbook.save(output_file)
+        print(f"Saved details to: {output_file}")
+
+    def write_cost_estimate(self, output_file, org_names, usage, report_outputs):
         estimate_map = {
             # Usage
             "memory_usage": "B7",
@@ -594,24 +1231,24 @@ class Account:
             "redis-5node": "R34",
             "redis-3node-large": "R35",
             "redis-5node-large": "R36",
-            "Not_Found": "A32",
+            PLAN_NOT_FOUND: "A32",
         }
 
-        workbook = load_workbook(filename=self.input_workbook_file)
+        workbook = self.load_template()
         platform_estimate_sheet = workbook.worksheets[1]
 
         today = datetime.datetime.today().strftime("%Y-%m-%d")
-        headline = f"Cloud.gov cost estimate generated {today} for Platform orgs: {', '.join(self.org_names)}"
+        headline = f"Cloud.gov cost estimate generated {today} for Platform orgs: {', '.join(org_names)}"
         if len(self.space_names) > 0:
             headline += f", spaces: {self.space_names}"
         platform_estimate_sheet["A3"] = headline
-        reporter.report(platform_estimate_sheet, "A", 60)
+        self.reporter.report(platform_estimate_sheet, "A", 60, report_outputs)
         # Usage
         if len(self.space_names) == 0:
             # If no space names were specified, then the memory usage is just the quota for the
             # organization
             platform_estimate_sheet[estimate_map["memory_usage"]] = (
-                self.memory_usage / 1024
+                usage.memory_usage / 1024
             )
         else:
             # If we are producing an estimate for a set of space(s), then the memory usage is
@@ -619,26 +1256,26 @@ class Account:
             # integer because we charge for memory on a per GB basis, so any partial use of a GB
             # should be treated as a whole GB for accounting purposes
             platform_estimate_sheet[estimate_map["memory_usage"]] = math.ceil(
-                self.memory_usage / 1024
+                usage.memory_usage / 1024
             )
         platform_estimate_sheet[estimate_map["rds_total_allocation"]] = (
-            self.rds_total_allocation
+            usage.rds_total_allocation
         )
         platform_estimate_sheet[estimate_map["s3_total_storage"]] = (
-            self.s3_total_storage / (1024 * 1024 * 1024)
+            usage.s3_total_storage / (1024 * 1024 * 1024)
         )
         platform_estimate_sheet[estimate_map["es_total_volume_storage"]] = (
-            self.es_total_volume_storage
+            usage.es_total_volume_storage
         )
         # Plans
-        for key, value in sorted(self.rds_total_instance_plans.items()):
+        for key, value in sorted(usage.rds_total_instance_plans.items()):
             platform_estimate_sheet[estimate_map[key]] = value
-        for key, value in sorted(self.redis_total_instance_plans.items()):
+        for key, value in sorted(usage.redis_total_instance_plans.items()):
             platform_estimate_sheet[estimate_map[key]] = value
-        for key, value in sorted(self.es_total_instance_plans.items()):
+        for key, value in sorted(usage.es_total_instance_plans.items()):
             platform_estimate_sheet[estimate_map[key]] = value
-        workbook.save(filename=self.output_workbook_file)
-        print(f"Saved cost estimate to: {self.output_workbook_file}")
+        workbook.save(filename=output_file)
+        print(f"Saved cost estimate to: {output_file}")
 
 
 class Reporter:
@@ -654,13 +1291,21 @@ class Reporter:
         print(message)
         self.outputs.append(message)
 
-    def report(self, worksheet, column, row):
+    def report(self, worksheet, column, row, outputs=None):
         worksheet[column + str(row)] = "ACCOUNT USAGE REPORT"
-        for output in self.outputs:
+        for output in self.outputs if outputs is None else outputs:
             row += 1
             worksheet[column + str(row)] = output
 
 
+def workbook_file_name(name):
+    """
+    Returns the workbook file name for an org or account name, with path
+    separators replaced so it always lands in the current directory
+    """
+    return re.sub(r"[\\/\0]", "-", name).lstrip(".") + ".xlsx"
+
+
 def download_file(url, output_filename):
     """
     Download a file from a URL and save it to the specified filename
@@ -706,21 +1351,61 @@ Notes:
         default=[],
         help="space names. only allowed for a single organization name",
     )
-    parser.add_argument("orgs", nargs="+", help="organization names")
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=ORG_WORKERS,
+        help=f"number of organizations collected at the same time (default {ORG_WORKERS}, 1 to collect them one by one)",
+    )
+    parser.add_argument(
+        "--per-org",
+        action="store_true",
+        help="batch mode: also write one workbook per organization, named <org>.xlsx, from the same collection pass",
+    )
+    parser.add_argument(
+        "--details",
+        action="store_true",
+        help="also write every space and resource found to <output>-details.xlsx",
+    )
+    parser.add_argument(
+        "--snapshot",
+        metavar="FILE",
+        help="also save all collected data to FILE (e.g. out.json.gz) for --from-snapshot",
+    )
+    parser.add_argument(
+        "--from-snapshot",
+        metavar="FILE",
+        help="generate the workbooks from a --snapshot FILE instead of querying CF and AWS; organization names are optional and select orgs from the snapshot",
+    )
+    parser.add_argument("orgs", nargs="*", help="organization names")
 
     # Parse arguments
     args = parser.parse_args()
     org_names = args.orgs
     space_names = args.spaces
 
+    snapshot = None
+    if args.from_snapshot:
+        snapshot = Account.load_snapshot(args.from_snapshot)
+        if len(space_names) > 0:
+            parser.error("space names are taken from the snapshot")
+        space_names = snapshot["space_names"]
+        missing = set(org_names) - {org["name"] for org in snapshot["orgs"]}
+        if len(missing) > 0:
+            parser.error(f"not in the snapshot: {', '.join(sorted(missing))}")
+        org_names = org_names or snapshot["org_names"]
+    elif len(org_names) == 0:
+        parser.error("at least one organization name is required")
+
     if len(org_names) > 1 and len(space_names) > 0:
         print("space names only allowed when specifying a single organization")
         exit(1)
 
     if args.account_name:
-        output_file = args.account_name + ".xlsx"
+        output_file = workbook_file_name(args.account_name)
     else:
-        output_file = org_names[-1] + ".xlsx"
+        output_file = workbook_file_name(org_names[-1])
 
     if not os.path.exists(cost_estimate_file):
         print(f'Info: Missing input file, "{cost_estimate_file}"')
@@ -734,24 +1419,36 @@ Notes:
 
     print(f'Info: Using output file, "{output_file}"', file=sys.stderr)
 
-    test_authenticated("cf")
-    test_authenticated("aws")
+    if snapshot is None:
+        test_authenticated("cf")
+        test_authenticated("aws")
 
-    print(f"Info: Authenticated, starting...", file=sys.stderr)
+        print(f"Info: Authenticated, starting...", file=sys.stderr)
 
     acct = Account(
         orgs=org_names,
         space_names=space_names,
         input_workbook_file=cost_estimate_file,
         output_workbook_file=output_file,
+        org_workers=max(args.workers, 1),
+        snapshot=snapshot,
     )
     acct.report_orgs()
+    if args.snapshot:
+        acct.save_snapshot(args.snapshot)
     if len(org_names) > 1:
         acct.report_summary(acct.reporter)
 
     acct.input_workbook_file = cost_estimate_file
     acct.output_workbook_file = output_file
-    acct.generate_cost_estimate(acct.reporter)
+    if args.per_org:
+        acct.generate_org_cost_estimates()
+    # In batch mode without an account name, the combined workbook would be
+    # named after the last org and overwrite that org's own workbook
+    if not args.per_org or args.account_name:
+        acct.generate_cost_estimate(acct.reporter)
+    if args.details:
+        acct.write_details(os.path.splitext(output_file)[0] + "-details.xlsx")
 
 
 if __name__ == "__main__":
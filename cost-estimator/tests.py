@@ -0,0 +1,188 @@
+import unittest
+import importlib.util
+import os
+import tempfile
+from unittest.mock import MagicMock
+from openpyxl import Workbook, load_workbook
+
+spec = importlib.util.spec_from_file_location(
+    "estimate_costs",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "estimate-costs.py"),
+)
+estimate_costs = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(estimate_costs)
+
+
+def resource_tags(instance_guid, space_guid) -> list:
+    return [
+        {"Key": "Instance GUID", "Value": instance_guid},
+        {"Key": "Space GUID", "Value": space_guid},
+    ]
+
+
+def snapshot_resource(arn, instance_guid, plan, **fields) -> dict:
+    return {
+        "arn": arn,
+        "tags": resource_tags(instance_guid, "space-guid"),
+        "instance_id": arn.split(":")[-1],
+        "service_plan_name": plan,
+        "instance_guid": instance_guid,
+        "space_guid": "space-guid",
+        "space_name": "dev",
+        **fields,
+    }
+
+
+def snapshot_org(name, memory_usage, allocated_storage) -> dict:
+    return {
+        "name": name,
+        "space_names": [],
+        "guid": name + "-guid",
+        "quota_guid": name + "-quota",
+        "space_guid_map": {},
+        "space_guids": [],
+        "memory_quota": 4096,
+        "memory_usage": memory_usage,
+        "memory_usage_by_space": [],
+        "rds_instances": [
+            snapshot_resource(
+                "arn:aws-us-gov:rds:us-gov-west-1:1:db:" + name,
+                name + "-db",
+                "micro-psql",
+                allocated_storage=allocated_storage,
+            )
+        ],
+        "redis_instances": [],
+        "es_instances": [
+            snapshot_resource(
+                "arn:aws-us-gov:es:us-gov-west-1:1:domain/" + name,
+                name + "-es",
+                "es-dev",
+                volume_size=10,
+            )
+        ],
+        "s3_buckets": [
+            snapshot_resource(
+                "arn:aws-us-gov:s3:::cg-" + name,
+                name,
+                "basic",
+                bucket_name="cg-" + name,
+                s3_usage=2 * 1024**3,
+                s3_usage_by_storage_type={"StandardStorage": 2 * 1024**3},
+            )
+        ],
+    }
+
+
+SNAPSHOT = {
+    "version": estimate_costs.SNAPSHOT_VERSION,
+    "org_names": ["org-a", "org-b"],
+    "space_names": [],
+    "orgs": [snapshot_org("org-a", 1024, 20), snapshot_org("org-b", 2048, 40)],
+}
+
+
+def tagged_resource(arn, **tags) -> dict:
+    return {
+        "ResourceARN": arn,
+        "Tags": [{"Key": key, "Value": value} for key, value in tags.items()],
+    }
+
+
+class TestTagIndex(unittest.TestCase):
+    def test_accepts_alternate_tag_spellings_for_s3_only(self):
+        client = MagicMock()
+        client.get_paginator.return_value.paginate.return_value = [
+            {
+                "ResourceTagMappingList": [
+                    tagged_resource(
+                        "arn:aws-us-gov:s3:::cg-bucket",
+                        organizationGuid="org-guid",
+                        spaceGuid="space-guid",
+                    ),
+                    tagged_resource(
+                        "arn:aws-us-gov:rds:us-gov-west-1:1:db:alternate",
+                        **{"Organization ID": "org-guid", "Space ID": "space-guid"},
+                    ),
+                    tagged_resource(
+                        "arn:aws-us-gov:rds:us-gov-west-1:1:db:brokered",
+                        **{
+                            "Organization GUID": "org-guid",
+                            "Space GUID": "space-guid",
+                            "Instance GUID": "db-guid",
+                        },
+                    ),
+                ]
+            }
+        ]
+        tag_index = estimate_costs.TagIndex(client)
+
+        buckets = tag_index.get_resources("org-guid", ["space-guid"], "s3")
+        self.assertEqual(
+            [r["ResourceARN"] for r in buckets], ["arn:aws-us-gov:s3:::cg-bucket"]
+        )
+        databases = tag_index.get_resources("org-guid", [], "rds")
+        self.assertEqual(
+            [r["ResourceARN"] for r in databases],
+            ["arn:aws-us-gov:rds:us-gov-west-1:1:db:brokered"],
+        )
+
+
+class TestCostEstimateFromSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.template = os.path.join(self.tmpdir.name, "template.xlsx")
+        workbook = Workbook()
+        workbook.create_sheet("Platform")
+        workbook.save(self.template)
+
+    def account(self, org_names) -> estimate_costs.Account:
+        account = estimate_costs.Account(
+            orgs=org_names,
+            space_names=[],
+            input_workbook_file=self.template,
+            output_workbook_file=os.path.join(self.tmpdir.name, "account.xlsx"),
+            snapshot=SNAPSHOT,
+        )
+        account.report_orgs()
+        return account
+
+    def test_generates_account_estimate(self):
+        account = self.account(SNAPSHOT["org_names"])
+        account.generate_cost_estimate(account.reporter)
+        sheet = load_workbook(account.output_workbook_file).worksheets[1]
+        self.assertEqual(sheet["B7"].value, 3)
+        self.assertEqual(sheet["J7"].value, 60)
+        self.assertEqual(sheet["R7"].value, 4)
+        self.assertEqual(sheet["R12"].value, 20)
+        self.assertEqual(sheet["J11"].value, 2)
+        self.assertEqual(sheet["R16"].value, 2)
+        self.assertIn("org-a, org-b", sheet["A3"].value)
+
+    def test_generates_one_estimate_per_org(self):
+        account = self.account(["org-b"])
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.tmpdir.name)
+        account.generate_org_cost_estimates()
+        sheet = load_workbook("org-b.xlsx").worksheets[1]
+        self.assertEqual(sheet["B7"].value, 2)
+        self.assertEqual(sheet["J7"].value, 40)
+        self.assertEqual(sheet["A62"].value, "Organization name: org-b")
+
+    def test_keeps_workbook_names_in_current_directory(self):
+        self.assertEqual(estimate_costs.workbook_file_name("org-b"), "org-b.xlsx")
+        self.assertEqual(
+            estimate_costs.workbook_file_name("../a/b\\c"), "-a-b-c.xlsx"
+        )
+
+    def test_snapshot_round_trip(self):
+        account = self.account(SNAPSHOT["org_names"])
+        path = os.path.join(self.tmpdir.name, "snapshot.json.gz")
+        account.save_snapshot(path)
+        snapshot = estimate_costs.Account.load_snapshot(path)
+        self.assertEqual(snapshot["orgs"], SNAPSHOT["orgs"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,312 @@
+"""
+Loads on-demand prices for the brokered services (RDS, Elasticsearch /
+OpenSearch and ElastiCache Redis) from AWS Price List bulk offer files, in
+either their JSON or CSV form, e.g.:
+
+    curl -O https://pricing.us-east-1.amazonaws.com/offers/v1.0/aws/AmazonRDS/current/index.json
+
+Offer files run to several GB, so the first load of a file streams through it
+once, keeps only the on-demand prices for one region, and saves them as a
+small table under $XDG_CACHE_HOME/cg-scripts/prices/.  Later loads of the same
+file (same path, size and modification time) read that table instead.
+
+Prices are returned as a dictionary keyed by tuples:
+
+    ("rds", "instance", engine, instance class, multi AZ) -> USD per hour
+    ("rds", "storage", engine, multi AZ)                   -> USD per GB/month
+    ("es", "instance", instance type)                      -> USD per hour
+    ("es", "storage", volume type)                         -> USD per GB/month
+    ("redis", "instance", node type)                       -> USD per hour
+"""
+
+import csv
+import hashlib
+import json
+import os
+import re
+import tempfile
+from typing import Iterable, Iterator, Optional, Tuple, Union
+
+from json_stream import iter_json_members, open_json
+
+
+DEFAULT_LOCATION = "AWS GovCloud (US-West)"
+
+# Bumped whenever the layout of the cached tables changes.
+TABLE_VERSION = 2
+
+# RDS engine names in offer files mapped to the engine names the RDS API uses.
+RDS_ENGINES = {
+    "MariaDB": "mariadb",
+    "MySQL": "mysql",
+    "PostgreSQL": "postgres",
+}
+
+# Offer files price RDS storage for "Any" engine as well as per engine.
+ANY_ENGINE = "any"
+
+# RDS deployment options mapped to whether they are multi AZ.  Other options,
+# such as multi AZ clusters with readable standbys, are not used by the broker.
+RDS_DEPLOYMENT_OPTIONS = {
+    "Single-AZ": False,
+    "Multi-AZ": True,
+}
+
+# Volume types of the storage the broker provisions.
+RDS_VOLUME_TYPES = {"General Purpose"}
+
+# Offer files name Elasticsearch / OpenSearch instance types "*.search", the
+# describe output the scripts price them for "*.elasticsearch".
+ES_OFFER_SUFFIX = ".search"
+ES_INSTANCE_SUFFIX = ".elasticsearch"
+
+HOURLY_UNITS = {"Hrs", "Hours"}
+STORAGE_UNITS = {"GB-Mo"}
+
+PriceKey = Tuple[Union[str, bool], ...]
+
+
+def default_cache_dir() -> str:
+    cache_home = os.getenv("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
+    return os.path.join(cache_home, "cg-scripts", "prices")
+
+
+def price_key(product_family: str, attributes: dict, unit: str) -> Optional[PriceKey]:
+    """
+    Returns the table key for one price dimension of a product, or None if it
+    is not a price the cost scripts use.
+    """
+
+    product_family = product_family or ""
+
+    if product_family == "Database Instance":
+        engine = RDS_ENGINES.get(attributes.get("databaseEngine"))
+        multi_az = RDS_DEPLOYMENT_OPTIONS.get(attributes.get("deploymentOption"))
+        if engine and multi_az is not None and unit in HOURLY_UNITS:
+            return ("rds", "instance", engine, attributes.get("instanceType"), multi_az)
+
+    elif product_family == "Database Storage":
+        database_engine = attributes.get("databaseEngine")
+        engine = ANY_ENGINE if database_engine == "Any" else RDS_ENGINES.get(database_engine)
+        multi_az = RDS_DEPLOYMENT_OPTIONS.get(attributes.get("deploymentOption"))
+        if (
+            engine
+            and multi_az is not None
+            and attributes.get("volumeType") in RDS_VOLUME_TYPES
+            and unit in STORAGE_UNITS
+        ):
+            return ("rds", "storage", engine, multi_az)
+
+    elif "Elastic Search" in product_family or "OpenSearch" in product_family:
+        if product_family.endswith("Instance") and unit in HOURLY_UNITS:
+            instance_type = attributes.get("instanceType") or ""
+            if instance_type.endswith(ES_OFFER_SUFFIX):
+                instance_type = instance_type[: -len(ES_OFFER_SUFFIX)] + ES_INSTANCE_SUFFIX
+            return ("es", "instance", instance_type)
+        if product_family.endswith("Volume") and unit in STORAGE_UNITS:
+            return ("es", "storage", (attributes.get("storageMedia") or "").lower())
+
+    elif product_family == "Cache Instance":
+        if attributes.get("cacheEngine") == "Redis" and unit in HOURLY_UNITS:
+            return ("redis", "instance", attributes.get("instanceType"))
+
+    return None
+
+
+def add_price(prices: dict, key: Optional[PriceKey], begin_range, price) -> None:
+    """
+    Records the first tier of a price under its key.
+    """
+
+    if key is None or None in key or price in (None, ""):
+        return
+    if begin_range not in (None, "", "0"):
+        return
+
+    prices.setdefault(key, float(price))
+
+
+def parse_json_offer(path: str, location: str) -> dict:
+    """
+    Collects prices from a JSON offer file.  Offer files list every product
+    before the terms, so the products for the region are remembered by SKU
+    and their on-demand terms picked up as the pass reaches them.
+    """
+
+    prices = {}
+    products = {}
+
+    members = iter_json_members(path, [("products",), ("terms", "OnDemand")])
+
+    for key_path, sku, value in members:
+        if key_path == ("products",):
+            attributes = value.get("attributes", {})
+            if attributes.get("location") == location:
+                products[sku] = (value.get("productFamily"), attributes)
+            continue
+
+        if sku not in products:
+            continue
+
+        product_family, attributes = products[sku]
+        for term in value.values():
+            for dimension in term.get("priceDimensions", {}).values():
+                add_price(
+                    prices,
+                    price_key(product_family, attributes, dimension.get("unit")),
+                    dimension.get("beginRange"),
+                    dimension.get("pricePerUnit", {}).get("USD"),
+                )
+
+    return prices
+
+
+def csv_attribute_name(column: str) -> str:
+    """
+    Turns a CSV offer file column such as "Database Engine" or "TermType" into
+    the name the JSON offer files use for the same attribute ("databaseEngine",
+    "termType").
+    """
+
+    name = "".join(word[:1].upper() + word[1:] for word in re.split(r"[\s_-]+", column.strip()))
+    return name[:1].lower() + name[1:]
+
+
+def iter_csv_offer_rows(csv_file) -> Iterator[dict]:
+    """
+    Yields the rows of a CSV offer file as dictionaries keyed by attribute
+    name, after the metadata lines that precede the header.
+    """
+
+    reader = csv.reader(csv_file)
+
+    for header in reader:
+        if header and header[0] == "SKU":
+            break
+    else:
+        return
+
+    names = [csv_attribute_name(column) for column in header]
+    for row in reader:
+        yield dict(zip(names, row))
+
+
+def parse_csv_offer(path: str, location: str) -> dict:
+    """
+    Collects prices from a CSV offer file, where every row is one price
+    dimension of one product.
+    """
+
+    prices = {}
+
+    with open_json(path) as csv_file:
+        for row in iter_csv_offer_rows(csv_file):
+            if row.get("termType") != "OnDemand" or row.get("location") != location:
+                continue
+
+            add_price(
+                prices,
+                price_key(row.get("productFamily"), row, row.get("unit")),
+                row.get("startingRange"),
+                row.get("pricePerUnit") if row.get("currency", "USD") == "USD" else None,
+            )
+
+    return prices
+
+
+def is_csv_offer(path: str) -> bool:
+    with open_json(path) as offer_file:
+        return not offer_file.read(64).lstrip().startswith("{")
+
+
+def parse_offer(path: str, location: str = DEFAULT_LOCATION) -> dict:
+    """
+    Streams through an offer file and returns its prices for one location.
+    """
+
+    if is_csv_offer(path):
+        prices = parse_csv_offer(path, location)
+    else:
+        prices = parse_json_offer(path, location)
+
+    # Storage priced for any engine applies to every engine without a price
+    # of its own.
+    for key, price in list(prices.items()):
+        if key[:3] == ("rds", "storage", ANY_ENGINE):
+            for engine in RDS_ENGINES.values():
+                prices.setdefault(("rds", "storage", engine, key[3]), price)
+
+    return prices
+
+
+def cache_path(path: str, location: str, cache_dir: Optional[str] = None) -> str:
+    """
+    Returns where the price table of an offer file is cached.  The name
+    changes whenever the offer file is replaced.
+    """
+
+    stat = os.stat(path)
+    fingerprint = "|".join(
+        map(str, (os.path.abspath(path), stat.st_size, stat.st_mtime_ns, location, TABLE_VERSION))
+    )
+    digest = hashlib.sha256(fingerprint.encode("utf-8")).hexdigest()[:24]
+
+    return os.path.join(cache_dir or default_cache_dir(), digest + ".json")
+
+
+def read_table(path: str) -> dict:
+    with open(path) as table_file:
+        return {tuple(key): price for key, price in json.load(table_file)}
+
+
+def write_table(path: str, prices: dict) -> None:
+    """
+    Saves a price table, replacing any previous one atomically so concurrent
+    runs never read a partial file.
+    """
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    rows = sorted(([list(key), price] for key, price in prices.items()), key=str)
+    with tempfile.NamedTemporaryFile(
+        "w", dir=os.path.dirname(path), suffix=".tmp", delete=False
+    ) as table_file:
+        json.dump(rows, table_file, separators=(",", ":"))
+
+    os.replace(table_file.name, path)
+
+
+def load_offer(
+    path: str, location: str = DEFAULT_LOCATION, cache_dir: Optional[str] = None
+) -> dict:
+    """
+    Returns the prices in an offer file, from the cached table if there is
+    one for this version of the file.
+    """
+
+    table_path = cache_path(path, location, cache_dir)
+
+    try:
+        return read_table(table_path)
+    except (OSError, ValueError):
+        pass
+
+    prices = parse_offer(path, location)
+    write_table(table_path, prices)
+    return prices
+
+
+def load_prices(
+    paths: Iterable[str],
+    location: str = DEFAULT_LOCATION,
+    cache_dir: Optional[str] = None,
+) -> dict:
+    """
+    Returns the merged prices of several offer files, e.g. the RDS,
+    Elasticsearch and ElastiCache ones.
+    """
+
+    prices = {}
+    for path in paths:
+        prices.update(load_offer(path, location, cache_dir))
+    return prices
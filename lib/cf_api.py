@@ -0,0 +1,301 @@
+"""
+Shared Cloud Foundry v3 API client for the Python scripts in this repo.
+
+Rather than forking a `cf curl` process for every request, this reads the API
+endpoint and access token from the cf CLI config once and sends every request
+over a pooled keep-alive HTTPS session.  An expired token is refreshed with
+`cf oauth-token` the first time the API answers with a 401.
+
+NOTE:  This assumes you are logged into CF on the command line.
+
+Scripts outside of lib/ can use it with:
+
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+    import cf_api
+
+    client = cf_api.get_client()
+    for space in client.paginate("/v3/spaces", params={"per_page": 5000}):
+        ...
+"""
+
+import json
+import os
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+# Number of keep-alive connections kept open to the CF API.
+DEFAULT_POOL_SIZE = 16
+
+# Seconds to wait on the CF API before giving up on a request.
+DEFAULT_TIMEOUT = 60
+
+# Number of pages of a listing fetched at the same time.
+DEFAULT_PAGE_WORKERS = 8
+
+# Longest list of GUIDs sent in a single `guids=` style filter.  Commas are
+# sent urlencoded (%2C), so this keeps the request line well under the 8k
+# limit of the CF API's front end.
+MAX_GUIDS_QUERY_LENGTH = 4000
+
+
+class CFAPIError(Exception):
+    """
+    Raised when the CF API responds with an error status.
+    """
+
+    def __init__(self, method: str, url: str, status_code: int, errors: list):
+        self.method = method
+        self.url = url
+        self.status_code = status_code
+        self.errors = errors
+
+        details = "; ".join(
+            f'{error.get("title", "Error")}: {error.get("detail", "")}'
+            for error in errors
+        )
+        super().__init__(f"{method} {url} returned {status_code}: {details}")
+
+
+def chunk_guids(guids, max_length: int = MAX_GUIDS_QUERY_LENGTH) -> Iterator[list]:
+    """
+    Splits GUIDs into lists short enough to pass as one comma-separated
+    filter, e.g. `/v3/spaces?guids=a,b,c`.
+    """
+
+    chunk = []
+    length = 0
+
+    for guid in guids:
+        guid_length = len(guid) + len("%2C")
+        if chunk and length + guid_length > max_length:
+            yield chunk
+            chunk = []
+            length = 0
+
+        chunk.append(guid)
+        length += guid_length
+
+    if chunk:
+        yield chunk
+
+
+def cf_config_path() -> str:
+    """
+    Returns the path of the cf CLI config file, honoring CF_HOME.
+    """
+
+    cf_home = os.getenv("CF_HOME", os.path.expanduser("~"))
+    return os.path.join(cf_home, ".cf", "config.json")
+
+
+def load_cf_config(path: Optional[str] = None) -> dict:
+    """
+    Loads the cf CLI config file that `cf login` writes.
+    """
+
+    with open(path or cf_config_path()) as config_file:
+        return json.load(config_file)
+
+
+class CFClient:
+    """
+    Thread-safe CF v3 API client that reuses one pooled HTTPS session.
+    """
+
+    def __init__(
+        self,
+        api_url: Optional[str] = None,
+        token: Optional[str] = None,
+        verify: Optional[bool] = None,
+        pool_size: int = DEFAULT_POOL_SIZE,
+        timeout: int = DEFAULT_TIMEOUT,
+    ):
+        if api_url is None or token is None or verify is None:
+            config = load_cf_config()
+            api_url = api_url or config["Target"]
+            token = token or config["AccessToken"]
+            if verify is None:
+                verify = not config.get("SSLDisabled", False)
+
+        self.api_url = api_url.rstrip("/")
+        self.timeout = timeout
+        self._token = token
+        self._token_lock = threading.Lock()
+
+        # Only idempotent methods are retried, so a flaky POST is never
+        # replayed behind the caller's back.  Once retries run out the last
+        # response is returned, so it still raises a CFAPIError.
+        retries = Retry(
+            total=3,
+            backoff_factor=0.5,
+            status_forcelist=[429, 502, 503, 504],
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retries
+        )
+
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers["Accept"] = "application/json"
+        self.session.verify = verify
+
+    def url(self, path: str) -> str:
+        """
+        Accepts either an API path ("/v3/spaces") or a full URL, such as the
+        pagination links the API hands back, and returns a full URL.
+        """
+
+        if path.startswith("http://") or path.startswith("https://"):
+            return path
+        return self.api_url + "/" + path.lstrip("/")
+
+    def refresh_token(self, stale_token: str) -> str:
+        """
+        Asks the cf CLI for a fresh access token.  Concurrent callers that saw
+        the same stale token only trigger a single refresh.
+        """
+
+        with self._token_lock:
+            if self._token == stale_token:
+                output = subprocess.run(
+                    ["cf", "oauth-token"],
+                    capture_output=True,
+                    check=True,
+                    encoding="utf-8",
+                )
+                self._token = output.stdout.strip()
+            return self._token
+
+    def request(self, method: str, path: str, **kwargs) -> dict:
+        """
+        Sends a request to the CF API and returns the decoded JSON body, or an
+        empty dict when there is no body.
+        """
+
+        url = self.url(path)
+        token = self._token
+
+        response = self.session.request(
+            method,
+            url,
+            headers={"Authorization": token},
+            timeout=self.timeout,
+            **kwargs,
+        )
+
+        if response.status_code == 401:
+            token = self.refresh_token(token)
+            response = self.session.request(
+                method,
+                url,
+                headers={"Authorization": token},
+                timeout=self.timeout,
+                **kwargs,
+            )
+
+        if not response.content:
+            results = {}
+        else:
+            try:
+                results = response.json()
+            except ValueError:
+                results = {}
+
+        if response.status_code >= 400:
+            errors = results.get("errors") if isinstance(results, dict) else None
+            raise CFAPIError(
+                method,
+                url,
+                response.status_code,
+                errors or [{"title": response.reason, "detail": response.text}],
+            )
+
+        return results
+
+    def get(self, path: str, params: Optional[dict] = None) -> dict:
+        return self.request("GET", path, params=params)
+
+    def post(self, path: str, data: dict) -> dict:
+        return self.request("POST", path, json=data)
+
+    def patch(self, path: str, data: dict) -> dict:
+        return self.request("PATCH", path, json=data)
+
+    def delete(self, path: str) -> dict:
+        return self.request("DELETE", path)
+
+    def paginate(self, path: str, params: Optional[dict] = None) -> Iterator[dict]:
+        """
+        Yields every resource of a paginated v3 listing, following the
+        pagination links until the last page.
+        """
+
+        results = self.get(path, params=params)
+
+        while True:
+            yield from results.get("resources", [])
+
+            next_page = (results.get("pagination") or {}).get("next")
+            if not next_page:
+                return
+
+            results = self.get(next_page["href"])
+
+    def paginate_concurrently(
+        self,
+        path: str,
+        params: Optional[dict] = None,
+        max_workers: int = DEFAULT_PAGE_WORKERS,
+    ) -> Iterator[dict]:
+        """
+        Yields every resource of a paginated v3 listing, in order.  The first
+        page says how many pages there are, so the rest are fetched at the same
+        time on a bounded pool of workers.  Falls back to following the
+        pagination links when the total is missing.
+        """
+
+        params = dict(params or {})
+        results = self.get(path, params=params)
+        yield from results.get("resources", [])
+
+        pagination = results.get("pagination") or {}
+        total_pages = pagination.get("total_pages")
+
+        if total_pages is None:
+            next_page = pagination.get("next")
+            if next_page:
+                yield from self.paginate(next_page["href"])
+            return
+
+        def get_page(page_number):
+            return self.get(path, params={**params, "page": page_number})
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for page_results in executor.map(get_page, range(2, total_pages + 1)):
+                yield from page_results.get("resources", [])
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> CFClient:
+    """
+    Returns the process-wide CF API client, creating it on first use.
+    """
+
+    global _client
+
+    with _client_lock:
+        if _client is None:
+            _client = CFClient()
+        return _client
@@ -0,0 +1,355 @@
+"""
+Persistent GUID -> name cache for CF entities (organizations, spaces, service
+instances, ...), shared by the audit and cost scripts.
+
+Names are kept in a SQLite file so repeated runs only ask the CF API about
+GUIDs that are new or whose cached name is older than the TTL for that entity
+type.  The least recently used entries are evicted once the cache grows past
+its size limit.
+
+Environment variables:
+ - CF_NAME_CACHE: path of the cache file, default is
+   $XDG_CACHE_HOME/cg-scripts/cf-names.sqlite3 (~/.cache/... if unset).  Use
+   ":memory:" to skip the on-disk cache entirely.
+"""
+
+import atexit
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Optional, Tuple
+
+import cf_api
+
+
+DAY = 24 * 60 * 60
+
+# Pseudo entity type that caches the service plan name of a service instance,
+# keyed by the service instance GUID.
+SERVICE_INSTANCE_PLANS = "service_instance_plans"
+
+# How long a cached name is trusted, in seconds, per entity type.  Orgs and
+# spaces are rarely renamed; service instances come and go more often.
+ENTITY_TTLS = {
+    "organizations": 7 * DAY,
+    "spaces": 3 * DAY,
+    "service_instances": 1 * DAY,
+    SERVICE_INSTANCE_PLANS: 1 * DAY,
+}
+DEFAULT_TTL = 1 * DAY
+
+# Number of names kept before the least recently used ones are evicted.
+DEFAULT_MAX_ENTRIES = 200000
+
+# Name returned for GUIDs the CF API does not know about.
+NOT_FOUND = "N/A"
+
+# Number of bulk listing requests sent at the same time when prefetching.
+PREFETCH_WORKERS = 4
+
+
+def default_cache_path() -> str:
+    cache_home = os.getenv("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
+    return os.getenv(
+        "CF_NAME_CACHE", os.path.join(cache_home, "cg-scripts", "cf-names.sqlite3")
+    )
+
+
+class CFNameCache:
+    """
+    Thread-safe SQLite-backed cache of CF entity names keyed by GUID.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        client: Optional[cf_api.CFClient] = None,
+        ttls: Optional[dict] = None,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+    ):
+        path = path or default_cache_path()
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+        self.client = client
+        self.ttls = {**ENTITY_TTLS, **(ttls or {})}
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS names (
+                entity TEXT NOT NULL,
+                guid TEXT NOT NULL,
+                name TEXT NOT NULL,
+                fetched_at REAL NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (entity, guid)
+            )
+            """
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS names_last_used ON names (last_used)")
+        self.db.commit()
+
+    def ttl(self, entity: str) -> float:
+        return self.ttls.get(entity, DEFAULT_TTL)
+
+    def lookup(self, entity: str, guid: str) -> Optional[str]:
+        """
+        Returns the cached name for a GUID, or None if it is missing or stale.
+        """
+
+        now = time.time()
+        with self.lock:
+            row = self.db.execute(
+                "SELECT name FROM names WHERE entity = ? AND guid = ? AND fetched_at >= ?",
+                (entity, guid, now - self.ttl(entity)),
+            ).fetchone()
+            if row is None:
+                return None
+
+            self.db.execute(
+                "UPDATE names SET last_used = ? WHERE entity = ? AND guid = ?",
+                (now, entity, guid),
+            )
+            # Commit right away so no write transaction stays open for other
+            # processes sharing the cache to trip over.
+            self.db.commit()
+            return row[0]
+
+    def store(self, entity: str, names: dict) -> None:
+        """
+        Saves a {guid: name} mapping for an entity type.
+        """
+
+        now = time.time()
+        with self.lock:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO names VALUES (?, ?, ?, ?, ?)",
+                [(entity, guid, name, now, now) for guid, name in names.items()],
+            )
+            self.db.commit()
+
+    def request_name(self, entity: str, guid: str) -> str:
+        """
+        Asks the CF API for the name of an entity, returning NOT_FOUND for
+        GUIDs the API does not know about.  Other errors are raised as
+        CFAPIError.
+        """
+
+        client = self.client or cf_api.get_client()
+        try:
+            if entity == SERVICE_INSTANCE_PLANS:
+                cf_data = client.get(
+                    "/v3/service_instances/" + guid,
+                    params={"fields[service_plan]": "name"},
+                )
+                plans = cf_data.get("included", {}).get("service_plans", [])
+                return plans[0]["name"] if plans else NOT_FOUND
+
+            return client.get("/v3/" + entity + "/" + guid).get("name", NOT_FOUND)
+        except cf_api.CFAPIError as err:
+            if err.status_code == 404:
+                return NOT_FOUND
+            raise
+
+    def fetch(self, entity: str, guid: str) -> Optional[str]:
+        """
+        Asks the CF API for the name of an entity.  GUIDs the API does not
+        know about are cached as NOT_FOUND; other errors are not cached.
+        """
+
+        try:
+            return self.request_name(entity, guid)
+        except cf_api.CFAPIError:
+            return None
+
+    def get_name(self, entity: str, guid: str) -> Optional[str]:
+        """
+        Retrieves the name of a CF entity from a GUID, going to the CF API
+        only when the cache has no fresh entry for it.
+        """
+
+        if not guid:
+            return None
+
+        name = self.lookup(entity, guid)
+        if name is not None:
+            return name
+
+        name = self.fetch(entity, guid)
+        if name is None:
+            return NOT_FOUND
+
+        self.store(entity, {guid: name})
+        return name
+
+    def list_names(self, client: cf_api.CFClient, entity: str, guids: list) -> dict:
+        """
+        Returns {guid: name} for the GUIDs found by one filtered listing.
+        """
+
+        params = {"guids": ",".join(guids), "per_page": 5000}
+
+        if entity != SERVICE_INSTANCE_PLANS:
+            resources = client.paginate("/v3/" + entity, params=params)
+            return {resource["guid"]: resource["name"] for resource in resources}
+
+        # The plans come back in the "included" section of each page.
+        names = {}
+        params["fields[service_plan]"] = "guid,name"
+        results = client.get("/v3/service_instances", params=params)
+
+        while True:
+            plans = {
+                plan["guid"]: plan["name"]
+                for plan in results.get("included", {}).get("service_plans", [])
+            }
+            for resource in results.get("resources", []):
+                # User-provided service instances have no service plan.
+                plan = resource.get("relationships", {}).get("service_plan") or {}
+                plan_guid = (plan.get("data") or {}).get("guid")
+                names[resource["guid"]] = plans.get(plan_guid, NOT_FOUND)
+
+            next_page = (results.get("pagination") or {}).get("next")
+            if not next_page:
+                return names
+            results = client.get(next_page["href"])
+
+    def prefetch(self, entity: str, guids: Iterable[str]) -> None:
+        """
+        Resolves many names with a few bulk listing calls, such as
+        `/v3/spaces?guids=a,b,c`, so later get_name calls are served from the
+        cache.  Only GUIDs without a fresh cached name are requested.
+        """
+
+        missing = sorted(
+            guid for guid in set(guids) if guid and self.lookup(entity, guid) is None
+        )
+        if not missing:
+            return
+
+        client = self.client or cf_api.get_client()
+
+        def fetch_chunk(chunk):
+            try:
+                names = self.list_names(client, entity, chunk)
+            except cf_api.CFAPIError:
+                # Leave these to be looked up one at a time by get_name.
+                return {}
+
+            # The listing silently leaves out GUIDs it does not know about.
+            return {guid: names.get(guid, NOT_FOUND) for guid in chunk}
+
+        with ThreadPoolExecutor(max_workers=PREFETCH_WORKERS) as executor:
+            for names in executor.map(fetch_chunk, cf_api.chunk_guids(missing)):
+                self.store(entity, names)
+
+    def get_names(self, entity: str, guids: Iterable[str]) -> Tuple[dict, dict]:
+        """
+        Resolves many names at once, in bulk where possible.  Returns
+        ({guid: name}, {guid: CFAPIError}) so callers can report the GUIDs
+        that could not be resolved; those are not cached and are tried again
+        next time.
+        """
+
+        guids = set(guid for guid in guids if guid)
+        self.prefetch(entity, guids)
+
+        names = {}
+        errors = {}
+        for guid in sorted(guids):
+            name = self.lookup(entity, guid)
+            if name is None:
+                # The bulk listing failed for this GUID's chunk.
+                try:
+                    name = self.request_name(entity, guid)
+                except cf_api.CFAPIError as err:
+                    errors[guid] = err
+                    continue
+                self.store(entity, {guid: name})
+            names[guid] = name
+
+        return names, errors
+
+    def evict(self) -> None:
+        """
+        Drops the least recently used names beyond max_entries.
+        """
+
+        with self.lock:
+            self.db.execute(
+                """
+                DELETE FROM names WHERE rowid IN (
+                    SELECT rowid FROM names ORDER BY last_used DESC LIMIT -1 OFFSET ?
+                )
+                """,
+                (self.max_entries,),
+            )
+            self.db.commit()
+
+    def close(self) -> None:
+        if self.db is None:
+            return
+
+        self.evict()
+        with self.lock:
+            self.db.close()
+            self.db = None
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_name_cache() -> CFNameCache:
+    """
+    Returns the process-wide name cache, opening it on first use.  It is
+    trimmed and closed when the process exits.
+    """
+
+    global _cache
+
+    with _cache_lock:
+        if _cache is None:
+            _cache = CFNameCache()
+            atexit.register(_cache.close)
+        return _cache
+
+
+def get_service_plan_name(instance_guid: str) -> Optional[str]:
+    """
+    Retrieves the name of the service plan of a CF service instance.
+    """
+
+    return get_name_cache().get_name(SERVICE_INSTANCE_PLANS, instance_guid)
+
+
+def get_service_plan_names(instance_guids: Iterable[str]) -> Tuple[dict, dict]:
+    """
+    Retrieves the service plan names of many CF service instances in bulk,
+    returning ({instance guid: plan name}, {instance guid: CFAPIError}).
+    """
+
+    return get_name_cache().get_names(SERVICE_INSTANCE_PLANS, instance_guids)
+
+
+def prefetch_cf_entity_names(entity: str, guids: Iterable[str]) -> None:
+    """
+    Resolves the names of many CF entities of one type in bulk.
+    """
+
+    get_name_cache().prefetch(entity, guids)
+
+
+def get_cf_entity_name(entity: str, guid: str) -> Optional[str]:
+    """
+    Retrieves the name of a CF entity from a GUID.
+    """
+
+    return get_name_cache().get_name(entity, guid)
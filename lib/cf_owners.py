@@ -0,0 +1,247 @@
+"""
+Resolves which CF org, space and service instance own a brokered AWS resource
+(RDS instance, Elasticsearch domain, Redis cluster), for the aws-list-*
+scripts.
+
+Every lookup goes through the shared cf_api client, so the access token is
+read once (and refreshed on a 401) and requests reuse pooled connections.
+Spaces and service instances are remembered for the rest of the run, and a
+whole scan can be resolved up front with a few bulk listings:
+
+    cf_owners.prefetch_owners(space_guids, instance_guids)
+    for resource in resources:
+        org_name, space_name, instance_name = (
+            cf_owners.get_org_space_service_instance(space_guid, instance_guid)
+        )
+
+Environment variables:
+ - SYSTEM_DOMAIN: CF system domain, e.g. "fr.cloud.gov".  Defaults to the API
+   the cf CLI is logged into.
+"""
+
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator, Optional, Tuple
+
+import requests
+
+import cf_api
+
+
+# Name returned for anything the CF API does not know about, e.g. resources
+# from another CF environment (typically dev/staging).
+NOT_FOUND = "NOTFOUND"
+
+# Number of bulk listing requests sent at the same time.
+PREFETCH_WORKERS = 4
+
+
+def iter_pages(client: cf_api.CFClient, path: str, params: dict) -> Iterator[dict]:
+    """
+    Yields each page of a listing, including its "included" section.
+    """
+
+    results = client.get(path, params=params)
+    while True:
+        yield results
+
+        next_page = (results.get("pagination") or {}).get("next")
+        if not next_page:
+            return
+        results = client.get(next_page["href"])
+
+
+class CFOwnerResolver:
+    """
+    Thread-safe, memoizing lookup of space, org and service instance names.
+    """
+
+    def __init__(self, client: Optional[cf_api.CFClient] = None):
+        self._client = client
+        self._client_lock = threading.Lock()
+        self.lock = threading.Lock()
+
+        # {space guid: (org name, space name)}
+        self.spaces = {}
+        # {instance guid: (instance name, space guid)}
+        self.service_instances = {}
+
+    @property
+    def client(self) -> cf_api.CFClient:
+        with self._client_lock:
+            if self._client is None:
+                system_domain = os.getenv("SYSTEM_DOMAIN")
+                if system_domain:
+                    self._client = cf_api.CFClient(api_url="https://api." + system_domain)
+                else:
+                    self._client = cf_api.get_client()
+            return self._client
+
+    def list_spaces(self, guids: list) -> dict:
+        params = {"guids": ",".join(guids), "include": "organization", "per_page": 5000}
+
+        spaces = {}
+        for results in iter_pages(self.client, "/v3/spaces", params):
+            org_names = {
+                org["guid"]: org["name"]
+                for org in results.get("included", {}).get("organizations", [])
+            }
+            for space in results.get("resources", []):
+                org_guid = space["relationships"]["organization"]["data"]["guid"]
+                spaces[space["guid"]] = (
+                    org_names.get(org_guid, NOT_FOUND),
+                    space["name"],
+                )
+        return spaces
+
+    def list_service_instances(self, guids: list) -> dict:
+        params = {"guids": ",".join(guids), "per_page": 5000}
+
+        return {
+            instance["guid"]: (
+                instance["name"],
+                instance["relationships"]["space"]["data"]["guid"],
+            )
+            for instance in self.client.paginate("/v3/service_instances", params=params)
+        }
+
+    def prefetch(self, memo: dict, list_entities, guids: Iterable[str]) -> None:
+        """
+        Looks up the GUIDs missing from a memo with bulk listings.  GUIDs the
+        listing leaves out are remembered as not found; GUIDs whose listing
+        failed are left out, to be tried again on the next lookup.
+        """
+
+        with self.lock:
+            missing = sorted(set(guid for guid in guids if guid and guid not in memo))
+        if not missing:
+            return
+
+        def fetch_chunk(chunk):
+            try:
+                return chunk, list_entities(chunk)
+            except (cf_api.CFAPIError, requests.RequestException) as err:
+                print(f"Could not look up {len(chunk)} CF GUIDs: {err}", file=sys.stderr)
+                return [], {}
+
+        with ThreadPoolExecutor(max_workers=PREFETCH_WORKERS) as executor:
+            for chunk, entities in executor.map(fetch_chunk, cf_api.chunk_guids(missing)):
+                with self.lock:
+                    for guid in chunk:
+                        memo[guid] = entities.get(guid)
+
+    def prefetch_spaces(self, space_guids: Iterable[str]) -> None:
+        self.prefetch(self.spaces, self.list_spaces, space_guids)
+
+    def prefetch_service_instances(self, instance_guids: Iterable[str]) -> None:
+        self.prefetch(self.service_instances, self.list_service_instances, instance_guids)
+
+    def prefetch_owners(
+        self, space_guids: Iterable[str] = (), instance_guids: Iterable[str] = ()
+    ) -> None:
+        """
+        Resolves every space and service instance of a scan in bulk, including
+        the spaces of the service instances.
+        """
+
+        instance_guids = list(instance_guids)
+        self.prefetch_service_instances(instance_guids)
+
+        space_guids = set(space_guids)
+        with self.lock:
+            for guid in instance_guids:
+                instance = self.service_instances.get(guid)
+                if instance:
+                    space_guids.add(instance[1])
+        self.prefetch_spaces(space_guids)
+
+    def get_space(self, space_guid: str) -> Tuple[str, str]:
+        """
+        Returns (org name, space name) for a space.
+        """
+
+        self.prefetch_spaces([space_guid])
+        with self.lock:
+            return self.spaces.get(space_guid) or (NOT_FOUND, NOT_FOUND)
+
+    def get_service_instance(self, instance_guid: str) -> Tuple[str, Optional[str]]:
+        """
+        Returns (instance name, space guid) for a service instance.
+        """
+
+        self.prefetch_service_instances([instance_guid])
+        with self.lock:
+            return self.service_instances.get(instance_guid) or (NOT_FOUND, None)
+
+    def get_org_space_service_instance(
+        self, space_guid: str, instance_guid: str
+    ) -> Tuple[str, str, str]:
+        """
+        Returns (org name, space name, instance name) for a resource tagged
+        with both its space and service instance.
+        """
+
+        org_name, space_name = self.get_space(space_guid)
+        instance_name, _ = self.get_service_instance(instance_guid)
+        return org_name, space_name, instance_name
+
+    def get_service_instance_owner(self, instance_guid: str) -> Tuple[str, str, str]:
+        """
+        Returns (org name, space name, instance name) for a resource that is
+        only known by its service instance.
+        """
+
+        instance_name, space_guid = self.get_service_instance(instance_guid)
+        if space_guid is None:
+            return NOT_FOUND, NOT_FOUND, NOT_FOUND
+
+        org_name, space_name = self.get_space(space_guid)
+        return org_name, space_name, instance_name
+
+
+_resolver = None
+_resolver_lock = threading.Lock()
+
+
+def get_resolver() -> CFOwnerResolver:
+    """
+    Returns the process-wide resolver, creating it on first use.
+    """
+
+    global _resolver
+
+    with _resolver_lock:
+        if _resolver is None:
+            _resolver = CFOwnerResolver()
+        return _resolver
+
+
+def prefetch_owners(
+    space_guids: Iterable[str] = (), instance_guids: Iterable[str] = ()
+) -> None:
+    """
+    Resolves the owners of every resource of a scan in bulk.
+    """
+
+    get_resolver().prefetch_owners(space_guids, instance_guids)
+
+
+def get_org_space_service_instance(
+    space_guid: str, instance_guid: str
+) -> Tuple[str, str, str]:
+    """
+    Retrieves the org, space and service instance names of a resource.
+    """
+
+    return get_resolver().get_org_space_service_instance(space_guid, instance_guid)
+
+
+def get_service_instance_owner(instance_guid: str) -> Tuple[str, str, str]:
+    """
+    Retrieves the org, space and service instance names of a resource from its
+    service instance GUID alone.
+    """
+
+    return get_resolver().get_service_instance_owner(instance_guid)
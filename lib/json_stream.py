@@ -0,0 +1,223 @@
+"""
+Streams values out of large (possibly gzip-compressed) JSON documents one at a
+time, so multi-GB `aws ... describe-*` dumps and AWS Price List offer files can
+be processed without loading the whole document into memory.
+
+    for db_instance in iter_json_array("rds.json.gz", "DBInstances"):
+        ...
+
+    for path, sku, product in iter_json_members("offer.json", [("products",)]):
+        ...
+"""
+
+import gzip
+import json
+import re
+from typing import IO, Iterable, Iterator, Tuple
+
+
+# Characters read from the input at a time.
+READ_SIZE = 1024 * 1024
+
+GZIP_MAGIC = b"\x1f\x8b"
+
+WHITESPACE = re.compile(r"\s*")
+ITEM_SEPARATOR = re.compile(r"[\s,]*")
+VALUE_END = re.compile(r"[\s,\]}]")
+
+
+def open_json(path: str) -> IO[str]:
+    """
+    Opens a JSON file for reading as text, transparently decompressing it if
+    it is gzipped.
+    """
+
+    with open(path, "rb") as json_file:
+        magic = json_file.read(len(GZIP_MAGIC))
+
+    if magic == GZIP_MAGIC:
+        return gzip.open(path, "rt", encoding="utf-8")
+    return open(path, encoding="utf-8")
+
+
+class _Reader:
+    """
+    Incremental reader over a JSON text stream that only keeps the value it is
+    currently decoding in memory.
+    """
+
+    def __init__(self, stream: IO[str], path: str):
+        self.stream = stream
+        self.path = path
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def read_more(self) -> None:
+        chunk = self.stream.read(READ_SIZE)
+        self.eof = not chunk
+        self.buffer = self.buffer[self.pos :] + chunk
+        self.pos = 0
+
+    def skip(self, pattern) -> str:
+        """
+        Moves past anything matching pattern and returns the next character,
+        reading more input as needed ("" at the end).
+        """
+
+        while True:
+            self.pos = pattern.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer) or self.eof:
+                return self.buffer[self.pos : self.pos + 1]
+            self.read_more()
+
+    def expect(self, char: str) -> None:
+        if self.skip(WHITESPACE) != char:
+            raise ValueError(f"Expected {char!r} at offset {self.pos} in {self.path}")
+        self.pos += 1
+
+    def decode(self):
+        """
+        Decodes the JSON value starting at pos, reading more input until the
+        whole value is in the buffer.
+        """
+
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # A number cut short by the end of the buffer, e.g. "12." of
+                # "12.5", still decodes, so it is only complete once something
+                # that can follow a value comes after it.
+                is_number = isinstance(value, (int, float)) and not isinstance(
+                    value, bool
+                )
+                if self.eof or (
+                    end < len(self.buffer)
+                    and (not is_number or VALUE_END.match(self.buffer, end))
+                ):
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.read_more()
+
+    def members(self) -> Iterator[str]:
+        """
+        Walks the object starting at pos, yielding each key with pos left at
+        the start of its value.  The caller must consume or skip the value
+        before asking for the next key.
+        """
+
+        self.expect("{")
+        while True:
+            next_char = self.skip(ITEM_SEPARATOR)
+            if next_char == "}":
+                self.pos += 1
+                return
+            if next_char == "":
+                raise ValueError(f"Unterminated object in {self.path}")
+
+            key = self.decode()
+            self.expect(":")
+            self.skip(WHITESPACE)
+            yield key
+
+    def items(self) -> Iterator[None]:
+        """
+        Walks the array starting at pos, yielding once per item with pos left
+        at the start of the item.
+        """
+
+        self.expect("[")
+        while True:
+            next_char = self.skip(ITEM_SEPARATOR)
+            if next_char == "]":
+                self.pos += 1
+                return
+            if next_char == "":
+                raise ValueError(f"Unterminated array in {self.path}")
+            yield
+
+    def skip_value(self) -> None:
+        """
+        Moves past the value starting at pos.  Objects and arrays are walked
+        member by member, so skipping a huge section never decodes all of it.
+        """
+
+        next_char = self.skip(WHITESPACE)
+        if next_char == "{":
+            for _ in self.members():
+                self.skip_value()
+        elif next_char == "[":
+            for _ in self.items():
+                self.skip_value()
+        else:
+            self.decode()
+
+
+def iter_json_array(path: str, key: str) -> Iterator:
+    """
+    Yields each item of the array stored under `key` in a JSON document,
+    e.g. the DBInstances of `aws rds describe-db-instances` output.  Only as
+    much of the document as the current item needs is kept in memory.
+
+    Raises KeyError if the document has no such array.
+    """
+
+    with open_json(path) as stream:
+        reader = _Reader(stream, path)
+
+        if reader.skip(WHITESPACE) != "{":
+            raise ValueError(f"{path} does not contain a JSON object")
+
+        # Walk the keys of the top-level object, skipping over the values of
+        # every other key, until the array under the requested key starts.
+        for current_key in reader.members():
+            if current_key == key and reader.skip(WHITESPACE) == "[":
+                for _ in reader.items():
+                    yield reader.decode()
+                return
+            reader.skip_value()
+
+        raise KeyError(key)
+
+
+def iter_json_members(
+    path: str, key_paths: Iterable[Tuple[str, ...]]
+) -> Iterator[Tuple[Tuple[str, ...], str, object]]:
+    """
+    Yields (key path, member key, member value) for each member of the objects
+    found at the given key paths, in document order and in a single pass over
+    the file.  For an AWS Price List offer file:
+
+        iter_json_members(path, [("products",), ("terms", "OnDemand")])
+
+    yields every product by SKU and then every on-demand term by SKU.  Values
+    outside of the key paths are skipped without being decoded.
+    """
+
+    key_paths = set(map(tuple, key_paths))
+    prefixes = {key_path[:i] for key_path in key_paths for i in range(len(key_path))}
+
+    with open_json(path) as stream:
+        reader = _Reader(stream, path)
+
+        if reader.skip(WHITESPACE) != "{":
+            raise ValueError(f"{path} does not contain a JSON object")
+
+        def walk(current_path):
+            for key in reader.members():
+                key_path = current_path + (key,)
+                is_object = reader.skip(WHITESPACE) == "{"
+
+                if key_path in key_paths and is_object:
+                    for member_key in reader.members():
+                        yield key_path, member_key, reader.decode()
+                elif key_path in prefixes and is_object:
+                    yield from walk(key_path)
+                else:
+                    reader.skip_value()
+
+        yield from walk(())
@@ -0,0 +1,352 @@
+"""
+Persistent store of CloudWatch metric history for the idle resource scans
+(aws/aws-list-unused-*.py).
+
+Each series (one metric, statistic and period of one resource) remembers the
+time range it already holds datapoints for, so a scan only asks GetMetricData
+for what came in since the last run, plus any older part of the lookback
+window it has not seen yet.  The period that was still in progress on the
+last run is fetched again, since its value was not final.  History outlives
+the lookback of a single run, which makes long windows (90+ days) cheap to
+scan again, and requests are split so no GetMetricData call goes over its
+datapoint limit.
+
+Environment variables:
+ - METRIC_STORE: path of the store, default is
+   $XDG_CACHE_HOME/cg-scripts/metrics.sqlite3 (~/.cache/... if unset).  Use
+   ":memory:" to keep nothing between runs.
+"""
+
+import atexit
+import datetime
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from collections import defaultdict
+from typing import Iterable, List, NamedTuple, Optional, Set, Tuple
+
+
+DAY = 24 * 60 * 60
+
+# GetMetricData accepts at most 500 metric queries per request and returns at
+# most 100,800 datapoints per request.
+MAX_QUERIES_PER_REQUEST = 500
+MAX_DATAPOINTS_PER_REQUEST = 100800
+
+# Datapoints older than this are dropped when the store is closed.
+DEFAULT_RETENTION = 455 * DAY
+
+
+def default_store_path() -> str:
+    cache_home = os.getenv("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
+    return os.getenv(
+        "METRIC_STORE", os.path.join(cache_home, "cg-scripts", "metrics.sqlite3")
+    )
+
+
+class Series(NamedTuple):
+    """
+    One CloudWatch metric statistic.  Scope tells apart resources with the same
+    dimensions in different accounts or regions, e.g. "123456789012/us-gov-west-1".
+    """
+
+    scope: str
+    namespace: str
+    metric_name: str
+    dimensions: Tuple[Tuple[str, str], ...]
+    stat: str
+    period: int = DAY
+    unit: Optional[str] = None
+
+    @property
+    def key(self) -> str:
+        return json.dumps(self)
+
+    def query(self, query_id: str) -> dict:
+        metric_stat = {
+            "Metric": {
+                "Namespace": self.namespace,
+                "MetricName": self.metric_name,
+                "Dimensions": [
+                    {"Name": name, "Value": value} for name, value in self.dimensions
+                ],
+            },
+            "Period": self.period,
+            "Stat": self.stat,
+        }
+        if self.unit:
+            metric_stat["Unit"] = self.unit
+        return {"Id": query_id, "MetricStat": metric_stat}
+
+
+def epoch(when: datetime.datetime) -> float:
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=datetime.timezone.utc)
+    return when.timestamp()
+
+
+def align(timestamp: float, period: int) -> int:
+    """
+    Rounds a time down to the start of its period, e.g. UTC midnight for a
+    daily period, which is where CloudWatch puts the datapoints.
+    """
+
+    return int(timestamp // period * period)
+
+
+def to_datetime(timestamp: float) -> datetime.datetime:
+    return datetime.datetime.fromtimestamp(timestamp, tz=datetime.timezone.utc)
+
+
+class MetricStore:
+    """
+    Thread-safe SQLite-backed store of CloudWatch datapoints.
+    """
+
+    def __init__(
+        self, path: Optional[str] = None, retention: float = DEFAULT_RETENTION
+    ):
+        path = path or default_store_path()
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+        self.retention = retention
+        self.lock = threading.Lock()
+
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS datapoints (
+                series TEXT NOT NULL,
+                timestamp INTEGER NOT NULL,
+                value REAL NOT NULL,
+                PRIMARY KEY (series, timestamp)
+            )
+            """
+        )
+        self.db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS coverage (
+                series TEXT PRIMARY KEY,
+                start INTEGER NOT NULL,
+                end INTEGER NOT NULL
+            )
+            """
+        )
+        self.db.commit()
+
+    def coverage(self, series: Series) -> Optional[Tuple[int, int]]:
+        """
+        Returns the (start, end) range the store holds final datapoints for.
+        """
+
+        with self.lock:
+            return self.db.execute(
+                "SELECT start, end FROM coverage WHERE series = ?", (series.key,)
+            ).fetchone()
+
+    def missing_ranges(
+        self, series: Series, start: int, end: int
+    ) -> List[Tuple[int, int]]:
+        """
+        Returns the parts of [start, end) that still have to be fetched.
+        """
+
+        covered = self.coverage(series)
+        if covered is None or covered[1] < start or covered[0] > end:
+            return [(start, end)]
+
+        ranges = []
+        if start < covered[0]:
+            ranges.append((start, covered[0]))
+        if covered[1] < end:
+            ranges.append((covered[1], end))
+        return ranges
+
+    def save(
+        self,
+        series: Series,
+        fetched: Tuple[int, int],
+        final_end: int,
+        datapoints: Iterable[Tuple[int, float]],
+    ) -> None:
+        """
+        Saves the datapoints of a fetched range and extends the coverage of
+        the series up to final_end, the start of the period still in progress.
+        """
+
+        with self.lock:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO datapoints VALUES (?, ?, ?)",
+                [(series.key, timestamp, value) for timestamp, value in datapoints],
+            )
+            row = self.db.execute(
+                "SELECT start, end FROM coverage WHERE series = ?", (series.key,)
+            ).fetchone()
+            start, end = fetched[0], min(fetched[1], final_end)
+            if row is not None and row[1] >= start and row[0] <= end:
+                start, end = min(start, row[0]), max(end, row[1])
+            self.db.execute(
+                "INSERT OR REPLACE INTO coverage VALUES (?, ?, ?)",
+                (series.key, start, end),
+            )
+            self.db.commit()
+
+    def fetch(
+        self,
+        cloudwatch_client,
+        batch: List[Series],
+        fetch_range: Tuple[int, int],
+        final_ends: dict,
+    ) -> None:
+        """
+        Fetches one range of a batch of series with a single paginated
+        GetMetricData request and saves the results.
+        """
+
+        datapoints = defaultdict(list)
+        pages = cloudwatch_client.get_paginator("get_metric_data").paginate(
+            MetricDataQueries=[
+                series.query("m" + str(index)) for index, series in enumerate(batch)
+            ],
+            StartTime=to_datetime(fetch_range[0]),
+            EndTime=to_datetime(fetch_range[1]),
+        )
+        # Results for one query can be split across pages
+        for page in pages:
+            for result in page["MetricDataResults"]:
+                series = batch[int(result["Id"][1:])]
+                datapoints[series].extend(
+                    (int(epoch(timestamp)), value)
+                    for timestamp, value in zip(result["Timestamps"], result["Values"])
+                )
+
+        for series in batch:
+            self.save(series, fetch_range, final_ends[series], datapoints[series])
+
+    def update(
+        self,
+        cloudwatch_client,
+        series_list: Iterable[Series],
+        start_time: datetime.datetime,
+        end_time: datetime.datetime,
+    ) -> Set[Series]:
+        """
+        Brings the store up to date for a lookback window, fetching only the
+        ranges it does not hold yet.  Series sharing a range are fetched
+        together.  Returns the series that could not be fetched, which are
+        tried again on the next update.
+        """
+
+        ranges = defaultdict(list)
+        final_ends = {}
+        for series in set(series_list):
+            start = align(epoch(start_time), series.period)
+            end = align(epoch(end_time), series.period)
+            final_ends[series] = end
+            # The period in progress is always fetched again
+            for fetch_range in self.missing_ranges(series, start, end + series.period):
+                ranges[(series.period, fetch_range)].append(series)
+
+        failed = set()
+        for (period, fetch_range), series_group in ranges.items():
+            periods = max((fetch_range[1] - fetch_range[0]) // period, 1)
+            batch_size = max(
+                min(MAX_QUERIES_PER_REQUEST, MAX_DATAPOINTS_PER_REQUEST // periods), 1
+            )
+            # A single series over a very long range is split by time instead
+            step = min(periods, MAX_DATAPOINTS_PER_REQUEST) * period
+
+            for i in range(0, len(series_group), batch_size):
+                batch = series_group[i : i + batch_size]
+                for start in range(fetch_range[0], fetch_range[1], step):
+                    try:
+                        self.fetch(
+                            cloudwatch_client,
+                            batch,
+                            (start, min(start + step, fetch_range[1])),
+                            final_ends,
+                        )
+                    except Exception as err:
+                        print(
+                            f"Could not pull cloudwatch metrics for "
+                            f"{len(batch)} series: {err}",
+                            file=sys.stderr,
+                        )
+                        failed.update(batch)
+                        break
+
+        return failed
+
+    def values(
+        self,
+        series: Series,
+        start_time: datetime.datetime,
+        end_time: datetime.datetime,
+    ) -> List[float]:
+        """
+        Returns the stored values of a series within a window, oldest first.
+        """
+
+        with self.lock:
+            rows = self.db.execute(
+                """
+                SELECT value FROM datapoints
+                WHERE series = ? AND timestamp >= ? AND timestamp <= ?
+                ORDER BY timestamp
+                """,
+                (
+                    series.key,
+                    align(epoch(start_time), series.period),
+                    epoch(end_time),
+                ),
+            ).fetchall()
+        return [value for value, in rows]
+
+    def prune(self) -> None:
+        """
+        Drops datapoints older than the retention period and shrinks the
+        coverage of their series to match.
+        """
+
+        cutoff = int(time.time() - self.retention)
+        with self.lock:
+            self.db.execute("DELETE FROM datapoints WHERE timestamp < ?", (cutoff,))
+            self.db.execute("DELETE FROM coverage WHERE end < ?", (cutoff,))
+            self.db.execute(
+                "UPDATE coverage SET start = ? WHERE start < ?", (cutoff, cutoff)
+            )
+            self.db.commit()
+
+    def close(self) -> None:
+        if self.db is None:
+            return
+
+        self.prune()
+        with self.lock:
+            self.db.close()
+            self.db = None
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_metric_store() -> MetricStore:
+    """
+    Returns the process-wide metric store, opening it on first use.  It is
+    pruned and closed when the process exits.
+    """
+
+    global _store
+
+    with _store_lock:
+        if _store is None:
+            _store = MetricStore()
+            atexit.register(_store.close)
+        return _store
@@ -0,0 +1,94 @@
+"""
+Helpers for overlapping slow producers (paginated AWS and CF API calls) with
+the work done on what they produce.
+"""
+
+import datetime
+import queue
+import threading
+import time
+from typing import Iterable, Iterator, Optional
+
+
+_DONE = object()
+
+
+def read_ahead(iterable: Iterable, depth: int = 1) -> Iterator:
+    """
+    Yields the items of an iterable while a background thread is already
+    producing the next `depth` items, e.g. fetching page N+1 of an API listing
+    while the caller works on page N.  Errors raised while producing are
+    re-raised to the caller in order.
+    """
+
+    items = queue.Queue(maxsize=max(depth, 1))
+    stop = threading.Event()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except BaseException as err:
+            put((_DONE, err))
+            return
+        put((_DONE, None))
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+
+    try:
+        while True:
+            item, err = items.get()
+            if item is _DONE:
+                if err is not None:
+                    raise err
+                return
+            yield item
+    finally:
+        # Lets the producer give up if the caller stopped early.
+        stop.set()
+
+
+class Progress:
+    """
+    Counts the items a long run has finished and estimates when it will be
+    done, e.g. "300/1200 (25%), 45.2/s, ETA 0:00:20".  Without a total it
+    only reports the count and rate.
+    """
+
+    def __init__(self, total: Optional[int] = None, clock=time.monotonic):
+        self.total = total
+        self.clock = clock
+        self.started = clock()
+        self.done = 0
+
+    def add(self, count: int = 1) -> str:
+        self.done += count
+        return str(self)
+
+    def rate(self) -> float:
+        elapsed = self.clock() - self.started
+        return self.done / elapsed if elapsed > 0 else 0.0
+
+    def __str__(self) -> str:
+        rate = self.rate()
+        if not self.total:
+            return f"{self.done}, {rate:.1f}/s"
+
+        percent = 100 * self.done // self.total
+        if rate > 0:
+            remaining = max(self.total - self.done, 0) / rate
+            eta = datetime.timedelta(seconds=round(remaining))
+        else:
+            eta = "unknown"
+        return f"{self.done}/{self.total} ({percent}%), {rate:.1f}/s, ETA {eta}"
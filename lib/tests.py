@@ -0,0 +1,613 @@
+import unittest
+from unittest.mock import MagicMock, patch
+import gzip
+import itertools
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import requests
+import aws_pricing
+import cf_api
+import cf_names
+import cf_owners
+import json_stream
+import metric_store
+import pipeline
+
+
+def api_response(body=None, status_code=200) -> requests.Response:
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = json.dumps(body).encode("utf-8") if body is not None else b""
+    return response
+
+
+def page(resources, next_href=None) -> dict:
+    next_page = {"href": next_href} if next_href else None
+    return {"pagination": {"next": next_page}, "resources": resources}
+
+
+def make_client() -> cf_api.CFClient:
+    return cf_api.CFClient(
+        api_url="https://api.example.gov", token="bearer test", verify=True
+    )
+
+
+class TestCFClientRequest(unittest.TestCase):
+    @patch("requests.Session.request")
+    def test_returns_json_body(self, mock_call):
+        body = {"guid": "a-guid", "name": "a-name"}
+        mock_call.return_value = api_response(body)
+        result = make_client().get("/v3/spaces/a-guid")
+        self.assertEqual(result, body)
+        args, kwargs = mock_call.call_args
+        self.assertEqual(args, ("GET", "https://api.example.gov/v3/spaces/a-guid"))
+        self.assertEqual(kwargs["headers"], {"Authorization": "bearer test"})
+
+    @patch("requests.Session.request")
+    def test_returns_empty_object_if_no_body(self, mock_call):
+        mock_call.return_value = api_response(status_code=204)
+        result = make_client().delete("/v3/test/1")
+        self.assertEqual(result, {})
+
+    @patch("requests.Session.request")
+    def test_raises_exception(self, mock_call):
+        body = {"errors": [{"title": "CF-Error", "detail": "error"}]}
+        mock_call.return_value = api_response(body, status_code=422)
+        with self.assertRaises(cf_api.CFAPIError) as context:
+            make_client().post("/v3/test", {"test": "data"})
+        self.assertEqual(context.exception.status_code, 422)
+        self.assertEqual(context.exception.errors, body["errors"])
+
+    @patch("subprocess.run")
+    @patch("requests.Session.request")
+    def test_refreshes_token_on_unauthorized(self, mock_call, mock_run):
+        mock_run.return_value.stdout = "bearer fresh\n"
+        mock_call.side_effect = [
+            api_response(status_code=401),
+            api_response({"name": "a-name"}),
+        ]
+        client = make_client()
+        result = client.get("/v3/spaces/a-guid")
+        self.assertEqual(result, {"name": "a-name"})
+        self.assertEqual(mock_run.call_count, 1)
+        _, kwargs = mock_call.call_args
+        self.assertEqual(kwargs["headers"], {"Authorization": "bearer fresh"})
+
+
+class UnavailableHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = json.dumps({"errors": [{"title": "CF-Unavailable"}]}).encode("utf-8")
+        self.send_response(503)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestCFClientRetries(unittest.TestCase):
+    @patch("urllib3.util.retry.time.sleep")
+    def test_raises_api_error_once_retries_run_out(self, _):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), UnavailableHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        client = cf_api.CFClient(
+            api_url=f"http://127.0.0.1:{server.server_port}",
+            token="bearer test",
+            verify=True,
+        )
+        with self.assertRaises(cf_api.CFAPIError) as context:
+            client.get("/v3/spaces")
+        self.assertEqual(context.exception.status_code, 503)
+
+
+class TestCFClientPaginate(unittest.TestCase):
+    @patch("requests.Session.request")
+    def test_follows_next_links(self, mock_call):
+        mock_call.side_effect = [
+            api_response(page([{"guid": "1"}], "https://api.example.gov/v3/x?page=2")),
+            api_response(page([{"guid": "2"}, {"guid": "3"}])),
+        ]
+        result = list(make_client().paginate("/v3/x"))
+        self.assertEqual([r["guid"] for r in result], ["1", "2", "3"])
+        args, _ = mock_call.call_args
+        self.assertEqual(args, ("GET", "https://api.example.gov/v3/x?page=2"))
+
+
+class TestChunkGuids(unittest.TestCase):
+    def test_chunks_by_query_length(self):
+        guids = list(f"guid-{i:04}" for i in range(100))
+        chunks = list(cf_api.chunk_guids(guids, max_length=130))
+        self.assertEqual(len(chunks), 10)
+        self.assertEqual(sum(chunks, []), guids)
+
+
+class TestCFNameCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.path = os.path.join(self.tmpdir.name, "names.sqlite3")
+        self.client = MagicMock()
+        self.client.get.return_value = {"name": "a-name"}
+
+    def name_cache(self, **kwargs) -> cf_names.CFNameCache:
+        name_cache = cf_names.CFNameCache(self.path, client=self.client, **kwargs)
+        self.addCleanup(name_cache.close)
+        return name_cache
+
+    def test_fetches_once_and_persists(self):
+        first = self.name_cache()
+        self.assertEqual(first.get_name("spaces", "a-guid"), "a-name")
+        self.assertEqual(first.get_name("spaces", "a-guid"), "a-name")
+        first.close()
+
+        second = self.name_cache()
+        self.assertEqual(second.get_name("spaces", "a-guid"), "a-name")
+        self.assertEqual(self.client.get.call_count, 1)
+
+    def test_refetches_stale_names(self):
+        name_cache = self.name_cache(ttls={"spaces": -1})
+        name_cache.get_name("spaces", "a-guid")
+        name_cache.get_name("spaces", "a-guid")
+        self.assertEqual(self.client.get.call_count, 2)
+
+    def test_caches_not_found(self):
+        self.client.get.side_effect = cf_api.CFAPIError("GET", "url", 404, [])
+        name_cache = self.name_cache()
+        self.assertEqual(name_cache.get_name("spaces", "a-guid"), cf_names.NOT_FOUND)
+        self.assertEqual(name_cache.get_name("spaces", "a-guid"), cf_names.NOT_FOUND)
+        self.assertEqual(self.client.get.call_count, 1)
+
+    def test_prefetches_missing_names_in_bulk(self):
+        self.client.paginate.return_value = [{"guid": "b-guid", "name": "b-name"}]
+        name_cache = self.name_cache()
+        name_cache.store("spaces", {"a-guid": "a-name"})
+        name_cache.prefetch("spaces", ["a-guid", "b-guid", "c-guid", "b-guid"])
+        self.client.paginate.assert_called_once_with(
+            "/v3/spaces", params={"guids": "b-guid,c-guid", "per_page": 5000}
+        )
+        self.assertEqual(name_cache.get_name("spaces", "b-guid"), "b-name")
+        self.assertEqual(name_cache.get_name("spaces", "c-guid"), cf_names.NOT_FOUND)
+        self.client.get.assert_not_called()
+
+    def test_prefetches_service_plan_names(self):
+        self.client.get.return_value = {
+            "pagination": {"next": None},
+            "resources": [
+                {
+                    "guid": "a-guid",
+                    "relationships": {"service_plan": {"data": {"guid": "plan-guid"}}},
+                },
+                # User-provided service instances have no service plan
+                {
+                    "guid": "ups-guid",
+                    "relationships": {"space": {"data": {"guid": "space-guid"}}},
+                },
+                {"guid": "other-ups-guid", "relationships": {}},
+            ],
+            "included": {"service_plans": [{"guid": "plan-guid", "name": "micro-psql"}]},
+        }
+        name_cache = self.name_cache()
+        guids = ["a-guid", "b-guid", "ups-guid", "other-ups-guid"]
+        name_cache.prefetch(cf_names.SERVICE_INSTANCE_PLANS, guids)
+        self.assertEqual(self.client.get.call_count, 1)
+        plan_name = name_cache.get_name(cf_names.SERVICE_INSTANCE_PLANS, "a-guid")
+        self.assertEqual(plan_name, "micro-psql")
+        for guid in guids[1:]:
+            plan_name = name_cache.get_name(cf_names.SERVICE_INSTANCE_PLANS, guid)
+            self.assertEqual(plan_name, cf_names.NOT_FOUND)
+        self.assertEqual(self.client.get.call_count, 1)
+
+    def test_reports_names_it_cannot_resolve(self):
+        error = cf_api.CFAPIError("GET", "url", 503, [])
+        self.client.paginate.side_effect = error
+        self.client.get.side_effect = [{"name": "a-name"}, error]
+        names, errors = self.name_cache().get_names("spaces", ["a-guid", "b-guid"])
+        self.assertEqual(names, {"a-guid": "a-name"})
+        self.assertEqual(errors, {"b-guid": error})
+
+    def test_does_not_lock_cache_after_hit(self):
+        name_cache = self.name_cache()
+        name_cache.store("spaces", {"a-guid": "a-name"})
+        self.assertEqual(name_cache.get_name("spaces", "a-guid"), "a-name")
+
+        other = sqlite3.connect(self.path, timeout=0.1)
+        self.addCleanup(other.close)
+        with other:
+            other.execute(
+                "INSERT INTO names VALUES ('spaces', 'b-guid', 'b-name', 0, 0)"
+            )
+
+    def test_returns_none_without_guid(self):
+        self.assertIsNone(self.name_cache().get_name("spaces", ""))
+        self.client.get.assert_not_called()
+
+    @patch("time.time", side_effect=itertools.count(1000))
+    def test_evicts_least_recently_used(self, mock_time):
+        name_cache = self.name_cache(max_entries=2)
+        name_cache.store("spaces", {"old-guid": "old"})
+        name_cache.store("spaces", {"new-guid": "new"})
+        name_cache.store("spaces", {"newer-guid": "newer"})
+        name_cache.lookup("spaces", "old-guid")
+        name_cache.evict()
+        self.assertEqual(name_cache.lookup("spaces", "old-guid"), "old")
+        self.assertIsNone(name_cache.lookup("spaces", "new-guid"))
+
+
+class TestCFOwnerResolver(unittest.TestCase):
+    def setUp(self):
+        self.client = MagicMock()
+        self.client.paginate.return_value = [
+            {
+                "guid": "instance-guid",
+                "name": "my-db",
+                "relationships": {"space": {"data": {"guid": "space-guid"}}},
+            }
+        ]
+        self.client.get.return_value = {
+            "pagination": {"next": None},
+            "resources": [
+                {
+                    "guid": "space-guid",
+                    "name": "dev",
+                    "relationships": {"organization": {"data": {"guid": "org-guid"}}},
+                }
+            ],
+            "included": {"organizations": [{"guid": "org-guid", "name": "my-org"}]},
+        }
+        self.resolver = cf_owners.CFOwnerResolver(client=self.client)
+
+    def test_resolves_scan_in_bulk(self):
+        self.resolver.prefetch_owners(
+            ["space-guid", "other-space-guid"], ["instance-guid", "other-guid"]
+        )
+        self.assertEqual(self.client.paginate.call_count, 1)
+        self.assertEqual(self.client.get.call_count, 1)
+
+        owner = self.resolver.get_org_space_service_instance("space-guid", "instance-guid")
+        self.assertEqual(owner, ("my-org", "dev", "my-db"))
+        owner = self.resolver.get_org_space_service_instance("other-space-guid", "other-guid")
+        self.assertEqual(owner, (cf_owners.NOT_FOUND,) * 3)
+        self.assertEqual(self.client.paginate.call_count, 1)
+        self.assertEqual(self.client.get.call_count, 1)
+
+    def test_resolves_owner_from_service_instance(self):
+        owner = self.resolver.get_service_instance_owner("instance-guid")
+        self.assertEqual(owner, ("my-org", "dev", "my-db"))
+        self.resolver.get_service_instance_owner("instance-guid")
+        self.assertEqual(self.client.get.call_count, 1)
+
+    @patch("requests.Session.request")
+    def test_retries_failed_lookups(self, mock_call):
+        mock_call.side_effect = [
+            requests.ConnectionError("connection refused"),
+            api_response(status_code=503),
+            api_response(page(self.client.paginate.return_value)),
+            api_response(self.client.get.return_value),
+        ]
+        resolver = cf_owners.CFOwnerResolver(client=make_client())
+        with patch("sys.stderr"):
+            owner = resolver.get_service_instance_owner("instance-guid")
+            self.assertEqual(owner, (cf_owners.NOT_FOUND,) * 3)
+            owner = resolver.get_service_instance_owner("instance-guid")
+            self.assertEqual(owner, (cf_owners.NOT_FOUND,) * 3)
+        owner = resolver.get_service_instance_owner("instance-guid")
+        self.assertEqual(owner, ("my-org", "dev", "my-db"))
+
+
+class FakeCloudWatch:
+    """
+    Answers GetMetricData with one datapoint of value 1.0 per period.
+    """
+
+    def __init__(self):
+        self.requests = []
+
+    def get_paginator(self, operation):
+        return self
+
+    def paginate(self, MetricDataQueries, StartTime, EndTime):
+        self.requests.append((len(MetricDataQueries), StartTime, EndTime))
+        results = []
+        for query in MetricDataQueries:
+            period = query["MetricStat"]["Period"]
+            timestamps = [
+                metric_store.to_datetime(timestamp)
+                for timestamp in range(
+                    int(StartTime.timestamp()), int(EndTime.timestamp()), period
+                )
+            ]
+            results.append(
+                {
+                    "Id": query["Id"],
+                    "Timestamps": timestamps,
+                    "Values": [1.0] * len(timestamps),
+                }
+            )
+        return [{"MetricDataResults": results}]
+
+
+class TestMetricStore(unittest.TestCase):
+    def setUp(self):
+        self.store = metric_store.MetricStore(":memory:")
+        self.addCleanup(self.store.close)
+        self.cloudwatch = FakeCloudWatch()
+        self.series = [
+            metric_store.Series(
+                "scope", "AWS/RDS", "DatabaseConnections", (("id", str(i)),), "Sum"
+            )
+            for i in range(3)
+        ]
+        self.end = metric_store.to_datetime(100 * metric_store.DAY + 3600)
+
+    def window(self, days):
+        return self.end - metric_store.datetime.timedelta(days=days), self.end
+
+    def test_fetches_only_new_datapoints(self):
+        failed = self.store.update(self.cloudwatch, self.series, *self.window(30))
+        self.assertEqual(failed, set())
+        self.assertEqual(len(self.cloudwatch.requests), 1)
+        self.assertEqual(len(self.store.values(self.series[0], *self.window(30))), 31)
+
+        self.end += metric_store.datetime.timedelta(days=2)
+        self.store.update(self.cloudwatch, self.series, *self.window(30))
+        self.assertEqual(len(self.cloudwatch.requests), 2)
+        _, start, end = self.cloudwatch.requests[1]
+        self.assertEqual((end - start).days, 3)
+        self.assertEqual(len(self.store.values(self.series[0], *self.window(30))), 31)
+
+    def test_backfills_longer_lookbacks(self):
+        self.store.update(self.cloudwatch, self.series, *self.window(7))
+        self.store.update(self.cloudwatch, self.series, *self.window(90))
+        _, start, end = self.cloudwatch.requests[1]
+        self.assertEqual((end - start).days, 83)
+        self.assertEqual(len(self.store.values(self.series[0], *self.window(90))), 91)
+
+    @patch("metric_store.MAX_DATAPOINTS_PER_REQUEST", 40)
+    def test_splits_requests_by_datapoint_limit(self):
+        self.store.update(self.cloudwatch, self.series, *self.window(30))
+        counts = [count for count, _, _ in self.cloudwatch.requests]
+        self.assertEqual(counts, [1, 1, 1])
+
+    def test_retries_failed_series(self):
+        error = RuntimeError("throttled")
+        with patch.object(self.cloudwatch, "paginate", side_effect=error):
+            with patch("sys.stderr"):
+                failed = self.store.update(
+                    self.cloudwatch, self.series, *self.window(30)
+                )
+        self.assertEqual(failed, set(self.series))
+        self.store.update(self.cloudwatch, self.series, *self.window(30))
+        _, start, end = self.cloudwatch.requests[0]
+        self.assertEqual((end - start).days, 31)
+
+
+class TestIterJsonArray(unittest.TestCase):
+    document = {
+        "Marker": "DBInstances",
+        "Other": [{"DBInstances": [0]}],
+        "DBInstances": [
+            {"DBInstanceIdentifier": f"db-{i}", "AllocatedStorage": 10 * i}
+            for i in range(25)
+        ]
+        + [12345, "text"],
+    }
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def write(self, name, opener=open) -> str:
+        path = os.path.join(self.tmpdir.name, name)
+        with opener(path, "wt") as json_file:
+            json.dump(self.document, json_file, indent=2)
+        return path
+
+    @patch("json_stream.READ_SIZE", 7)
+    def test_streams_items_across_reads(self):
+        path = self.write("rds.json")
+        items = list(json_stream.iter_json_array(path, "DBInstances"))
+        self.assertEqual(items, self.document["DBInstances"])
+
+    def test_reads_gzip(self):
+        path = self.write("rds.json.gz", opener=gzip.open)
+        items = list(json_stream.iter_json_array(path, "DBInstances"))
+        self.assertEqual(items, self.document["DBInstances"])
+
+    def test_raises_for_missing_key(self):
+        path = self.write("rds.json")
+        with self.assertRaises(KeyError):
+            list(json_stream.iter_json_array(path, "CacheClusters"))
+
+    @patch("json_stream.READ_SIZE", 5)
+    def test_streams_object_members(self):
+        self.document = {
+            "skipped": {"nested": [{"products": {"x": 1}}]},
+            "products": {"a": {"sku": "a"}, "b": {"sku": "b"}},
+            "terms": {"Reserved": {"a": [1, 2]}, "OnDemand": {"a": {"t": 1.5}}},
+        }
+        path = self.write("offer.json")
+        members = list(
+            json_stream.iter_json_members(path, [("products",), ("terms", "OnDemand")])
+        )
+        self.assertEqual(
+            members,
+            [
+                (("products",), "a", {"sku": "a"}),
+                (("products",), "b", {"sku": "b"}),
+                (("terms", "OnDemand"), "a", {"t": 1.5}),
+            ],
+        )
+
+    def test_streams_numbers_split_across_reads(self):
+        path = os.path.join(self.tmpdir.name, "rds.json")
+        with open(path, "w") as json_file:
+            json_file.write('{"Other": [12.5e-3, 3], "DBInstances": [12.5e-3, 3]}')
+
+        for read_size in range(1, 60):
+            with self.subTest(read_size=read_size), patch(
+                "json_stream.READ_SIZE", read_size
+            ):
+                items = list(json_stream.iter_json_array(path, "DBInstances"))
+                self.assertEqual(items, [12.5e-3, 3])
+
+
+def offer_product(sku, product_family, **attributes) -> dict:
+    return {"sku": sku, "productFamily": product_family, "attributes": attributes}
+
+
+def offer_term(sku, unit, price) -> dict:
+    dimension = {"unit": unit, "beginRange": "0", "pricePerUnit": {"USD": price}}
+    return {sku + ".TERM": {"priceDimensions": {sku + ".TERM.DIM": dimension}}}
+
+
+class TestAWSPricing(unittest.TestCase):
+    offer = {
+        "offerCode": "AmazonRDS",
+        "products": {
+            "PG": offer_product(
+                "PG",
+                "Database Instance",
+                location="AWS GovCloud (US-West)",
+                instanceType="db.t3.micro",
+                databaseEngine="PostgreSQL",
+                deploymentOption="Multi-AZ",
+            ),
+            "EAST": offer_product(
+                "EAST",
+                "Database Instance",
+                location="US East (N. Virginia)",
+                instanceType="db.t3.micro",
+                databaseEngine="PostgreSQL",
+                deploymentOption="Multi-AZ",
+            ),
+            "GP2": offer_product(
+                "GP2",
+                "Database Storage",
+                location="AWS GovCloud (US-West)",
+                volumeType="General Purpose",
+                databaseEngine="Any",
+                deploymentOption="Single-AZ",
+            ),
+        },
+        "terms": {
+            "OnDemand": {
+                "PG": offer_term("PG", "Hrs", "0.0440000000"),
+                "EAST": offer_term("EAST", "Hrs", "0.0360000000"),
+                "GP2": offer_term("GP2", "GB-Mo", "0.1380000000"),
+            },
+            "Reserved": {"PG": offer_term("PG", "Quantity", "300")},
+        },
+    }
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.cache_dir = os.path.join(self.tmpdir.name, "prices")
+
+    def test_loads_json_offer_for_region(self):
+        path = os.path.join(self.tmpdir.name, "index.json.gz")
+        with gzip.open(path, "wt") as offer_file:
+            json.dump(self.offer, offer_file)
+
+        prices = aws_pricing.load_prices([path], cache_dir=self.cache_dir)
+        self.assertEqual(prices[("rds", "instance", "postgres", "db.t3.micro", True)], 0.044)
+        self.assertEqual(prices[("rds", "storage", "mysql", False)], 0.138)
+        self.assertNotIn(("rds", "instance", "postgres", "db.t3.micro", False), prices)
+
+    def test_loads_csv_offer(self):
+        path = os.path.join(self.tmpdir.name, "index.csv")
+        with open(path, "w") as offer_file:
+            offer_file.write(
+                '"FormatVersion","v1.0"\n'
+                '"OfferCode","AmazonElastiCache"\n'
+                '"SKU","TermType","Unit","PricePerUnit","Currency","StartingRange",'
+                '"Location","Product Family","Instance Type","Cache Engine"\n'
+                '"A","OnDemand","Hrs","0.0200000000","USD","0","AWS GovCloud (US-West)",'
+                '"Cache Instance","cache.t3.micro","Redis"\n'
+                '"A","Reserved","Quantity","100","USD","0","AWS GovCloud (US-West)",'
+                '"Cache Instance","cache.t3.micro","Redis"\n'
+                '"B","OnDemand","Hrs","0.0200000000","USD","0","AWS GovCloud (US-West)",'
+                '"Cache Instance","cache.t3.micro","Memcached"\n'
+            )
+
+        prices = aws_pricing.load_prices([path], cache_dir=self.cache_dir)
+        self.assertEqual(prices, {("redis", "instance", "cache.t3.micro"): 0.02})
+
+    def test_names_es_instances_like_describe_output(self):
+        path = os.path.join(self.tmpdir.name, "index.json")
+        with open(path, "w") as offer_file:
+            json.dump(
+                {
+                    "offerCode": "AmazonES",
+                    "products": {
+                        "ES": offer_product(
+                            "ES",
+                            "Amazon OpenSearch Service Instance",
+                            location="AWS GovCloud (US-West)",
+                            instanceType="m5.large.search",
+                        ),
+                    },
+                    "terms": {"OnDemand": {"ES": offer_term("ES", "Hrs", "0.1680000000")}},
+                },
+                offer_file,
+            )
+
+        prices = aws_pricing.load_prices([path], cache_dir=self.cache_dir)
+        self.assertEqual(prices, {("es", "instance", "m5.large.elasticsearch"): 0.168})
+
+    def test_reuses_cached_table(self):
+        path = os.path.join(self.tmpdir.name, "index.json")
+        with open(path, "w") as offer_file:
+            json.dump(self.offer, offer_file)
+
+        first = aws_pricing.load_offer(path, cache_dir=self.cache_dir)
+        with patch("aws_pricing.parse_offer") as mock_parse:
+            second = aws_pricing.load_offer(path, cache_dir=self.cache_dir)
+        mock_parse.assert_not_called()
+        self.assertEqual(first, second)
+
+
+class TestReadAhead(unittest.TestCase):
+    def test_yields_items_in_order(self):
+        items = list(pipeline.read_ahead(iter(range(50)), depth=3))
+        self.assertEqual(items, list(range(50)))
+
+    def test_reraises_producer_errors(self):
+        def pages():
+            yield 1
+            raise RuntimeError("throttled")
+
+        results = pipeline.read_ahead(pages())
+        self.assertEqual(next(results), 1)
+        with self.assertRaises(RuntimeError):
+            next(results)
+
+    def test_stops_early(self):
+        results = pipeline.read_ahead(itertools.count())
+        self.assertEqual(list(itertools.islice(results, 3)), [0, 1, 2])
+        results.close()
+
+
+class TestProgress(unittest.TestCase):
+    def test_estimates_time_left(self):
+        clock = MagicMock(side_effect=[0, 10, 10])
+        progress = pipeline.Progress(total=100, clock=clock)
+        self.assertEqual(progress.add(25), "25/100 (25%), 2.5/s, ETA 0:00:30")
+
+    def test_counts_without_total(self):
+        clock = MagicMock(side_effect=[0, 4])
+        progress = pipeline.Progress(clock=clock)
+        self.assertEqual(progress.add(10), "10, 2.5/s")
+
+
+if __name__ == "__main__":
+    unittest.main()